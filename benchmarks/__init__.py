@@ -0,0 +1 @@
+"""Benchmark harness for the download engine; see ``python -m benchmarks.bench --help``."""
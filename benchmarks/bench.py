@@ -0,0 +1,259 @@
+"""Throughput benchmarks for the download engine against the local stand-in server.
+
+Every cell of the grid (file size x segments x concurrency x layout x
+workers x bulk) downloads ``files`` files (``concurrency`` unless given) of
+``size`` bytes, ``concurrency`` at a time, through a ``DownloadEngine``
+configured like the GUI's, with ``segments`` as its segment limit. The
+layout is ``preallocated`` (segments written in place) or ``parts`` (part
+files joined at the end). With ``workers`` above 0 the engine leases the
+files to that many worker processes instead of downloading them itself.
+With ``bulk`` above 0, files up to that size go through the small-file
+lane, ``concurrency`` at a time. Cells run in fresh processes, so CPU time
+(worker processes included) and peak RSS belong to that cell alone;
+``write_amplification`` is the bytes written to disk per byte downloaded,
+``read_amplification`` the bytes read back from disk to compute checksums
+per byte downloaded, and ``files_per_s`` the rate at which files
+completed. With ``--verify`` every job has the file's checksum as its
+expected one, so segmented downloads are hashed and checked.
+The results, with the commit they were measured at, are written as JSON
+for comparing runs.
+
+Usage: python -m benchmarks.bench --sizes 1M,16M,64M --segments 1,4,10 --concurrency 1,4 \
+           --layouts preallocated,parts --workers 0,2 -o results.json
+       python -m benchmarks.bench --sizes 64M --segments 10 --concurrency 1 --verify
+       python -m benchmarks.bench --sizes 16K --segments 10 --concurrency 32 --files 2000 --bulk 0,2M
+
+Server options (``--latency``, ``--bandwidth``, ``--no-ranges``,
+``--disconnect-rate``, ``--error-rate``) are passed to ``benchmarks.server``.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.server import CHUNK_SIZE, add_server_arguments, pattern_bytes
+from downloader.checksums import new_hash
+from downloader.ratelimit import parse_rate
+
+MEGABYTE = 1048576
+CELL_TIMEOUT = 600  # seconds
+LAYOUTS = ("preallocated", "parts")
+
+
+def pattern_checksum(size):
+    """The checksum of a ``size`` byte file from the benchmark server, in ``Job.expected_hash`` form."""
+    hasher = new_hash("sha256")
+    for offset in range(0, size, CHUNK_SIZE):
+        hasher.update(pattern_bytes(offset, min(CHUNK_SIZE, size - offset)))
+    return f"sha256:{hasher.hexdigest()}"
+
+
+def run_cell(base_url, size, segments, concurrency, retries, layout="preallocated", workers=0, files=0, bulk=0,
+             verify=False):
+    """Download ``files`` files of ``size`` bytes, ``concurrency`` at a time, and measure it.
+
+    Runs in the cell's own process.
+    """
+    from downloader import DownloadEngine, Job
+    from downloader.cluster import spawn_workers, stop_workers
+
+    files = files or concurrency
+    finished = threading.Event()
+    first_byte = {}
+    outcome = {}
+
+    def on_events(events):
+        now = time.perf_counter()
+        for event in events:
+            job = event.job
+            if job.downloaded and job.id not in first_byte:
+                first_byte[job.id] = now
+            if event.kind in ("completed", "failed"):
+                outcome[job.id] = event.kind
+        if len(outcome) == files:
+            finished.set()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as directory:
+        # A high UI rate makes the first progress event a close measure of the first byte
+        engine = DownloadEngine(on_events=on_events, max_concurrent=concurrency, per_host_limit=concurrency,
+                                max_segments=segments, retries=retries, max_ui_rate=1000,
+                                preallocate=layout == "preallocated", bulk_threshold=bulk,
+                                bulk_concurrent=concurrency)
+        engine.start()
+        processes = []
+        if workers:
+            address = engine.serve_workers("127.0.0.1:0").result()
+            processes = spawn_workers(address, workers, -(-concurrency // workers))
+            while len(engine.snapshot().result()["workers"]) < workers:
+                time.sleep(0.01)
+        jobs = [Job(index + 1, f"{base_url}/{size}?{index}", directory) for index in range(files)]
+        checksum = pattern_checksum(size) if verify else None
+        for job in jobs:
+            job.file_name = f"file-{job.id}"
+            job.expected_hash = checksum
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for job in jobs:
+            engine.submit(job)
+        finished.wait(CELL_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        engine.shutdown()
+        stop_workers(processes)
+        # Worker processes count in full, start-up included, since their time cannot be split
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += children.ru_utime + children.ru_stime
+        complete = [job for job in jobs if outcome.get(job.id) == "completed"
+                    and os.path.getsize(job.file_path) == size]
+
+    ttfb = sorted(first_byte[job.id] - start for job in jobs if job.id in first_byte)
+    received = sum(engine.metrics.bytes_by_host.values())
+    return {
+        "size": size,
+        "segments": segments,
+        "concurrency": concurrency,
+        "layout": layout,
+        "workers": workers,
+        "files": files,
+        "bulk": bulk,
+        "verify": verify,
+        "completed": len(complete),
+        "failed": files - len(complete),
+        "seconds": round(elapsed, 4),
+        "mb_per_s": round(size * len(complete) / MEGABYTE / elapsed, 3) if elapsed else None,
+        "files_per_s": round(len(complete) / elapsed, 2) if elapsed else None,
+        "ttfb_ms": round(ttfb[len(ttfb) // 2] * 1000, 2) if ttfb else None,
+        "cpu_seconds": round(cpu, 4),
+        "bytes_written": engine.metrics.bytes_written,
+        "write_amplification": round(engine.metrics.bytes_written / received, 3) if received else None,
+        "bytes_read": engine.metrics.bytes_read,
+        "read_amplification": round(engine.metrics.bytes_read / received, 3) if received else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def start_server(args):
+    command = [sys.executable, "-m", "benchmarks.server", "--latency", str(args.latency),
+               "--bandwidth", str(args.bandwidth), "--disconnect-rate", str(args.disconnect_rate),
+               "--error-rate", str(args.error_rate)]
+    if not args.ranges:
+        command.append("--no-ranges")
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith("port "):
+        server.kill()
+        raise RuntimeError("benchmark server did not start")
+    return server, f"http://127.0.0.1:{line.split()[1]}"
+
+
+def spawn_cell(base_url, size, segments, concurrency, retries, layout, workers, files, bulk, verify):
+    cell = json.dumps({"base_url": base_url, "size": size, "segments": segments, "concurrency": concurrency,
+                       "retries": retries, "layout": layout, "workers": workers, "files": files, "bulk": bulk,
+                       "verify": verify})
+    result = subprocess.run([sys.executable, "-m", "benchmarks.bench", "--cell", cell],
+                            capture_output=True, text=True, timeout=CELL_TIMEOUT + 30)
+    if result.returncode != 0:
+        raise RuntimeError(f"benchmark cell failed: {result.stderr.strip()}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_list(convert):
+    return lambda text: [convert(item) for item in text.split(",") if item]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench",
+                                     description="Measure download throughput over a grid of settings.")
+    parser.add_argument("--sizes", type=parse_list(parse_rate), default="1M,16M,64M",
+                        help="comma-separated file sizes (default: 1M,16M,64M)")
+    parser.add_argument("--segments", type=parse_list(int), default="1,4,10",
+                        help="comma-separated segment limits (default: 1,4,10)")
+    parser.add_argument("--concurrency", type=parse_list(int), default="1,4",
+                        help="comma-separated numbers of simultaneous downloads (default: 1,4)")
+    parser.add_argument("--layouts", type=parse_list(str), default="preallocated",
+                        help=f"comma-separated output layouts out of {', '.join(LAYOUTS)} (default: preallocated)")
+    parser.add_argument("--workers", type=parse_list(int), default="0",
+                        help="comma-separated numbers of worker processes, 0 to download in the engine's "
+                             "own process (default: 0)")
+    parser.add_argument("--bulk", type=parse_list(parse_rate), default="0",
+                        help="comma-separated bulk mode thresholds, 0 for off (default: 0)")
+    parser.add_argument("--files", type=int, default=0, metavar="N",
+                        help="files to download per cell (default: the concurrency)")
+    parser.add_argument("--verify", action="store_true",
+                        help="give every download its expected checksum, so it is hashed and checked")
+    parser.add_argument("--retries", type=int, default=3, help="retries per download (default: 3)")
+    parser.add_argument("-o", "--output", default="bench-results.json", help="JSON file to write the results to")
+    parser.add_argument("--cell", help=argparse.SUPPRESS)
+    add_server_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.cell:
+        cell = json.loads(args.cell)
+        print(json.dumps(run_cell(cell["base_url"], cell["size"], cell["segments"], cell["concurrency"],
+                                  cell["retries"], cell["layout"], cell["workers"], cell["files"], cell["bulk"],
+                                  cell["verify"])))
+        return 0
+
+    unknown = [layout for layout in args.layouts if layout not in LAYOUTS]
+    if unknown:
+        print(f"unknown layout: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    server, base_url = start_server(args)
+    results = []
+    try:
+        for size, segments, concurrency, layout, workers, bulk in itertools.product(
+                args.sizes, args.segments, args.concurrency, args.layouts, args.workers, args.bulk):
+            result = spawn_cell(base_url, size, segments, concurrency, args.retries, layout, workers, args.files,
+                                bulk, args.verify)
+            results.append(result)
+            print(f"{size / MEGABYTE:>8.3f} MB  {segments:>3} segments  {concurrency:>3} concurrent  "
+                  f"{layout:>12}  {workers:>2} workers  bulk {bulk / MEGABYTE:>4.1f} MB  "
+                  f"{result['mb_per_s'] or 0:>9.2f} MB/s  {result['files_per_s'] or 0:>8.1f} files/s  "
+                  f"ttfb {result['ttfb_ms'] or 0:>7.1f} ms  "
+                  f"cpu {result['cpu_seconds']:>6.2f} s  rss {result['peak_rss_kb'] / 1024:>6.1f} MB  "
+                  f"writes x{result['write_amplification'] or 0:.2f}  reads x{result['read_amplification'] or 0:.2f}  "
+                  f"{result['failed']} failed", file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "commit": current_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": {"latency": args.latency, "bandwidth": args.bandwidth, "ranges": args.ranges,
+                   "disconnect_rate": args.disconnect_rate, "error_rate": args.error_rate, "seed": args.seed},
+        "retries": args.retries,
+        "verify": args.verify,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
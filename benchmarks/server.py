@@ -0,0 +1,175 @@
+"""Local stand-in for a download server, used by the benchmarks.
+
+``GET /<size>`` (for example ``/16M``) returns that many bytes of a fixed
+pattern, so nothing is read from disk and any byte can be checked from its
+offset. Every size has the ETag ``"<size>"`` and the same Last-Modified, and
+conditional requests for them get a 304. The server can add latency before
+every response, cap the bandwidth of each connection, refuse Range requests,
+drop connections half way through a body and answer with 503 at random.
+
+Usage: python -m benchmarks.server [--port 0] [--latency 0.05] [--bandwidth 5M] ...
+
+The port actually bound is printed as ``port <n>`` on the first line.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from email.utils import formatdate
+
+from aiohttp import web
+
+from downloader.ratelimit import parse_rate
+
+CHUNK_SIZE = 64 * 1024
+PATTERN = bytes(range(256)) * (CHUNK_SIZE // 256 + 1)
+LAST_MODIFIED = formatdate(0, usegmt=True)
+
+
+def pattern_bytes(offset, length):
+    """The ``length`` bytes the server sends from ``offset``; ``length`` is at most ``CHUNK_SIZE``."""
+    start = offset % 256
+    return PATTERN[start:start + length]
+
+
+class ServerConfig:
+    """Behaviour of the stand-in server."""
+
+    def __init__(self, latency=0.0, bandwidth=0, ranges=True, disconnect_rate=0.0, error_rate=0.0, seed=None):
+        self.latency = latency  # seconds before every response
+        self.bandwidth = bandwidth  # bytes per second per connection, 0 for unlimited
+        self.ranges = ranges
+        self.disconnect_rate = disconnect_rate  # share of bodies cut off part way
+        self.error_rate = error_rate  # share of GET requests answered with 503
+        self.random = random.Random(seed)
+
+
+CONFIG = web.AppKey("config", ServerConfig)
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` for a single ``bytes=`` range, or None if it cannot be served."""
+    unit, _, spec = header.partition("=")
+    start, _, end = spec.partition("-")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    try:
+        if not start:
+            start, end = size - int(end), size - 1
+        else:
+            start, end = int(start), int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+def not_modified(request, headers):
+    """Whether the request's ``If-None-Match``, or else its ``If-Modified-Since``, matches ``headers``."""
+    if "If-None-Match" in request.headers:
+        return headers["ETag"] in (tag.strip() for tag in request.headers["If-None-Match"].split(","))
+    return request.headers.get("If-Modified-Since") == headers["Last-Modified"]
+
+
+async def serve_file(request):
+    config = request.app[CONFIG]
+    try:
+        size = parse_rate(request.match_info["size"])
+    except ValueError:
+        raise web.HTTPNotFound()
+    if config.latency:
+        await asyncio.sleep(config.latency)
+    if request.method == "GET" and config.random.random() < config.error_rate:
+        return web.Response(status=503, headers={"Retry-After": "1"})
+
+    headers = {"ETag": f'"{size}"', "Last-Modified": LAST_MODIFIED,
+               "Accept-Ranges": "bytes" if config.ranges else "none"}
+    if not_modified(request, headers):
+        return web.Response(status=304, headers=headers)
+    start, end, status = 0, size - 1, 200
+    if config.ranges and "Range" in request.headers:
+        requested = parse_range(request.headers["Range"], size)
+        if requested is None:
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        start, end = requested
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return web.Response(status=status, headers=headers)
+
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+    cut_off = None
+    if config.random.random() < config.disconnect_rate:
+        cut_off = config.random.randint(start, end)
+    offset = start
+    try:
+        while offset <= end:
+            length = min(CHUNK_SIZE, end - offset + 1)
+            if cut_off is not None and offset + length > cut_off:
+                request.transport.close()
+                return response
+            await response.write(pattern_bytes(offset, length))
+            offset += length
+            if config.bandwidth:
+                await asyncio.sleep(length / config.bandwidth)
+        await response.write_eof()
+    except ConnectionError:
+        pass  # the client gave up on the body, as it does when a download is stopped or retried
+    return response
+
+
+def create_app(config):
+    app = web.Application()
+    app[CONFIG] = config
+    app.router.add_get("/{size}", serve_file)
+    return app
+
+
+async def run_server(config, host="127.0.0.1", port=0):
+    runner = web.AppRunner(create_app(config), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    print(f"port {port}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--bandwidth", type=parse_rate, default=0, metavar="RATE",
+                        help="bandwidth cap per connection, e.g. 5M (default: unlimited)")
+    parser.add_argument("--no-ranges", dest="ranges", action="store_false", help="ignore Range requests")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, metavar="P",
+                        help="share of responses whose connection is dropped part way (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, metavar="P",
+                        help="share of GET requests answered with 503 (default: 0)")
+    parser.add_argument("--seed", type=int, help="seed for the injected faults")
+
+
+def config_from_args(args):
+    return ServerConfig(args.latency, args.bandwidth, args.ranges, args.disconnect_rate, args.error_rate, args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.server",
+                                     description="Serve generated files with configurable latency and faults.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (default: any free port)")
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run_server(config_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,27 @@
 import sys
 import os
-import time
 import logging
-from urllib.parse import urlparse
+import secrets
+import time
+STARTED_AT = time.monotonic()  # startup metrics count from here, before Qt is loaded
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                             QPushButton, QLabel, QListWidget, QProgressBar, QFileDialog,
-                             QMessageBox, QComboBox, QSpinBox, QLineEdit, QDialog, QFormLayout,
-                             QListWidgetItem, QInputDialog, QScrollArea, QGroupBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QTimer, QSettings
+                             QPushButton, QLabel, QFileDialog, QMessageBox, QComboBox, QSpinBox,
+                             QLineEdit, QDialog, QFormLayout, QInputDialog, QScrollArea, QGroupBox,
+                             QTableView, QHeaderView, QAbstractItemView, QStyledItemDelegate,
+                             QStyleOptionProgressBar, QStyle, QMenu, QCheckBox)
+from PyQt6.QtCore import (Qt, QObject, QTimer, pyqtSignal, QSettings, QStandardPaths, QAbstractTableModel, QModelIndex,
+                          QEvent)
 from PyQt6.QtGui import QIcon
-from pypdl import Pypdl
+from downloader import DownloadCache, DownloadEngine, Job, JobStore
+from downloader.bulk import BULK_THRESHOLD
+from downloader.checksums import FileVerifier
+from downloader.cluster import TOKEN_VARIABLE, spawn_workers, stop_workers
+from downloader.ingest import LinkIngester
+from downloader.jobs import DirectoryIndex, parse_link
+from downloader.postprocess import PostProcessor, build_steps
+from downloader.preflight import ProbeResult, order_jobs
+from downloader.restore import JobFeeder, JobRestorer, reconcile
+from downloader.scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 class HeaderDialog(QDialog):
     def __init__(self, parent=None):
@@ -34,184 +46,277 @@ class HeaderDialog(QDialog):
         self.ok_button.clicked.connect(self.accept)
         self.cancel_button.clicked.connect(self.reject)
 
-class DownloadThread(QThread):
-    progress_update = pyqtSignal(int, float, str)
-    download_complete = pyqtSignal(bool, str)
+class EngineBridge(QObject):
+    """Re-emits batches of engine events as a Qt signal so they are handled on the GUI thread."""
+    events_received = pyqtSignal(list)
 
-    def __init__(self, url, download_path, headers, progress=0):
-        super().__init__()
-        self.url = url
-        self.download_path = download_path
-        self.headers = headers
-        self.paused = False
-        self.dl = None
-        self.initial_progress = progress
 
-    def run(self):
-        self.dl = Pypdl(headers=self.headers)
-        file_name = os.path.basename(urlparse(self.url).path)
+class IngestBridge(QObject):
+    """Carries progress of a background ``LinkIngester`` over to the GUI thread."""
+    links_added = pyqtSignal(int)
+    finished = pyqtSignal(object)
 
-        try:
-            self.dl.start(
-                url=self.url,
-                display=True,
-                block=False,
-                multisegment=True,
-                segments=10,
-                file_path=self.download_path,
-                retries=3,
-            )
-
-            while not self.dl.completed:
-                if self.paused:
-                    time.sleep(0.5)
-                    continue
-                if self.dl.failed:
-                    raise Exception("An error occurred.")
-                self.progress_update.emit(self.dl.progress, self.dl.speed, file_name)
-                time.sleep(0.5)
-
-            self.progress_update.emit(100, 0, file_name)
-            self.download_complete.emit(True, file_name)
-        except Exception as e:
-            logging.error(f"Error downloading {file_name}: {e}")
-            self.download_complete.emit(False, file_name)
-
-    def pause(self):
-        self.paused = True
-        if self.dl:
-            self.dl.stop()
-
-    def resume(self):
-        self.paused = False
-        if self.dl:
-            try:
-                # Restart the download from the last progress point
-                self.dl.start(
-                    url=self.url,
-                    display=True,
-                    block=False,
-                    multisegment=True,
-                    segments=10,
-                    file_path=self.download_path,
-                    retries=5,
-                )
-            except Exception as e:
-                logging.error(f"Error resuming download for {self.url}: {e}")
-
-
-class DownloadWindow(QWidget):
-    def __init__(self, url, download_path, headers, progress=0):
-        super().__init__()
-        self.url = url
-        self.download_path = download_path
-        self.headers = headers
-        self.progress = progress
-        self.thread = None
-        self.setWindowTitle(f"Downloading: {os.path.basename(urlparse(url).path)}")
-        self.setGeometry(100, 100, 400, 150)
-
-        layout = QVBoxLayout(self)
-
-        self.progress_bar = QProgressBar(self)
-        self.progress_bar.setValue(progress)
-        layout.addWidget(self.progress_bar)
-
-        self.speed_label = QLabel("Download Speed: 0 MB/s")
-        layout.addWidget(self.speed_label)
-
-        self.pause_resume_button = QPushButton("Pause")
-        self.pause_resume_button.clicked.connect(self.toggle_pause_resume)
-        layout.addWidget(self.pause_resume_button)
-
-        self.cooldown_timer = QTimer(self)
-        self.cooldown_timer.timeout.connect(self.enable_pause_resume_button)
-        self.cooldown_duration = 1500  # 1 second cooldown
-
-        self.thread = DownloadThread(url, download_path, headers, progress)
-        self.thread.progress_update.connect(self.update_progress)
-        self.thread.download_complete.connect(self.download_finished)
-        self.thread.start()
-
-    def update_progress(self, progress, speed, file_name):
-        self.progress_bar.setValue(progress)
-        self.speed_label.setText(f"Download Speed: {speed:.2f} MB/s")
-        self.progress = progress
-
-    def toggle_pause_resume(self):
-        if self.thread.paused:
-            self.thread.resume()
-            self.pause_resume_button.setText("Pause")
-        else:
-            self.thread.pause()
-            self.pause_resume_button.setText("Resume")
-        # Disable the button and start the cooldown timer
-        self.pause_resume_button.setEnabled(False)
-        self.cooldown_timer.start(self.cooldown_duration)
-
-    def enable_pause_resume_button(self):
-        self.pause_resume_button.setEnabled(True)
-        self.cooldown_timer.stop()
-
-    def download_finished(self, success, file_name):
-        if success:
-            self.close_and_clear_window()
-            QMessageBox.information(self, "Complete", f"Download of {file_name} completed.")
-        else:
-            self.close_and_clear_window()
-            QMessageBox.warning(self, "Error", f"Download of {file_name} failed.")
-    def close_and_clear_window(self):
-        current_active_windows = show_current_active_windows()
-        if self.window() in current_active_windows:
-            self.window().close()
-            current_active_windows.remove(self.window())
-            # current_active_windows.remove(self.window())
-    def pause_download(self):
-        if self.thread.paused:
-            pass
-        else:
-            self.thread.pause()
-            self.pause_resume_button.setText("Resume")
 
-    def resume_download(self):
-        if self.thread.paused:
-            self.thread.resume()
-            self.pause_resume_button.setText("Pause")
+class RestoreBridge(QObject):
+    """Hands the saved jobs a background ``JobRestorer`` read over to the GUI thread."""
+    page_loaded = pyqtSignal(int, list)
+    finished = pyqtSignal(object)
 
-        else:
-            pass
 
-    def stop_download(self):
-        """Safely stop the download process and close the window."""
-        if self.thread.isRunning():
-            # Somewhere else in your code
-            self.thread.pause()
-            self.thread.terminate()
-            self.thread.wait()
-            self.close_and_clear_window()
+class CheckBridge(QObject):
+    """Delivers preflight results and the verdicts of a ``FileVerifier`` on the GUI thread."""
+    preflight_done = pyqtSignal(list)
+    file_verified = pyqtSignal(object, str)
 
-    def closeEvent(self, event):
-        if self.thread.isRunning():
-            reply = QMessageBox.question(self, 'Exit',
-                                         'Download is still in progress. Are you sure you want to quit?',
-                                         QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-                                         QMessageBox.StandardButton.No)
-            if reply == QMessageBox.StandardButton.Yes:
-                # Somewhere else in your code
-                inner_active_window = self.window()
-                active_windows = show_current_active_windows()
-                if inner_active_window in active_windows:
-                    active_windows.remove(inner_active_window)
-                self.thread.pause()
-                self.thread.terminate()
-                self.thread.wait()
-                event.accept()
-            else:
-                event.ignore()
+
+class FeedBridge(QObject):
+    """Hands the pages of jobs a background ``JobFeeder`` is starting over to the GUI thread."""
+    page_fed = pyqtSignal(list)
+    finished = pyqtSignal(object)
+
+
+def format_size(size):
+    if not size:
+        return ""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class DownloadTableModel(QAbstractTableModel):
+    """Table of every job, with an index from job ID to row for in-place updates.
+
+    Jobs saved in the ``JobStore`` are read a page at a time as the view
+    scrolls (``canFetchMore``/``fetchMore``). New jobs are written to the
+    store first and then read in the same way, so the table only ever holds
+    the rows that have been looked at. At startup the count and first page
+    come from a ``JobRestorer`` (``restore``) so the window never waits for
+    the store; once its ``DirectoryIndex`` is in (``set_files``), completed
+    jobs whose file is gone are reset as pages load.
+    """
+    PAGE_SIZE = 256
+    COLUMNS = ["File", "Status", "Progress", "Speed", "Size"]
+    FILE, STATUS, PROGRESS, SPEED, SIZE = range(5)
+    STATUS_TEXT = {"idle": "", "queued": "Queued", "downloading": "Downloading", "paused": "Paused",
+                   "completed": "Completed", "failed": "Failed", "stopped": "Stopped", "checking": "Checking",
+                   "verifying": "Verifying", "waiting": "Waiting for Host", "processing": "Processing"}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._jobs = []
+        self._rows = {}
+        self._checked = set()
+        self._done_icon = QIcon.fromTheme("emblem-default")
+        self._store = None
+        self._last_loaded_id = 0
+        self._unfetched = 0
+        self._files = None
+        self.live_job = None  # returns the object a job already running elsewhere has, for rows loaded later
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._jobs)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.column() == self.FILE:
+            flags |= Qt.ItemFlag.ItemIsUserCheckable
+        return flags
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        job = self._jobs[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == self.FILE:
+                return job.file_name
+            if column == self.STATUS:
+                return self.STATUS_TEXT.get(job.status, job.status)
+            if column == self.PROGRESS:
+                return f"{job.progress}%"
+            if column == self.SPEED:
+                return f"{job.speed:.2f} MB/s" if job.status == "downloading" else ""
+            if column == self.SIZE:
+                return format_size(job.size)
+        elif role == Qt.ItemDataRole.UserRole and column == self.PROGRESS:
+            return job.progress
+        elif role == Qt.ItemDataRole.CheckStateRole and column == self.FILE:
+            return Qt.CheckState.Checked if job.id in self._checked else Qt.CheckState.Unchecked
+        elif role == Qt.ItemDataRole.DecorationRole and column == self.FILE and job.status == "completed":
+            return self._done_icon
+        elif role == Qt.ItemDataRole.ToolTipRole:
+            if job.status == "completed":
+                return f"{job.file_name} already downloaded"
+            if job.status in ("failed", "waiting") and job.error:
+                return f"{job.file_name}: {job.error}"
+            if job.status == "downloading" and job.resume_latency is not None:
+                return f"{job.url}\nResumed in {job.resume_latency * 1000:.0f} ms"
+            return job.url
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if role == Qt.ItemDataRole.CheckStateRole and index.column() == self.FILE:
+            self.set_checked(self._jobs[index.row()], Qt.CheckState(value) == Qt.CheckState.Checked)
+            return True
+        return False
+
+    def attach_store(self, store):
+        self.beginResetModel()
+        self._jobs.clear()
+        self._rows.clear()
+        self._checked.clear()
+        self._store = store
+        self._last_loaded_id = 0
+        self._unfetched = 0  # known once ``restore`` is called
+        self._files = None
+        self.endResetModel()
+
+    def restore(self, total, jobs):
+        """Show the first page of saved jobs, read by a ``JobRestorer``, out of ``total``."""
+        self._unfetched = max(0, total - len(self._jobs) - len(jobs))
+        if jobs:
+            self._last_loaded_id = jobs[-1].id
+            self._insert(jobs)
+
+    def set_files(self, files):
+        """Check loaded and future pages against ``files``, a ``DirectoryIndex`` of the download directories."""
+        self._files = files
+        for job in self._reconcile(self._jobs):
+            self.update_job(job)
+
+    def _reconcile(self, jobs):
+        # Completed jobs whose file was deleted or changed since are downloaded again
+        changed = [job for job in jobs if reconcile(job, self._files)]
+        for job in changed:
+            self._checked.add(job.id)
+            self._store.mark(job)
+        return changed
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._unfetched > 0
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        jobs = self._store.load(self._last_loaded_id, self.PAGE_SIZE)
+        self._unfetched = max(0, self._unfetched - len(jobs)) if jobs else 0
+        if jobs:
+            self._last_loaded_id = jobs[-1].id
+            if self._files is not None:
+                self._reconcile(jobs)
+            self._insert(jobs)
+
+    def total_jobs(self):
+        return len(self._jobs) + self._unfetched
+
+    def unfetched(self):
+        return self._unfetched
+
+    def last_loaded_id(self):
+        return self._last_loaded_id
+
+    def files(self):
+        return self._files
+
+    def loaded_job(self, job_id):
+        row = self._rows.get(job_id)
+        return None if row is None else self._jobs[row]
+
+    def is_checked(self, job):
+        return job.id in self._checked
+
+    def replace_job(self, job):
+        """Show ``job`` in the row of the loaded job with its ID."""
+        row = self._rows.get(job.id)
+        if row is not None:
+            self._jobs[row] = job
+            self.update_job(job)
+
+    def append_saved(self, count):
+        """Account for ``count`` jobs just added to the store."""
+        self._unfetched += count
+        if len(self._jobs) < self.PAGE_SIZE:
+            self.fetchMore()
+
+    def _insert(self, jobs):
+        if self.live_job is not None:
+            jobs = [self.live_job(job) for job in jobs]
+        first = len(self._jobs)
+        self.beginInsertRows(QModelIndex(), first, first + len(jobs) - 1)
+        for row, job in enumerate(jobs, first):
+            self._jobs.append(job)
+            self._rows[job.id] = row
+            if job.status != "completed":
+                self._checked.add(job.id)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._jobs.clear()
+        self._rows.clear()
+        self._checked.clear()
+        self._unfetched = 0
+        if self._store is not None:
+            self._store.clear()
+        self.endResetModel()
+
+    def jobs(self):
+        return list(self._jobs)
+
+    def job_at(self, row):
+        return self._jobs[row]
+
+    def checked_jobs(self):
+        return [job for job in self._jobs if job.id in self._checked]
+
+    def set_checked(self, job, checked):
+        if checked:
+            self._checked.add(job.id)
         else:
-            event.accept()
-# Global variable to store the reference to the DownloaderApp instance
-global_downloader_app = None
+            self._checked.discard(job.id)
+        row = self._rows.get(job.id)
+        if row is not None:
+            index = self.index(row, self.FILE)
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
+
+    def update_job(self, job):
+        """Repaint the row of ``job`` in place."""
+        row = self._rows.get(job.id)
+        if row is not None:
+            self.dataChanged.emit(self.index(row, self.FILE), self.index(row, self.SIZE))
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """Paints the progress column as a progress bar without creating a widget per row."""
+
+    def paint(self, painter, option, index):
+        progress = index.data(Qt.ItemDataRole.UserRole) or 0
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(2, 2, -2, -2)
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = progress
+        bar.text = f"{progress}%"
+        bar.textVisible = True
+        bar.state = QStyle.StateFlag.State_Enabled | QStyle.StateFlag.State_Horizontal
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.ControlElement.CE_ProgressBar, bar, painter, option.widget)
 
 
 class DownloaderApp(QMainWindow):
@@ -226,21 +331,120 @@ class DownloaderApp(QMainWindow):
         self.layout = QVBoxLayout(self.central_widget)
 
         self.setup_ui()
-        self.links_dict = {}
         self.current_theme = "light"
         self.download_path = ""
-        self.download_queue = []
-        self.active_windows = set()
+        self.pending_jobs = {}
+        self.active_jobs = {}
+        self.job_store = JobStore(self.job_store_path())
+        self.job_ids = self.job_store.ids
+        self.download_model.attach_store(self.job_store)
+        self.restore_bridge = RestoreBridge()
+        self.restore_bridge.page_loaded.connect(self.on_restore_page)
+        self.restore_bridge.finished.connect(self.on_restore_finished)
+        self.restorer = None
+        self.first_paint = None
+        self.worker_processes = []
+        # Nothing that changes the list until the saved jobs are in
+        for button in (self.select_files_button, self.add_link_button, self.download_button):
+            button.setEnabled(False)
+        self.download_table.viewport().installEventFilter(self)
+        self.ingester = None
+        self.ingest_bridge = IngestBridge()
+        self.ingest_bridge.links_added.connect(self.on_links_added)
+        self.ingest_bridge.finished.connect(self.on_ingest_finished)
+        self.verifier = FileVerifier()
+        self.checking_jobs = {}  # jobs being probed or verified before they are submitted
+        self.check_bridge = CheckBridge()
+        self.check_bridge.preflight_done.connect(self.on_preflight_done)
+        self.feeder = None
+        self.feed_bridge = FeedBridge()
+        self.feed_bridge.page_fed.connect(self.on_feed_page)
+        self.feed_bridge.finished.connect(self.on_feed_finished)
+        self.download_model.live_job = self.live_job
+        self.check_bridge.file_verified.connect(self.on_file_verified)
+        self.engine_bridge = EngineBridge()
+        self.engine_bridge.events_received.connect(self.on_engine_events)
+        self.download_cache = DownloadCache(self.cache_path())
+        self.post_hooks = {}
+        self.use_http2 = False
+        self.postprocessor = PostProcessor([])  # the steps are set by apply_postprocessing
+        self.engine = DownloadEngine(on_events=self.engine_bridge.events_received.emit,
+                                     max_concurrent=self.concurrent_downloads_spinner.value(),
+                                     per_host_limit=self.per_host_downloads_spinner.value(),
+                                     store=self.job_store, cache=self.download_cache,
+                                     postprocessor=self.postprocessor)
+        self.engine.start()
         self.load_settings()
+        self.concurrent_downloads_spinner.valueChanged.connect(self.apply_concurrency)
+        self.auto_concurrency_checkbox.toggled.connect(self.apply_concurrency)
+        self.auto_min_spinner.valueChanged.connect(self.apply_concurrency)
+        self.apply_concurrency()
+        self.per_host_downloads_spinner.valueChanged.connect(self.engine.set_per_host_limit)
+        self.engine.set_per_host_limit(self.per_host_downloads_spinner.value())
+        self.global_limit_spinner.valueChanged.connect(self.apply_rate_limits)
+        self.host_limit_spinner.valueChanged.connect(self.apply_rate_limits)
+        self.apply_rate_limits()
+        self.keep_partial_checkbox.toggled.connect(self.engine.set_keep_partial)
+        self.engine.set_keep_partial(self.keep_partial_checkbox.isChecked())
+        self.cache_size_spinner.valueChanged.connect(self.apply_cache_size)
+        self.apply_cache_size()
+        self.extract_checkbox.toggled.connect(self.apply_postprocessing)
+        self.apply_postprocessing()
+        self.bulk_checkbox.toggled.connect(self.apply_bulk_mode)
+        self.apply_bulk_mode()
         self.change_theme(self.current_theme)
-        global global_downloader_app
-        global_downloader_app = self
+        # Counting and reading the saved jobs and listing their directories happens off the GUI thread
+        self.restorer = JobRestorer(self.job_store, on_page=self.restore_bridge.page_loaded.emit,
+                                    on_finished=self.restore_bridge.finished.emit)
+        self.restorer.start()
+        # Keeps the remaining bytes and ETA current while downloads run
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.refresh_eta)
+        self.status_timer.start(1000)
+
+    def job_store_path(self):
+        # Next to the settings file, e.g. ~/.config/AdvancedDownloader/jobs.db
+        settings = QSettings("AdvancedDownloader", "Settings")
+        return os.path.join(os.path.dirname(settings.fileName()), "jobs.db")
+
+    def cache_path(self):
+        # e.g. ~/.cache/AdvancedDownloader
+        cache_root = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation)
+        return os.path.join(cache_root, "AdvancedDownloader")
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Type.Paint and self.first_paint is None \
+                and watched is self.download_table.viewport():
+            self.first_paint = time.monotonic() - STARTED_AT
+            self.engine.record_startup("first_paint", self.first_paint)
+            watched.removeEventFilter(self)
+        return super().eventFilter(watched, event)
+
+    def on_restore_page(self, total, jobs):
+        self.download_model.restore(total, jobs)
+        self.select_files_button.setEnabled(self.ingester is None)
+        self.add_link_button.setEnabled(True)
+        self.update_status_bar()
 
-    def get_active_windows(self):
-        # Ensure self.active_windows exists before returning it
-        if not hasattr(self, 'active_windows'):
-            self.active_windows = set()
-        return self.active_windows
+    def on_restore_finished(self, restorer):
+        self.restorer = None
+        self.download_model.set_files(restorer.files)
+        self.download_button.setEnabled(True)
+        restored = time.monotonic() - STARTED_AT
+        self.engine.record_startup("restored", restored)
+        self.update_status_bar()
+        if restorer.error:
+            QMessageBox.critical(self, "Restore Error", f"Error restoring saved downloads: {restorer.error}")
+        else:
+            first_paint = f", first paint after {self.first_paint:.2f} s" if self.first_paint is not None else ""
+            self.statusBar().showMessage(f"Restored {restorer.total} saved downloads in {restored:.2f} s{first_paint}",
+                                         5000)
+
+    def get_active_jobs(self):
+        # Ensure self.active_jobs exists before returning it
+        if not hasattr(self, 'active_jobs'):
+            self.active_jobs = {}
+        return self.active_jobs
 
     def get_download_path(self):
         if not hasattr(self, 'download_path'):
@@ -272,21 +476,92 @@ class DownloaderApp(QMainWindow):
         file_group.setLayout(file_layout)
         scroll_layout.addWidget(file_group)
 
-        # List of files
-        self.file_list = QListWidget()
-        self.file_list.setSelectionMode(QListWidget.SelectionMode.ExtendedSelection)
-        scroll_layout.addWidget(self.file_list)
+        # Table of downloads
+        self.download_model = DownloadTableModel(self)
+        self.download_table = QTableView()
+        self.download_table.setModel(self.download_model)
+        self.download_table.setItemDelegateForColumn(DownloadTableModel.PROGRESS, ProgressDelegate(self.download_table))
+        self.download_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.download_table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.download_table.verticalHeader().setVisible(False)
+        # Fixed row heights keep scrolling cheap with many thousands of rows
+        self.download_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.download_table.verticalHeader().setDefaultSectionSize(24)
+        self.download_table.horizontalHeader().setSectionResizeMode(DownloadTableModel.FILE, QHeaderView.ResizeMode.Stretch)
+        self.download_table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.download_table.customContextMenuRequested.connect(self.show_table_menu)
+        self.download_table.setMinimumHeight(300)
+        scroll_layout.addWidget(self.download_table)
 
         # Download options group
         options_group = QGroupBox("Download Options")
         options_layout = QHBoxLayout()
         self.concurrent_downloads_label = QLabel("Concurrent Downloads:")
         self.concurrent_downloads_spinner = QSpinBox()
-        self.concurrent_downloads_spinner.setRange(1, 10)
+        self.concurrent_downloads_spinner.setRange(1, 500)
         self.concurrent_downloads_spinner.setValue(3)
         options_layout.addWidget(self.concurrent_downloads_label)
         options_layout.addWidget(self.concurrent_downloads_spinner)
 
+        self.auto_concurrency_checkbox = QCheckBox("Auto")
+        self.auto_concurrency_checkbox.setToolTip("Adjust concurrent downloads and segments to the measured "
+                                                  "throughput, up to the number set here")
+        options_layout.addWidget(self.auto_concurrency_checkbox)
+        self.auto_min_label = QLabel("Min:")
+        self.auto_min_spinner = QSpinBox()
+        self.auto_min_spinner.setRange(1, 500)
+        self.auto_min_spinner.setValue(1)
+        options_layout.addWidget(self.auto_min_label)
+        options_layout.addWidget(self.auto_min_spinner)
+
+        self.per_host_downloads_label = QLabel("Per Host:")
+        self.per_host_downloads_spinner = QSpinBox()
+        self.per_host_downloads_spinner.setRange(1, 100)
+        self.per_host_downloads_spinner.setValue(4)
+        options_layout.addWidget(self.per_host_downloads_label)
+        options_layout.addWidget(self.per_host_downloads_spinner)
+
+        self.global_limit_label = QLabel("Total Limit:")
+        self.global_limit_spinner = self.create_rate_spinner()
+        options_layout.addWidget(self.global_limit_label)
+        options_layout.addWidget(self.global_limit_spinner)
+
+        self.host_limit_label = QLabel("Per-Host Limit:")
+        self.host_limit_spinner = self.create_rate_spinner()
+        options_layout.addWidget(self.host_limit_label)
+        options_layout.addWidget(self.host_limit_spinner)
+
+        self.cache_size_label = QLabel("Cache:")
+        self.cache_size_spinner = QSpinBox()
+        self.cache_size_spinner.setRange(0, 10_000_000)
+        self.cache_size_spinner.setSingleStep(1024)
+        self.cache_size_spinner.setSuffix(" MB")
+        self.cache_size_spinner.setSpecialValueText("Off")
+        options_layout.addWidget(self.cache_size_label)
+        options_layout.addWidget(self.cache_size_spinner)
+
+        self.queue_order_label = QLabel("Queue Order:")
+        self.queue_order_combo = QComboBox()
+        self.queue_order_combo.addItem("As Listed", "listed")
+        self.queue_order_combo.addItem("Smallest First", "smallest")
+        self.queue_order_combo.addItem("Largest First", "largest")
+        options_layout.addWidget(self.queue_order_label)
+        options_layout.addWidget(self.queue_order_combo)
+
+        self.keep_partial_checkbox = QCheckBox("Keep Partial Files")
+        self.keep_partial_checkbox.setToolTip("Keep the parts of stopped downloads so they can resume later")
+        self.keep_partial_checkbox.setChecked(True)
+        options_layout.addWidget(self.keep_partial_checkbox)
+
+        self.bulk_checkbox = QCheckBox("Bulk Mode for Small Files")
+        self.bulk_checkbox.setToolTip("Download files under 2 MB many at a time over shared connections, "
+                                      "one request each; for long lists of thumbnails or manifests")
+        options_layout.addWidget(self.bulk_checkbox)
+
+        self.extract_checkbox = QCheckBox("Extract Archives")
+        self.extract_checkbox.setToolTip("Unpack .zip, .tar.gz and .gz downloads into a folder next to them")
+        options_layout.addWidget(self.extract_checkbox)
+
         self.custom_headers_button = QPushButton("Custom Headers")
         self.custom_headers_button.setIcon(QIcon.fromTheme("preferences-system-network"))
         self.custom_headers_button.clicked.connect(self.set_custom_headers)
@@ -331,12 +606,6 @@ class DownloaderApp(QMainWindow):
         theme_group.setLayout(theme_layout)
         scroll_layout.addWidget(theme_group)
 
-        # Download progress overview
-        self.progress_overview = QListWidget()
-        self.progress_overview.setMaximumHeight(150)
-        scroll_layout.addWidget(QLabel("Download Progress Overview:"))
-        scroll_layout.addWidget(self.progress_overview)
-
         scroll_area.setWidget(scroll_content)
         self.layout.addWidget(scroll_area)
 
@@ -344,29 +613,99 @@ class DownloaderApp(QMainWindow):
         self.statusBar().showMessage("Ready")
         self.update_status_bar()
 
+    def create_rate_spinner(self):
+        spinner = QSpinBox()
+        spinner.setRange(0, 10_000_000)
+        spinner.setSingleStep(100)
+        spinner.setSuffix(" KB/s")
+        spinner.setSpecialValueText("Unlimited")
+        return spinner
+
+    def apply_rate_limits(self):
+        self.engine.set_rate_limits(self.global_limit_spinner.value() * 1024, self.host_limit_spinner.value() * 1024)
+
+    def apply_concurrency(self):
+        auto = self.auto_concurrency_checkbox.isChecked()
+        self.auto_min_label.setVisible(auto)
+        self.auto_min_spinner.setVisible(auto)
+        self.auto_min_spinner.setMaximum(self.concurrent_downloads_spinner.value())
+        if auto:
+            self.engine.set_auto_concurrency(self.auto_min_spinner.value(), self.concurrent_downloads_spinner.value())
+        else:
+            self.engine.set_auto_concurrency(None)
+            self.engine.set_max_concurrent(self.concurrent_downloads_spinner.value())
+        self.update_status_bar()
+
+    def apply_cache_size(self):
+        self.download_cache.set_max_size(self.cache_size_spinner.value() * 1024 * 1024)
+        self.update_status_bar()
+
+    def apply_bulk_mode(self):
+        self.engine.set_bulk(BULK_THRESHOLD if self.bulk_checkbox.isChecked() else 0, http2=self.use_http2)
+
+    def apply_postprocessing(self):
+        self.postprocessor.steps = build_steps(self.extract_checkbox.isChecked(), **self.post_hooks)
+
     def update_status_bar(self):
-        active_downloads = len(self.get_active_windows())
-        total_files = self.file_list.count()
+        active_downloads = len(self.get_active_jobs())
+        total_files = self.download_model.total_jobs()
         status_message = f"Download path: {self.get_download_path() or 'Not set'} | Active downloads: {active_downloads} | Total files: {total_files}"
+        pending = list(getattr(self, 'pending_jobs', {}).values())
+        if pending:
+            remaining = sum(max(job.size - job.downloaded, 0) for job in pending if job.size)
+            status_message += f" | Remaining: {format_size(remaining) or '0 B'}"
+            processing = sum(1 for job in pending if job.status == "processing")
+            if processing:
+                status_message += f" | Processing: {processing}"
+            speed = sum(job.speed for job in self.get_active_jobs().values()) * 1024 * 1024
+            if remaining and speed:
+                status_message += f" | ETA: {format_eta(remaining / speed)}"
+            latencies = [job.resume_latency for job in pending if job.resume_latency is not None]
+            if latencies:
+                status_message += f" | Resume latency: {max(latencies) * 1000:.0f} ms"
+        tuner = self.engine.tuner if hasattr(self, 'engine') else None
+        if tuner is not None:
+            status_message += f" | Auto: {tuner.jobs} downloads, {tuner.segments} segments"
+        workers = self.engine.workers if hasattr(self, 'engine') else None
+        if workers is not None:
+            status_message += f" | Workers: {len(workers.workers)}"
+        cache = getattr(self, 'download_cache', None)
+        if cache is not None and cache.enabled:
+            status_message += f" | Cache: {cache.hits} hits, {cache.misses} misses"
         self.statusBar().showMessage(status_message)
+    def refresh_eta(self):
+        if self.pending_jobs:
+            self.update_status_bar()
+
     def select_files(self):
-        files, _ = QFileDialog.getOpenFileNames(self, "Select Files", "", "Text Files (*.txt)")
+        files, _ = QFileDialog.getOpenFileNames(self, "Select Files", "", "Link Files (*.txt *.gz)")
         if files:
-            self.file_list.clear()
-            self.links_dict.clear()
-            for file in files:
-                self.load_links(file)
+            self.stop_feeding()
+            self.download_model.clear()
+            self.load_links(files)
         self.update_status_bar()
 
 
-    def load_links(self, file):
-        try:
-            with open(file, 'r') as f:
-                links = [link.strip() for link in f if link.strip()]
-                for link in links:
-                    self.add_link_to_list(link)
-        except IOError as e:
-            QMessageBox.critical(self, "File Error", f"Error reading file {file}: {e}")
+    def load_links(self, files):
+        # Streamed into the job store on a background thread; rows appear batch by batch
+        self.select_files_button.setEnabled(False)
+        self.ingester = LinkIngester(self.job_store, files, self.download_path, self.custom_headers,
+                                     on_batch=self.ingest_bridge.links_added.emit,
+                                     on_finished=self.ingest_bridge.finished.emit)
+        self.ingester.start()
+
+    def on_links_added(self, count):
+        self.download_model.append_saved(count)
+        self.update_status_bar()
+
+    def on_ingest_finished(self, ingester):
+        self.ingester = None
+        self.select_files_button.setEnabled(True)
+        for file, error in ingester.errors:
+            QMessageBox.critical(self, "File Error", f"Error reading file {file}: {error}")
+        self.update_status_bar()
+        self.statusBar().showMessage(f"Added {ingester.added} links, skipped {ingester.duplicates} duplicates "
+                                     f"and {ingester.invalid} invalid lines", 5000)
 
     def select_save_location(self):
         self.download_path = QFileDialog.getExistingDirectory(self, "Select Download Directory")
@@ -381,135 +720,275 @@ class DownloaderApp(QMainWindow):
             self.statusBar().showMessage("Custom headers set", 3000)
 
     def add_link(self):
-        link, ok = QInputDialog.getText(self, "Add Link", "Enter download link:")
+        link, ok = QInputDialog.getText(self, "Add Link", "Enter download link (mirrors of the same file after it, separated by spaces):")
         if ok and link:
             self.add_link_to_list(link)
 
-    def add_link_to_list(self, link):
-        file_name = os.path.basename(urlparse(link).path)
-        file_path = os.path.join(self.download_path, file_name)
-
-        item = QListWidgetItem(file_name)
-        item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
-
-        if os.path.exists(file_path):
-            item.setIcon(QIcon.fromTheme("emblem-default"))
-            item.setCheckState(Qt.CheckState.Unchecked)
-            item.setToolTip(f"{file_name} already downloaded")
-            self.update_progress_overview(file_name, 100)
+    def create_job(self, link, progress=0, files=None):
+        job = Job(next(self.job_ids), link, self.download_path, self.custom_headers, progress)
+        if files.exists(job.file_path) if files is not None else os.path.exists(job.file_path):
+            job.status = "completed"
+            job.progress = 100
+        return job
 
+    def add_link_to_list(self, link):
+        url, mirrors = parse_link(link)
+        if url is None:
+            QMessageBox.warning(self, "Invalid Link", f"'{link}' is not a valid download link.")
+        elif not self.job_store.add_links([url], self.download_path, self.custom_headers,
+                                          mirrors={url: mirrors} if mirrors else None):
+            QMessageBox.information(self, "Duplicate Link", f"'{url}' is already in the list.")
         else:
-            item.setCheckState(Qt.CheckState.Checked)
-
-        self.file_list.addItem(item)
-        self.links_dict[file_name] = {"url": link, "progress": 0}
+            self.download_model.append_saved(1)
+            self.update_status_bar()
 
     def start_download(self):
-        if not hasattr(self, 'download_queue'):
-            self.download_queue = []  # Initialize download queue if not present
-
         if not self.download_path:
             QMessageBox.warning(self, "No Save Location", "Please select a save location first.")
             return
 
-        selected_items = [self.file_list.item(i) for i in range(self.file_list.count())
-                          if self.file_list.item(i).checkState() == Qt.CheckState.Checked]
+        selected_jobs = self.download_model.checked_jobs()
+        # Jobs not loaded into the table yet are read and started by a JobFeeder instead
+        feed = self.feeder is None and self.download_model.unfetched() > 0
 
-        if not selected_items:
+        if not selected_jobs and not feed:
             QMessageBox.warning(self, "No Selection", "Please select at least one file.")
             return
 
         max_concurrent = self.concurrent_downloads_spinner.value()
-        active_count = len(self.active_windows)
-        if len(selected_items) > max_concurrent:
+        if feed or len(selected_jobs) > max_concurrent:
             QMessageBox.information(self, "Max Concurrent Downloads",
                                     f"Maximum concurrent downloads ({max_concurrent}) reached. Remaining files will be queued.")
 
-        for item in selected_items:
-            file_name = item.text()
-            url = self.links_dict[file_name]["url"]
-            progress = self.links_dict[file_name]["progress"]
-            file_path = os.path.join(self.download_path, file_name)
-
-            if os.path.exists(file_path):
-                item.setIcon(QIcon.fromTheme("emblem-default"))
-                reply = QMessageBox.question(self, 'File Exists',
-                                             f"The file '{file_name}' already exists. Do you want to download it again?",
-                                             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-                                             QMessageBox.StandardButton.No)
-                if reply == QMessageBox.StandardButton.No:
-                    continue
+        pending_urls = {job.url for job in self.pending_jobs.values()}
+        pending_urls.update(job.url for job in self.checking_jobs.values())
+        batch = []
+        for job in selected_jobs:
+            if job.id in self.pending_jobs or job.id in self.checking_jobs:
+                continue
+            job.download_path = self.download_path
+            job.headers = dict(self.custom_headers)
 
-            if any(win.url == url for win in self.active_windows):
+            if job.url in pending_urls:
                 QMessageBox.warning(self, "Duplicate Download",
-                                    f"A download for '{file_name}' is already in progress.")
+                                    f"A download for '{job.file_name}' is already in progress.")
                 continue
+            pending_urls.add(job.url)
+            self.checking_jobs[job.id] = job
+            job.status = "checking"
+            self.download_model.update_job(job)
+            batch.append(job)
+
+        if batch:
+            # One concurrent HEAD request per job; on_preflight_done decides what happens next
+            self.engine.preflight(batch).add_done_callback(
+                lambda future, batch=batch: self.emit_preflight(batch, future))
+        if feed:
+            self.feeder = JobFeeder(self.job_store, self.check_fed_jobs, self.download_path,
+                                    self.download_model.last_loaded_id(), self.download_model.files(),
+                                    on_finished=self.feed_bridge.finished.emit)
+            self.feeder.start()
+        self.update_status_bar()
 
-            if active_count >= max_concurrent:
-                self.download_queue.append((url, file_name, progress))  # Add to queue
-            else:
-                self.start_download_window(url, file_name, progress)
-                active_count += 1
+    def check_fed_jobs(self, jobs, targets):
+        # Called on the feeder thread with jobs only it holds; the GUI takes them over in on_feed_page
+        for job in jobs:
+            job.download_path = self.download_path
+            job.headers = dict(self.custom_headers)
+        self.feed_bridge.page_fed.emit(jobs)
+        future = self.engine.preflight(jobs, targets)
+        future.add_done_callback(lambda future: self.emit_preflight(jobs, future))
+        return future
+
+    def on_feed_page(self, jobs):
+        if self.feeder is None:
+            return  # stopped; the page belongs to a cleared list
+        for job in jobs:
+            if job.id in self.pending_jobs or job.id in self.checking_jobs:
+                continue
+            loaded = self.download_model.loaded_job(job.id)
+            if loaded is not None:
+                # Scrolled into the table meanwhile; its checkbox still decides
+                if not self.download_model.is_checked(loaded):
+                    continue
+                self.download_model.replace_job(job)
+            self.checking_jobs[job.id] = job
+            job.status = "checking"
+            self.download_model.update_job(job)
 
+    def on_feed_finished(self, feeder):
+        if feeder is not self.feeder:
+            return
+        self.feeder = None
+        if feeder.error:
+            QMessageBox.critical(self, "Download Error", f"Error reading saved downloads: {feeder.error}")
+        else:
+            self.statusBar().showMessage(f"Checked {feeder.fed} saved downloads", 5000)
+
+    def live_job(self, job):
+        """The object of ``job`` that is being checked or downloaded, if it is."""
+        return self.pending_jobs.get(job.id) or self.checking_jobs.get(job.id) or job
+
+    def emit_preflight(self, batch, future):
+        # Called on the engine thread; if the probes failed as a whole every job is downloaded
+        if not future.cancelled():
+            results = future.result() if future.exception() is None else [ProbeResult(job) for job in batch]
+            self.check_bridge.preflight_done.emit(results)
+
+    def on_preflight_done(self, results):
+        downloads = []
+        for result in results:
+            job = result.job
+            if self.checking_jobs.get(job.id) is not job:
+                continue  # removed from the list in the meantime
+            if result.exists and (job.expected_hash or (result.unchanged and job.file_hash)):
+                # Hashed in the verifier's process pool; on_file_verified decides what happens next
+                job.status = "verifying"
+                self.verifier.verify(job).add_done_callback(lambda future, job=job: self.emit_verdict(job, future))
+            elif result.unchanged:
+                del self.checking_jobs[job.id]
+                self.skip_job(job)
+            else:
+                del self.checking_jobs[job.id]
+                job.status = "idle"
+                downloads.append(job)
+            self.download_model.update_job(job)
+        for job in order_jobs(downloads, self.queue_order_combo.currentData()):
+            self.submit_job(job)
+        if self.feeder is None:
+            self.update_status_bar()  # otherwise once a second by refresh_eta, not once per page
+
+    def skip_job(self, job):
+        # Already there and current: nothing to download
+        job.status = "completed"
+        job.progress = 100
+        self.download_model.set_checked(job, False)
+        self.job_store.mark(job)
+
+    def stop_feeding(self):
+        if self.feeder is not None:
+            self.feeder.cancel()
+            self.feeder.wait()
+            self.feeder = None
+
+    def submit_job(self, job):
+        # The engine queues the job until one of its download slots is free
+        self.pending_jobs[job.id] = job
+        self.engine.submit(job)
+
+    def emit_verdict(self, job, future):
+        # Called on a pool thread; an unreadable file is downloaded again
+        if not future.cancelled():
+            verdict = "mismatch" if future.exception() is not None else future.result()
+            self.check_bridge.file_verified.emit(job, verdict)
+
+    def on_file_verified(self, job, verdict):
+        if self.checking_jobs.pop(job.id, None) is None:
+            return
+        job.status = "idle"
+        if verdict == "match":
+            # Same size and checksum as expected
+            job.file_hash = job.expected_hash or job.file_hash
+            self.skip_job(job)
+        else:
+            self.submit_job(job)
+        self.download_model.update_job(job)
         self.update_status_bar()
 
-    def start_download_window(self, url, file_name, progress):
-        """Helper function to start a download."""
-        download_window = DownloadWindow(url, self.download_path, self.custom_headers, progress)
-        download_window.show()
-        self.active_windows.add(download_window)
-
-        download_window.thread.download_complete.connect(lambda: self.on_download_complete(download_window))
-        download_window.thread.progress_update.connect(lambda p, s, fn: self.update_progress_overview(fn, p))
+    def on_engine_events(self, events):
+        """Apply a batch of engine events to the rows of the jobs they belong to."""
+        changed = False
+        for event in events:
+            job = event.job
+            self.download_model.update_job(job)
+            if event.kind == "started":
+                self.active_jobs[job.id] = job
+                changed = True
+            elif event.kind == "queued" and job.id in self.active_jobs:
+                self.active_jobs.pop(job.id)  # parked until its host answers again
+                changed = True
+            elif event.kind == "downloaded":
+                self.active_jobs.pop(job.id, None)  # its slot is free while it is processed
+                changed = True
+            elif event.kind in ("completed", "failed", "stopped"):
+                if event.kind != "stopped":
+                    self.download_model.set_checked(job, False)
+                self.pending_jobs.pop(job.id, None)
+                self.active_jobs.pop(job.id, None)
+                changed = True
+        if changed:
+            self.update_status_bar()
 
-    def on_download_complete(self, download_window):
-        """Handle logic when a download completes, start queued downloads if any."""
-        self.remove_active_window(download_window)
+    def selected_jobs(self):
+        rows = {index.row() for index in self.download_table.selectionModel().selectedRows()}
+        return [self.download_model.job_at(row) for row in sorted(rows)]
 
-        # Check if there are items in the queue
-        if self.download_queue:
-            next_url, next_file_name, next_progress = self.download_queue.pop(0)
-            self.start_download_window(next_url, next_file_name, next_progress)
+    def show_table_menu(self, position):
+        jobs = self.selected_jobs()
+        if not jobs:
+            return
+        menu = QMenu(self)
+        pause_action = menu.addAction(QIcon.fromTheme("media-playback-pause"), "Pause")
+        resume_action = menu.addAction(QIcon.fromTheme("media-playback-start"), "Resume")
+        stop_action = menu.addAction(QIcon.fromTheme("media-playback-stop"), "Stop")
+        priority_menu = menu.addMenu("Priority")
+        priority_actions = {priority_menu.addAction("High"): PRIORITY_HIGH,
+                            priority_menu.addAction("Normal"): PRIORITY_NORMAL,
+                            priority_menu.addAction("Low"): PRIORITY_LOW}
+        action = menu.exec(self.download_table.viewport().mapToGlobal(position))
+        if action in priority_actions:
+            self.set_jobs_priority(jobs, priority_actions[action])
+        elif action == pause_action:
+            self.pause_jobs(jobs)
+        elif action == resume_action:
+            self.resume_jobs(jobs)
+        elif action == stop_action:
+            self.stop_jobs(jobs)
+
+    def set_jobs_priority(self, jobs, priority):
+        for job in jobs:
+            if job.id in self.pending_jobs:
+                self.engine.set_priority(job.id, priority)
+            else:
+                job.priority = priority
+            self.job_store.mark(job)
 
-        self.update_status_bar()
+    def pause_jobs(self, jobs):
+        for job in jobs:
+            if job.id in self.active_jobs and job.status == "downloading":
+                self.engine.pause(job.id)
 
-    def update_progress_overview(self, file_name, progress):
-        for i in range(self.progress_overview.count()):
-            item = self.progress_overview.item(i)
-            if item.text().startswith(file_name):
-                item.setText(f"{file_name}: {progress}%")
-                return
+    def resume_jobs(self, jobs):
+        for job in jobs:
+            if job.id in self.active_jobs and job.status == "paused":
+                self.engine.resume(job.id)
 
-        self.progress_overview.addItem(f"{file_name}: {progress}%")
+    def stop_jobs(self, jobs):
+        for job in jobs:
+            if job.id in self.pending_jobs:
+                self.engine.stop(job.id)
 
     def pause_all_downloads(self):
-        if len(self.active_windows) > 0:
-            for window in list(self.active_windows):
-                window.pause_download()
+        if len(self.active_jobs) > 0:
+            # One engine command for every job, however many are running
+            self.engine.pause_all()
             QMessageBox.information(self, "Downloads Paused", "All active downloads have been paused.")
         else:
-            QMessageBox.warning(self, "No active windows", "Please start at least one download window.")
+            QMessageBox.warning(self, "No active downloads", "Please start at least one download.")
 
     def resume_all_downloads(self):
-        if len(self.active_windows) > 0:
-            for window in list(self.active_windows):
-                window.resume_download()
+        if len(self.active_jobs) > 0:
+            self.engine.resume_all()
             QMessageBox.information(self, "Downloads Resumed", "All paused downloads have been resumed.")
         else:
-            QMessageBox.information(self, "No active windows", "No active windows are being downloaded.")
+            QMessageBox.information(self, "No active downloads", "No files are being downloaded.")
 
     def stop_all_downloads(self):
-        if len(self.active_windows) > 0:
-            windows_to_stop = list(self.active_windows)  # Copy to avoid modifying during iteration
-            for inner_window in windows_to_stop:
-                inner_window.stop_download()  # This might modify self.active_windows
+        if len(self.pending_jobs) > 0:
+            self.engine.stop_all()
             QMessageBox.information(self, "Downloads Stopped", "All paused downloads have been stopped.")
         else:
-            QMessageBox.information(self, "No active windows", "No files are being downloaded.")
-
-    def remove_active_window(self, window):
-        self.active_windows.discard(window)
-        self.update_status_bar()
+            QMessageBox.information(self, "No active downloads", "No files are being downloaded.")
 
     def change_theme(self, theme):
         if theme == "Light":
@@ -517,7 +996,7 @@ class DownloaderApp(QMainWindow):
                 QWidget { background-color: #f0f0f0; color: #000000; }
                 QPushButton { background-color: #e0e0e0; border: 1px solid #b0b0b0; padding: 5px; }
                 QPushButton:hover { background-color: #d0d0d0; }
-                QListWidget { background-color: #ffffff; border: 1px solid #b0b0b0; }
+                QTableView { background-color: #ffffff; border: 1px solid #b0b0b0; }
                 QProgressBar { border: 1px solid #b0b0b0; }
                 QComboBox, QSpinBox { background-color: #ffffff; border: 1px solid #b0b0b0; }
             """)
@@ -526,7 +1005,7 @@ class DownloaderApp(QMainWindow):
                 QWidget { background-color: #2c2c2c; color: #ffffff; }
                 QPushButton { background-color: #3c3c3c; border: 1px solid #5c5c5c; padding: 5px; }
                 QPushButton:hover { background-color: #4c4c4c; }
-                QListWidget { background-color: #3c3c3c; border: 1px solid #5c5c5c; }
+                QTableView { background-color: #3c3c3c; border: 1px solid #5c5c5c; }
                 QProgressBar { border: 1px solid #5c5c5c; }
                 QComboBox, QSpinBox { background-color: #3c3c3c; border: 1px solid #5c5c5c; color: #ffffff; }
             """)
@@ -535,7 +1014,7 @@ class DownloaderApp(QMainWindow):
                 QWidget { background-color: #e6f3ff; color: #000000; }
                 QPushButton { background-color: #b3d9ff; border: 1px solid #80bfff; padding: 5px; }
                 QPushButton:hover { background-color: #99ccff; }
-                QListWidget { background-color: #ffffff; border: 1px solid #80bfff; }
+                QTableView { background-color: #ffffff; border: 1px solid #80bfff; }
                 QProgressBar { border: 1px solid #80bfff; }
                 QComboBox, QSpinBox { background-color: #ffffff; border: 1px solid #80bfff; }
             """)
@@ -543,65 +1022,123 @@ class DownloaderApp(QMainWindow):
 
     def closeEvent(self, event):
         self.save_settings()
-        if self.active_windows:
+        if self.pending_jobs:
             reply = QMessageBox.question(self, 'Exit',
                                          'Downloads are still in progress. Are you sure you want to quit?',
                                          QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
                                          QMessageBox.StandardButton.No)
             if reply == QMessageBox.StandardButton.Yes:
-                for window in self.active_windows:
-                    window.close()
+                self.shutdown()
                 event.accept()
             else:
                 event.ignore()
         else:
+            self.shutdown()
             event.accept()
 
+    def shutdown(self):
+        if self.restorer is not None:
+            self.restorer.cancel()
+            self.restorer.wait()
+        if self.ingester is not None:
+            self.ingester.cancel()
+            self.ingester.wait()
+        self.stop_feeding()
+        self.verifier.shutdown()
+        self.engine.shutdown()  # disconnects the workers, which cancel their transfers and exit
+        stop_workers(self.worker_processes)
+        self.postprocessor.shutdown()
+        self.job_store.close()
+        self.download_cache.close()
+
     def load_settings(self):
         settings = QSettings("AdvancedDownloader", "Settings")
         self.download_path = settings.value("download_path", "")
         self.current_theme = settings.value("theme", "Light")
         self.custom_headers = settings.value("custom_headers", {'referer': 'https://vidtube.pro/'})
-        print(self.custom_headers)
         self.concurrent_downloads_spinner.setValue(int(settings.value("concurrent_downloads", 3)))
-
+        self.per_host_downloads_spinner.setValue(int(settings.value("per_host_downloads", 4)))
+        self.auto_concurrency_checkbox.setChecked(settings.value("auto_concurrency", False, type=bool))
+        self.auto_min_spinner.setValue(int(settings.value("auto_concurrency_min", 1)))
+        self.global_limit_spinner.setValue(int(settings.value("global_rate_limit", 0)))
+        self.host_limit_spinner.setValue(int(settings.value("host_rate_limit", 0)))
+        self.cache_size_spinner.setValue(int(settings.value("cache_size_mb", 0)))
+        # Opt-in: /metrics and /stats.json on localhost, e.g. metrics_port=9464 in the settings file
+        metrics_port = int(settings.value("metrics_port", 0))
+        if metrics_port:
+            self.engine.serve_metrics(metrics_port).add_done_callback(self.report_metrics_error)
+        # Opt-in: downloads run in worker processes, e.g. workers=4 here and/or worker_listen=0.0.0.0:7700
+        # for workers on other machines, which need DOWNLOADER_TOKEN set to worker_token
+        local_workers = int(settings.value("workers", 0))
+        worker_listen = settings.value("worker_listen", "")
+        if local_workers or worker_listen:
+            self.start_workers(local_workers, worker_listen,
+                               settings.value("worker_token", "") or os.environ.get(TOKEN_VARIABLE))
+        self.keep_partial_checkbox.setChecked(settings.value("keep_partial", True, type=bool))
+        self.extract_checkbox.setChecked(settings.value("extract_archives", False, type=bool))
+        self.bulk_checkbox.setChecked(settings.value("bulk_mode", False, type=bool))
+        # Opt-in: bulk mode reaches https hosts over HTTP/2 with http2=true in the settings file (needs httpx[http2])
+        self.use_http2 = settings.value("http2", False, type=bool)
+        # Opt-in: more steps for every finished download, e.g. checksum_file=sha256, move_to=/srv/done
+        # and post_command="chmod 644 {}" in the settings file
+        self.post_hooks = {"checksum": settings.value("checksum_file", ""), "move_to": settings.value("move_to", ""),
+                           "command": settings.value("post_command", "")}
+        self.queue_order_combo.setCurrentIndex(max(self.queue_order_combo.findData(settings.value("queue_order", "listed")), 0))
+
+        # Lists saved by older versions move into the job store once
         saved_links = settings.value("saved_links", {})
-        for file_name, data in saved_links.items():
-            self.add_link_to_list(data["url"])
-            self.links_dict[file_name]["progress"] = data["progress"]
-            self.update_progress_overview(file_name, data["progress"])
-
+        if saved_links:
+            files = DirectoryIndex()
+            jobs = []
+            for file_name, data in saved_links.items():
+                job = self.create_job(data["url"], files=files)
+                if job.status != "completed":
+                    job.progress = data["progress"]
+                jobs.append(job)
+            self.job_store.add(jobs)  # shown by the restorer with the rest
+            settings.remove("saved_links")
+
+        # The theme is applied once, by __init__, not again through the combo box's signal
+        self.theme_combo.blockSignals(True)
         self.theme_combo.setCurrentText(self.current_theme)
+        self.theme_combo.blockSignals(False)
+
+    def start_workers(self, count, listen, token):
+        token = token or (None if listen else secrets.token_hex(16))
+        try:
+            address = self.engine.serve_workers(listen or "127.0.0.1:0", token).result()
+        except OSError as e:
+            # Already logged by the worker pool; downloads run in this process instead
+            self.statusBar().showMessage(f"Worker mode disabled: {e}", 5000)
+            return
+        if count:
+            slots = -(-self.concurrent_downloads_spinner.value() // count)
+            self.worker_processes = spawn_workers(address, count, slots, token)
+
+    def report_metrics_error(self, future):
+        # Already logged by the metrics server; the downloads carry on without it
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Metrics endpoint disabled: {future.exception()}")
 
     def save_settings(self):
         settings = QSettings("AdvancedDownloader", "Settings")
         settings.setValue("download_path", self.download_path)
         settings.setValue("theme", self.current_theme)
         settings.setValue("custom_headers", self.custom_headers)
-        print("custom headers: ", self.custom_headers)
         settings.setValue("concurrent_downloads", self.concurrent_downloads_spinner.value())
-
-        saved_links = {file_name: {"url": data["url"], "progress": data["progress"]}
-                       for file_name, data in self.links_dict.items()}
-        settings.setValue("saved_links", saved_links)
-
-    def update_link_progress(self, file_name, progress):
-        if file_name in self.links_dict:
-            self.links_dict[file_name]["progress"] = progress
-            for i in range(self.file_list.count()):
-                item = self.file_list.item(i)
-                if item.text() == file_name:
-                    item.setData(Qt.ItemDataRole.UserRole, progress)
-                    self.file_list.update()
-                    break
-def show_current_active_windows():
-    if global_downloader_app is not None:
-        return global_downloader_app.get_active_windows()
-    else:
-        return set()  # Return an empty set if the app instance doesn't exis
+        settings.setValue("per_host_downloads", self.per_host_downloads_spinner.value())
+        settings.setValue("auto_concurrency", self.auto_concurrency_checkbox.isChecked())
+        settings.setValue("auto_concurrency_min", self.auto_min_spinner.value())
+        settings.setValue("global_rate_limit", self.global_limit_spinner.value())
+        settings.setValue("host_rate_limit", self.host_limit_spinner.value())
+        settings.setValue("cache_size_mb", self.cache_size_spinner.value())
+        settings.setValue("queue_order", self.queue_order_combo.currentData())
+        settings.setValue("keep_partial", self.keep_partial_checkbox.isChecked())
+        settings.setValue("extract_archives", self.extract_checkbox.isChecked())
+        settings.setValue("bulk_mode", self.bulk_checkbox.isChecked())
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = DownloaderApp()
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
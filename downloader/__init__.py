@@ -0,0 +1,7 @@
+from .cache import DownloadCache
+from .engine import DownloadEngine
+from .events import DownloadEvent, ProgressBus
+from .jobs import Job, read_links
+from .store import JobStore
+
+__all__ = ["DownloadCache", "DownloadEngine", "DownloadEvent", "Job", "JobStore", "ProgressBus", "read_links"]
@@ -0,0 +1,62 @@
+TUNE_SECONDS = 3.0  # length of one measurement window
+DECREASE = 0.5  # factor applied to the slots when a window saw congestion
+GAIN_THRESHOLD = 1.05  # a new job slot must raise goodput by at least 5% to be kept
+HOLD_WINDOWS = 5  # windows to wait after backing off before probing upwards again
+WARMUP_WINDOWS = 1  # windows a new job slot gets to ramp up before it is judged
+
+
+def congestion(metrics):
+    """Throttled range requests plus failed attempts that point at an overloaded host or network."""
+    failures = 0
+    for (_, status), count in metrics.errors.items():
+        if status == "error" or (status.isdigit() and (int(status) >= 500 or int(status) == 429)):
+            failures += count
+    return failures + sum(metrics.throttles_by_host.values())
+
+
+class ConcurrencyTuner:
+    """Additive-increase/multiplicative-decrease control of job and segment slots.
+
+    Every window the engine reports its goodput, whether any request was
+    throttled or failed like an overloaded server would, and whether every
+    job slot was busy with more jobs waiting. Congestion halves both the
+    job slots and the segments new transfers may open. Otherwise a busy
+    engine gets one more job slot, which is kept only if goodput rose by
+    ``GAIN_THRESHOLD`` once the new job had ``WARMUP_WINDOWS`` to ramp up;
+    segments creep back up by one per window. After backing off the job slots stay put for
+    ``HOLD_WINDOWS``, so the controller settles instead of oscillating.
+    """
+
+    def __init__(self, minimum, maximum, max_segments, jobs=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.max_segments = max(1, max_segments)
+        self.jobs = min(max(jobs or self.minimum, self.minimum), self.maximum)
+        self.segments = self.max_segments
+        self._baseline = None  # goodput before the last increase, while it is on trial
+        self._warmup = 0
+        self._hold = 0
+
+    def update(self, goodput, congested, saturated):
+        """Feed one window's measurements; returns the new ``(jobs, segments)``."""
+        if congested:
+            self.jobs = max(self.minimum, int(self.jobs * DECREASE))
+            self.segments = max(1, int(self.segments * DECREASE))
+            self._baseline = None
+            self._hold = HOLD_WINDOWS
+            return self.jobs, self.segments
+        self.segments = min(self.max_segments, self.segments + 1)
+        if self._warmup:
+            self._warmup -= 1
+        elif self._baseline is not None:
+            if goodput < self._baseline * GAIN_THRESHOLD:
+                self.jobs = max(self.minimum, self.jobs - 1)  # the last slot added nothing
+                self._hold = HOLD_WINDOWS
+            self._baseline = None
+        elif self._hold:
+            self._hold -= 1
+        elif saturated and self.jobs < self.maximum:
+            self._baseline = goodput
+            self._warmup = WARMUP_WINDOWS
+            self.jobs += 1
+        return self.jobs, self.segments
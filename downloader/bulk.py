@@ -0,0 +1,94 @@
+import importlib.util
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from .segments import SINGLE_STREAM_SIZE
+
+try:
+    import httpx
+except ImportError:  # optional: pip install "httpx[http2]" for HTTP/2
+    httpx = None
+
+BULK_THRESHOLD = SINGLE_STREAM_SIZE  # files this small get a single stream anyway
+BULK_CONCURRENT = 32  # small files in flight at once, on top of the regular download slots
+
+
+def http2_available():
+    """Whether httpx and its HTTP/2 support (the ``h2`` package) are installed."""
+    return httpx is not None and importlib.util.find_spec("h2") is not None
+
+
+class Http2Session:
+    """The part of ``aiohttp.ClientSession`` a small-file ``Transfer`` uses, on an HTTP/2 capable httpx client.
+
+    Every host that offers HTTP/2 when the TLS connection is set up gets
+    one connection carrying all of its requests as parallel streams; other
+    hosts get pooled HTTP/1.1 keep-alive connections. Failures are raised
+    as the aiohttp errors they correspond to, so retries, metrics and
+    host health treat both sessions alike.
+    """
+
+    def __init__(self, connections_per_host=16):
+        self._client = httpx.AsyncClient(http2=True, follow_redirects=True, timeout=httpx.Timeout(60.0),
+                                         limits=httpx.Limits(max_connections=None,
+                                                             max_keepalive_connections=connections_per_host))
+
+    @property
+    def closed(self):
+        return self._client.is_closed
+
+    def get(self, url, headers=None):
+        return Http2Request(self._client, url, headers or {})
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class Http2Request:
+    """``async with session.get(...)`` for ``Http2Session``, raising for error statuses like aiohttp does."""
+
+    def __init__(self, client, url, headers):
+        self.client = client
+        self.url = url
+        self.headers = headers
+        self._stream = None
+
+    async def __aenter__(self):
+        self._stream = self.client.stream("GET", self.url, headers=self.headers)
+        try:
+            response = await self._stream.__aenter__()
+        except httpx.TimeoutException as e:
+            raise aiohttp.ServerTimeoutError(str(e)) from e
+        except httpx.TransportError as e:
+            raise aiohttp.ClientConnectionError(str(e)) from e
+        if response.status_code >= 400:
+            await self._stream.__aexit__(None, None, None)
+            url = URL(self.url)
+            info = aiohttp.RequestInfo(url, "GET", CIMultiDictProxy(CIMultiDict(self.headers)), url)
+            raise aiohttp.ClientResponseError(info, (), status=response.status_code,
+                                              message=response.reason_phrase, headers=response.headers)
+        return Http2Response(response)
+
+    async def __aexit__(self, *exc_info):
+        await self._stream.__aexit__(*exc_info)
+
+
+class Http2Response:
+    """An httpx response with the ``status``, ``headers`` and ``content.iter_chunked`` of an aiohttp one."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.content = self
+
+    async def iter_chunked(self, size):
+        try:
+            async for chunk in self.response.aiter_bytes(size):
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise aiohttp.ServerTimeoutError(str(e)) from e
+        except (httpx.TransportError, httpx.StreamError) as e:
+            raise aiohttp.ClientPayloadError(str(e)) from e
@@ -0,0 +1,215 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from .ratelimit import parse_rate
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl that makes dst share src's extents (Btrfs, XFS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    checksum TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER,
+    checksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_checksum ON urls (checksum);
+"""
+
+
+def parse_size(text):
+    """Parse a size such as ``500M`` or ``20G`` into bytes."""
+    return parse_rate(text)
+
+
+def reflink(src, dst):
+    """Clone ``src`` to ``dst`` without copying data; raises OSError where unsupported."""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    try:
+        with open(src, "rb") as source, open(dst, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+
+def link_or_copy(src, dst):
+    """Place ``src`` at ``dst`` by reflink, else hardlink, else a plain copy."""
+    for place in (reflink, os.link, shutil.copyfile):
+        try:
+            place(src, dst)
+            return
+        except OSError:
+            if place is shutil.copyfile:
+                raise
+
+
+class DownloadCache:
+    """Finished downloads kept by checksum, so a file fetched before is linked instead of downloaded.
+
+    Files live under ``objects/<algorithm>/<xx>/<hexdigest>`` and are found
+    either by checksum (when a manifest gives one) or by URL, as long as the
+    server still reports the same ETag, or Last-Modified, and length. A hit
+    is placed in the target folder by reflink where the file system supports
+    it, else by hardlink, else by copying. Once the files add up to more than
+    ``max_size`` bytes the least recently used ones are evicted; a
+    ``max_size`` of 0 turns the cache off. ``hits`` and ``misses`` count the
+    URL lookups since the cache was opened.
+    """
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "cache.db"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def size(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        if self.enabled:
+            self.evict()
+
+    def find(self, url, etag=None, last_modified=None, size=None):
+        """Return ``(path, checksum)`` of the cached copy of ``url``, or ``(None, None)``."""
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, size, checksum FROM urls WHERE url = ?",
+                                   (url,)).fetchone()
+        checksum = None
+        if row is not None:
+            cached_etag, cached_modified, cached_size, cached_checksum = row
+            if etag:
+                fresh = etag == cached_etag
+            else:
+                fresh = bool(last_modified) and last_modified == cached_modified
+            if fresh and (size is None or size == cached_size):
+                checksum = cached_checksum
+        path = self.find_checksum(checksum) if checksum else None
+        if path is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return path, checksum
+
+    def knows(self, url):
+        """Whether ``url`` was added before, so asking the server for its validators may find it here.
+
+        An unknown URL counts as a miss, as ``find`` would have counted it.
+        """
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM urls WHERE url = ?", (url,)).fetchone() is not None
+        if not known:
+            self.misses += 1
+        return known
+
+    def find_checksum(self, checksum):
+        """Return the path of the cached file with ``checksum``, or None."""
+        path = self._blob_path(checksum)
+        with self._lock:
+            row = self._db.execute("SELECT size FROM blobs WHERE checksum = ?", (checksum,)).fetchone()
+            if row is None:
+                return None
+            try:
+                if os.path.getsize(path) != row[0]:
+                    raise OSError("size changed")
+            except OSError:
+                # Removed or modified behind our back
+                self._forget(checksum)
+                return None
+            with self._db:
+                self._db.execute("UPDATE blobs SET last_used = ? WHERE checksum = ?", (time.time(), checksum))
+        return path
+
+    def materialize(self, path, target):
+        """Place the cached file ``path`` at ``target``; returns False if that failed."""
+        partial = target + ".cache"
+        try:
+            if os.path.exists(partial):
+                os.remove(partial)
+            link_or_copy(path, partial)
+            os.replace(partial, target)
+            return True
+        except OSError as e:
+            logging.error(f"Error copying {os.path.basename(target)} from the download cache: {e}")
+            return False
+
+    def add(self, file_path, url, checksum, etag=None, last_modified=None):
+        """Keep the finished download ``file_path`` under ``checksum`` and remember ``url``'s validators."""
+        if not self.enabled or not checksum:
+            return
+        path = self._blob_path(checksum)
+        try:
+            size = os.path.getsize(file_path)
+            if size > self.max_size:
+                return  # would only push everything else out and then itself
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                link_or_copy(file_path, path + ".tmp")
+                os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.error(f"Error adding {os.path.basename(file_path)} to the download cache: {e}")
+            return
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO blobs (checksum, size, last_used) VALUES (?, ?, ?)",
+                             (checksum, size, time.time()))
+            if etag or last_modified:
+                self._db.execute("INSERT OR REPLACE INTO urls (url, etag, last_modified, size, checksum) "
+                                 "VALUES (?, ?, ?, ?, ?)", (url, etag, last_modified, size, checksum))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used files until the cache fits in ``max_size``."""
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_size:
+                return
+            for checksum, size in self._db.execute("SELECT checksum, size FROM blobs ORDER BY last_used").fetchall():
+                if total <= self.max_size:
+                    break
+                self._forget(checksum)
+                total -= size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _forget(self, checksum):
+        with self._db:
+            self._db.execute("DELETE FROM blobs WHERE checksum = ?", (checksum,))
+            self._db.execute("DELETE FROM urls WHERE checksum = ?", (checksum,))
+        try:
+            os.remove(self._blob_path(checksum))
+        except OSError:
+            pass
+
+    def _blob_path(self, checksum):
+        algorithm, _, digest = checksum.partition(":")
+        return os.path.join(self.directory, "objects", algorithm, digest[:2], digest)
@@ -0,0 +1,104 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from .jobs import normalize_url
+
+MEGABYTE = 1048576
+ALGORITHMS = {"sha256": hashlib.sha256, "md5": hashlib.md5, "blake2b": hashlib.blake2b}
+DEFAULT_ALGORITHM = "sha256"
+# Sidecars named after the link file (links.txt.sha256) and sum files in its folder
+MANIFEST_SUFFIXES = {".sha256": "sha256", ".md5": "md5", ".b2": "blake2b"}
+MANIFEST_NAMES = {"SHA256SUMS": "sha256", "MD5SUMS": "md5", "B2SUMS": "blake2b"}
+
+
+def algorithm_of(checksum):
+    """The algorithm of a checksum written as ``algorithm:hexdigest``."""
+    return checksum.partition(":")[0] if checksum else DEFAULT_ALGORITHM
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    return ALGORITHMS[algorithm]()
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, size=None):
+    """Return ``(size, checksum)`` of the file at ``path``.
+
+    The checksum is None when the file cannot be read, or when ``size`` is
+    given and the file has a different size, which is found without reading it.
+    """
+    try:
+        actual_size = os.path.getsize(path)
+        if size is not None and actual_size != size:
+            return actual_size, None
+        digest = new_hash(algorithm)
+        with open(path, "rb") as f:
+            while chunk := f.read(MEGABYTE):
+                digest.update(chunk)
+    except OSError:
+        return None, None
+    return actual_size, f"{algorithm}:{digest.hexdigest()}"
+
+
+def check_file(path, checksum, size=None):
+    """Return ``"match"`` if the file has ``size`` bytes and ``checksum``, otherwise ``"mismatch"``."""
+    _, actual = hash_file(path, algorithm_of(checksum), size)
+    return "match" if actual == checksum else "mismatch"
+
+
+def read_manifest(link_file):
+    """Expected checksums for the links in ``link_file``, keyed by file name and by URL.
+
+    Lines use the ``sha256sum`` format (``<hexdigest>  <file name or URL>``)
+    and are read from ``<link file>.sha256``/``.md5``/``.b2`` and from
+    ``SHA256SUMS``/``MD5SUMS``/``B2SUMS`` next to the link file. Missing
+    manifests are simply skipped.
+    """
+    bases = {link_file, link_file[:-3] if link_file.endswith(".gz") else link_file}
+    candidates = [(base + suffix, algorithm) for base in bases for suffix, algorithm in MANIFEST_SUFFIXES.items()]
+    directory = os.path.dirname(link_file)
+    candidates += [(os.path.join(directory, name), algorithm) for name, algorithm in MANIFEST_NAMES.items()]
+
+    checksums = {}
+    for path, algorithm in candidates:
+        if not os.path.isfile(path):
+            continue
+        with open(path, errors="replace") as f:
+            for line in f:
+                digest, _, name = line.strip().partition(" ")
+                name = name.strip().lstrip("*")  # '*' marks binary mode in sha256sum output
+                if digest and name:
+                    checksums.setdefault(normalize_url(name) or name, f"{algorithm}:{digest.lower()}")
+    return checksums
+
+
+class FileVerifier:
+    """Checks files that already exist against their known checksum in a process pool.
+
+    A job's known checksum is the one from a manifest (``expected_hash``)
+    or, failing that, the one recorded when it was last downloaded
+    (``file_hash``). Hashing runs in separate processes, so callers never
+    wait on disk reads; ``verify`` returns a future that resolves to
+    ``"match"``, ``"mismatch"`` or ``"unknown"`` when no checksum is known.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def verify(self, job):
+        checksum = job.expected_hash or job.file_hash
+        if not checksum:
+            future = Future()
+            future.set_result("unknown")
+            return future
+        if self._pool is None:
+            # Spawned rather than forked: the caller may be running threads
+            self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool.submit(check_file, job.file_path, checksum, job.size)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,300 @@
+"""Headless command line front end for the download engine.
+
+Usage: python -m downloader links.txt [more.txt.gz ...] -o DIR [-c 3]
+
+Nothing in here (or in the rest of the ``downloader`` package) imports Qt,
+so it runs on machines without a display and starts in a fraction of a
+second.
+"""
+import argparse
+import itertools
+import logging
+import os
+import secrets
+import sys
+import threading
+
+from .bulk import BULK_CONCURRENT, BULK_THRESHOLD, http2_available
+from .cache import DownloadCache, parse_size
+from .checksums import ALGORITHMS, FileVerifier, read_manifest
+from .cluster import TOKEN_VARIABLE, spawn_workers, stop_workers
+from .engine import DownloadEngine
+from .jobs import DirectoryIndex, Job, numbered_name, parse_link, read_links
+from .postprocess import PostProcessor, build_steps
+from .preflight import ORDERS, order_jobs
+from .ratelimit import parse_rate
+
+
+class ConsoleReporter:
+    """Prints one line per finished job and a single refreshed status line."""
+
+    def __init__(self, total=None, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.completed = 0
+        self.failed = 0
+        self.stopped = 0
+        self.running = {}
+        self.processing = set()
+        self.done = threading.Event()
+        if total is not None:
+            self.set_total(total)
+
+    @property
+    def finished(self):
+        return self.completed + self.failed + self.stopped
+
+    def set_total(self, total):
+        """Set how many jobs to wait for, once it is known."""
+        self.total = total
+        if self.finished >= total:
+            self.done.set()
+
+    def __call__(self, events):
+        # Called on the engine thread with one batch of events at a time
+        for event in events:
+            job = event.job
+            if event.kind in ("started", "resumed", "progress"):
+                self.running[job.id] = job
+            elif event.kind == "queued":
+                self.running.pop(job.id, None)
+            elif event.kind == "downloaded":
+                self.running.pop(job.id, None)
+                self.processing.add(job.id)
+            elif event.kind in ("completed", "failed", "stopped"):
+                self.running.pop(job.id, None)
+                self.processing.discard(job.id)
+                if event.kind == "completed":
+                    self.completed += 1
+                    self._line(f"done    {job.file_name}")
+                elif event.kind == "failed":
+                    self.failed += 1
+                    self._line(f"failed  {job.file_name}: {event.error}")
+                else:
+                    self.stopped += 1
+        self._status()
+        if self.finished >= self.total:
+            self.done.set()
+
+    def _line(self, text):
+        if self.interactive:
+            self.stream.write("\r\x1b[K")
+        self.stream.write(text + "\n")
+
+    def _status(self):
+        if not self.interactive:
+            return
+        speed = sum(job.speed for job in self.running.values())
+        width = len(str(self.total))
+        status = (f"[{self.finished:>{width}}/{self.total}] {len(self.running)} active | "
+                  f"{speed:.2f} MB/s | {self.failed} failed")
+        if self.processing:
+            status += f" | {len(self.processing)} processing"
+        self.stream.write("\r\x1b[K" + status)
+        self.stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m downloader",
+                                     description="Download every link listed in one or more link files.")
+    parser.add_argument("link_files", nargs="+", help="text files (optionally .gz) with one download link per line")
+    parser.add_argument("-o", "--output", default=".", help="directory to save downloads in (default: current)")
+    parser.add_argument("-c", "--concurrent", type=int, default=3, help="maximum concurrent downloads (default: 3)")
+    parser.add_argument("--auto-concurrency", type=int, metavar="MIN",
+                        help="tune the number of concurrent downloads and segments from measured throughput "
+                             "and throttling, between MIN and --concurrent (default: fixed)")
+    parser.add_argument("--per-host", type=int, default=4,
+                        help="maximum concurrent downloads from one host (default: 4)")
+    parser.add_argument("--bulk", type=parse_size, nargs="?", const=BULK_THRESHOLD, default=0, metavar="SIZE",
+                        help="download files up to SIZE (default: 2M) with one request each, many at a time "
+                             "over shared keep-alive connections; for thousands of small files (default: off)")
+    parser.add_argument("--bulk-concurrent", type=int, default=BULK_CONCURRENT, metavar="N",
+                        help=f"small files downloading at once in bulk mode (default: {BULK_CONCURRENT})")
+    parser.add_argument("--http2", action="store_true",
+                        help="in bulk mode, multiplex the requests to each https host over one HTTP/2 "
+                             "connection (needs httpx[http2])")
+    parser.add_argument("--segments", type=int, default=10,
+                        help="maximum segments per download; the actual count adapts to file size and "
+                             "measured throughput (default: 10)")
+    parser.add_argument("--retries", type=int, default=3, help="retries per download (default: 3)")
+    parser.add_argument("--limit-rate", type=parse_rate, default=0, metavar="RATE",
+                        help="total bandwidth limit in bytes/s, e.g. 500K or 2M (default: unlimited)")
+    parser.add_argument("--host-limit-rate", type=parse_rate, default=0, metavar="RATE",
+                        help="bandwidth limit for each host (default: unlimited)")
+    parser.add_argument("--cache-dir", help="keep finished downloads in this cache and reuse them by hardlink or reflink")
+    parser.add_argument("--cache-size", type=parse_size, default="10G", metavar="SIZE",
+                        help="evict least recently used files once the cache is larger than this (default: 10G)")
+    parser.add_argument("--order", choices=ORDERS, default="listed",
+                        help="download in the order listed, or smallest or largest files first, going by "
+                             "a HEAD request for every link (default: listed)")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="run the downloads in N worker processes on this machine, sharing --concurrent "
+                             "between them (default: in this process)")
+    parser.add_argument("--listen", metavar="ADDRESS",
+                        help="lease downloads to workers (python -m downloader.worker) connecting to HOST:PORT "
+                             "or unix:/path; set the same DOWNLOADER_TOKEN on both sides")
+    parser.add_argument("--metrics-port", type=int, default=0, metavar="PORT",
+                        help="serve Prometheus /metrics and /stats.json on this localhost port (default: off)")
+    parser.add_argument("--extract", nargs="?", const=True, default=False, metavar="DIR",
+                        help="unpack .tar(.gz/.bz2/.xz), .zip and .gz downloads into a folder named after the "
+                             "archive, next to it or in DIR; single-stream tar and gzip downloads are unpacked "
+                             "while they download")
+    parser.add_argument("--checksum-file", choices=sorted(ALGORITHMS), metavar="ALGORITHM",
+                        help="write a <file>.<algorithm> checksum file next to every download")
+    parser.add_argument("--move-to", metavar="DIR", help="move every finished download into DIR")
+    parser.add_argument("--exec", dest="command", metavar="COMMAND",
+                        help="run COMMAND for every finished download, with {} replaced by its path "
+                             "(appended if there is no {}); a non-zero exit fails the job")
+    parser.add_argument("--post-workers", type=int, default=2, metavar="N",
+                        help="processes running the steps above, apart from the downloads (default: 2)")
+    parser.add_argument("--referer", default="", help="Referer header to send")
+    parser.add_argument("--user-agent", default="", help="User-Agent header to send")
+    parser.add_argument("--discard-partial", action="store_true",
+                        help="delete the part files of downloads cut short by Ctrl-C instead of keeping them "
+                             "to resume from")
+    parser.add_argument("--part-files", action="store_true",
+                        help="download segments into separate part files and join them at the end, "
+                             "instead of writing them in place into a preallocated file")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="download files that already exist again, even when their checksum matches")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+    headers = {'referer': args.referer, 'user-agent': args.user_agent}
+
+    job_ids = itertools.count(1)
+    jobs = []
+    urls = set()
+    names = {}  # file name -> how many jobs want it
+    unverified = []  # existing files that have an expected checksum
+    existing = []  # existing files without one, skipped if the server says they are unchanged
+    existing_files = DirectoryIndex([args.output])  # one listing of the output directory, not a stat per link
+    for link_file in args.link_files:
+        try:
+            checksums = read_manifest(link_file)
+            for link in read_links(link_file):
+                url, mirrors = parse_link(link)
+                if url is None:
+                    print(f"skipped {link} (not a URL)", file=sys.stderr)
+                    continue
+                if url in urls:
+                    continue
+                urls.add(url)
+                job = Job(next(job_ids), url, args.output, headers)
+                job.mirrors = mirrors
+                job.expected_hash = checksums.get(url) or checksums.get(job.file_name)
+                count = names.get(job.file_name, 0)
+                names[job.file_name] = count + 1
+                if count:
+                    job.file_name = numbered_name(job.file_name, count)
+                if not args.overwrite and existing_files.exists(job.file_path):
+                    (unverified if job.expected_hash else existing).append(job)
+                    continue
+                jobs.append(job)
+        except IOError as e:
+            print(f"Error reading file {link_file}: {e}", file=sys.stderr)
+            return 2
+
+    if unverified:
+        # Only files whose size and checksum match are skipped; the rest are downloaded again
+        verifier = FileVerifier()
+        results = [(job, verifier.verify(job)) for job in unverified]
+        for job, result in results:
+            try:
+                outcome = result.result()
+            except Exception as e:
+                # An unreadable file or a broken pool process: download it again rather than give up
+                logging.error(f"Error verifying {job.file_name}: {e}")
+                outcome = "mismatch"
+            if outcome == "match":
+                print(f"skipped {job.file_name} (checksum matches)", file=sys.stderr)
+            else:
+                jobs.append(job)
+        verifier.shutdown()
+
+    if args.http2 and not http2_available():
+        print('--http2 needs httpx with HTTP/2 support (pip install "httpx[http2]"), using HTTP/1.1',
+              file=sys.stderr)
+    cache = DownloadCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+    extract_to = args.extract if isinstance(args.extract, str) else None
+    steps = build_steps(bool(args.extract), extract_to, args.checksum_file, args.move_to, args.command)
+    postprocessor = PostProcessor(steps, args.post_workers) if steps else None
+    reporter = ConsoleReporter()
+    engine = DownloadEngine(on_events=reporter, max_concurrent=args.concurrent, per_host_limit=args.per_host,
+                            max_segments=args.segments, retries=args.retries,
+                            global_rate=args.limit_rate, host_rate=args.host_limit_rate, cache=cache,
+                            keep_partial=not args.discard_partial, preallocate=not args.part_files,
+                            postprocessor=postprocessor, bulk_threshold=args.bulk,
+                            bulk_concurrent=args.bulk_concurrent, http2=args.http2)
+    engine.start()
+    if args.auto_concurrency:
+        engine.set_auto_concurrency(args.auto_concurrency, args.concurrent)
+    if args.metrics_port:
+        try:
+            engine.serve_metrics(args.metrics_port).result()
+        except OSError as e:
+            print(f"metrics endpoint disabled: {e}", file=sys.stderr)
+    workers = []
+    if args.workers or args.listen:
+        # Local workers get a random secret; remote ones need DOWNLOADER_TOKEN set on both sides
+        token = os.environ.get(TOKEN_VARIABLE) or (None if args.listen else secrets.token_hex(16))
+        try:
+            address = engine.serve_workers(args.listen or "127.0.0.1:0", token).result()
+        except OSError as e:
+            print(f"cannot listen for workers: {e}", file=sys.stderr)
+            engine.shutdown()
+            return 2
+        if args.listen:
+            print(f"waiting for workers on {address}", file=sys.stderr)
+            if token is None:
+                print(f"warning: {TOKEN_VARIABLE} is not set, any worker that can connect is accepted",
+                      file=sys.stderr)
+        if args.workers:
+            workers = spawn_workers(address, args.workers, -(-args.concurrent // args.workers), token)
+
+    try:
+        probed = existing + (jobs if args.order != "listed" else [])
+        if probed:
+            # One concurrent round of HEAD requests instead of one per download as it starts
+            results = engine.preflight(probed).result()
+            unchanged = {result.job.id for result in results if result.unchanged}
+            for job in existing:
+                if job.id in unchanged:
+                    print(f"skipped {job.file_name} (unchanged on the server)", file=sys.stderr)
+                else:
+                    jobs.append(job)
+        jobs = order_jobs(jobs, args.order)
+        reporter.set_total(len(jobs))
+        for job in jobs:
+            engine.submit(job)
+
+        while not reporter.done.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        engine.stop_all()
+        # Transfers close their files (and delete them with --discard-partial) before reporting stopped
+        reporter.done.wait(engine.stop_deadline + 1)
+        print("\ninterrupted", file=sys.stderr)
+        return 130
+    finally:
+        engine.shutdown()  # disconnects the workers, which cancel their transfers and exit
+        stop_workers(workers)
+        if postprocessor is not None:
+            postprocessor.shutdown()
+        if cache is not None:
+            cache.close()
+
+    if reporter.interactive:
+        sys.stderr.write("\n")
+    print(f"{reporter.completed} completed, {reporter.failed} failed", file=sys.stderr)
+    if cache is not None:
+        print(f"cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
+    return 1 if reporter.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from .jobs import Job
+from .segments import Segment
+from .transfer import restore_cached
+
+HEARTBEAT_SECONDS = 2.0  # how often a worker reports in
+LEASE_SECONDS = 10.0  # a worker silent for this long loses its jobs to the others
+TOKEN_VARIABLE = "DOWNLOADER_TOKEN"  # environment variable holding the shared secret
+COUNTERS = ("bytes_by_host", "retries_by_host", "throttles_by_host")
+
+
+class WorkerLost(Exception):
+    """The worker running a job went away; the job goes back to the queue with its segment offsets."""
+
+
+def parse_address(address):
+    """``(host, port)`` for ``host:port`` or ``(path, None)`` for ``unix:/path/to/socket``."""
+    if address.startswith("unix:"):
+        return address[5:], None
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+async def open_connection(address):
+    path, port = parse_address(address)
+    if port is None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(path, port)
+
+
+def send(writer, message):
+    """Write one message as a line of JSON; a closed connection is left for the reader to notice."""
+    if not writer.is_closing():
+        writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+
+async def read_messages(reader):
+    """Yield the messages of a connection until it closes."""
+    while True:
+        try:
+            line = await reader.readline()
+        except (ConnectionError, ValueError) as e:  # ValueError: a line over the stream limit
+            logging.error(f"Error reading from cluster connection: {e}")
+            return
+        if not line:
+            return
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            logging.error(f"Ignoring malformed cluster message: {e}")
+
+
+def job_to_wire(job):
+    """The fields a worker needs to run ``job``, including where to resume each segment."""
+    return {"id": job.id, "url": job.url, "download_path": job.download_path, "file_name": job.file_name,
+            "headers": job.headers, "priority": job.priority, "progress": job.progress, "size": job.size,
+            "downloaded": job.downloaded, "etag": job.etag, "last_modified": job.last_modified,
+            "expected_hash": job.expected_hash, "file_hash": job.file_hash, "mirrors": job.mirrors,
+            "segments": [[s.start, s.end, s.written] for s in job.segments]}
+
+
+def job_from_wire(data):
+    job = Job(data["id"], data["url"], data["download_path"], data["headers"], data["progress"], data["priority"])
+    job.file_name = data["file_name"]
+    job.expected_hash = data["expected_hash"]
+    job.mirrors = data["mirrors"]
+    apply_state(job, data)
+    return job
+
+
+def event_to_wire(event):
+    """A worker's event with the job state the coordinator keeps, taken on the worker's engine thread."""
+    job = event.job
+    return {"kind": event.kind, "id": job.id, "status": job.status, "progress": event.progress,
+            "error": event.error, "size": job.size, "downloaded": job.downloaded, "etag": job.etag,
+            "last_modified": job.last_modified, "file_hash": job.file_hash, "resume_latency": job.resume_latency,
+            "segments": [[s.start, s.end, s.written] for s in list(job.segments)]}
+
+
+def apply_state(job, state):
+    job.size = state["size"]
+    job.downloaded = state["downloaded"]
+    job.progress = state["progress"]
+    job.etag = state["etag"]
+    job.last_modified = state["last_modified"]
+    job.file_hash = state["file_hash"]
+    job.resume_latency = state.get("resume_latency")
+    job.segments = [Segment(index, start, end, f"{job.file_path}.{index}", written)
+                    for index, (start, end, written) in enumerate(state["segments"])]
+
+
+def counters_of(stats):
+    """The cumulative counters of a ``DownloadEngine.stats()`` snapshot that a worker reports."""
+    counters = {name: stats[name] for name in COUNTERS}
+    counters["bytes_written"] = stats["bytes_written"]
+    counters["bytes_read"] = stats["bytes_read"]
+    counters["errors"] = [[error["host"], error["status"], error["count"]] for error in stats["errors"]]
+    return counters
+
+
+def add_counters(metrics, previous, current):
+    """Add what a worker counted since its ``previous`` report to the coordinator's ``metrics``."""
+    for name in COUNTERS:
+        totals = getattr(metrics, name)
+        before = previous.get(name, {})
+        for key, value in current[name].items():
+            totals[key] = totals.get(key, 0) + value - before.get(key, 0)
+    metrics.bytes_written += current["bytes_written"] - previous.get("bytes_written", 0)
+    metrics.bytes_read += current["bytes_read"] - previous.get("bytes_read", 0)
+    before = {(host, status): count for host, status, count in previous.get("errors", [])}
+    for host, status, count in current["errors"]:
+        metrics.errors[(host, status)] = metrics.errors.get((host, status), 0) + count - before.get((host, status), 0)
+
+
+class RemoteWorker:
+    """The coordinator's side of one connected worker process."""
+
+    def __init__(self, name, slots, writer):
+        self.name = name
+        self.slots = max(1, slots)
+        self.writer = writer
+        self.transfers = {}  # job id -> RemoteTransfer leased to this worker
+        self.last_seen = time.monotonic()
+        self.counters = {}  # cumulative counters as last reported
+
+    @property
+    def free(self):
+        return self.slots - len(self.transfers)
+
+    def send(self, message):
+        send(self.writer, message)
+
+
+class RemoteTransfer:
+    """Stands in for a ``Transfer`` whose job is leased to a worker process.
+
+    ``run`` sends the job to the least loaded worker and returns once the
+    worker reports it completed (True) or failed (False). Progress the
+    worker streams back updates the coordinator's copy of the job, so the
+    engine's ``ProgressBus``, job store and metrics see it as they would a
+    local transfer. ``pause``, ``resume`` and cancellation are forwarded.
+    If the worker disconnects or misses its heartbeats, ``run`` raises
+    ``WorkerLost`` and the engine queues the job again; the next worker
+    resumes it from the last segment offsets it reported.
+
+    The download cache stays with the coordinator, since workers may run
+    on other machines: a job whose expected checksum, or whose URL with
+    unchanged validators (asked for with a HEAD request on ``session``), is
+    cached is linked into place without a lease, and the file a worker
+    finished is added to the cache, with the checksum the worker computed.
+    """
+
+    def __init__(self, job, pool, bus, max_segments=10, cache=None, session=None):
+        self.job = job
+        self.pool = pool
+        self.bus = bus
+        self.max_segments = max_segments  # sent with the lease; later changes apply to the next lease
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.session = session
+        self.error = None
+        self.paused = False
+        self.connections = 0
+        self.worker = None
+        self._done = None
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            self.connections = 0
+            if self.worker is not None:  # otherwise the lease says so
+                self.worker.send({"type": "pause", "id": self.job.id})
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            if self.worker is not None:
+                self.worker.send({"type": "resume", "id": self.job.id})
+
+    def discard_partial(self):
+        # The worker deletes the files itself, since it runs with the coordinator's keep_partial setting
+        self.job.segments = []
+        self.job.downloaded = 0
+        self.job.progress = 0
+
+    async def run(self):
+        if self.cache is not None and await self._restore():
+            return True
+        self._done = asyncio.get_running_loop().create_future()
+        self.worker = self.pool.lease(self)
+        try:
+            success = await self._done
+        except asyncio.CancelledError:
+            self.worker.send({"type": "stop", "id": self.job.id})
+            raise
+        finally:
+            if self.worker is not None:
+                self.worker.transfers.pop(self.job.id, None)
+        if success and self.cache is not None:
+            job = self.job
+            await asyncio.get_running_loop().run_in_executor(None, self.cache.add, job.file_path, job.url,
+                                                             job.file_hash, job.etag, job.last_modified)
+        return success
+
+    async def _restore(self):
+        job = self.job
+        loop = asyncio.get_running_loop()
+        if job.expected_hash:
+            path = await loop.run_in_executor(None, self.cache.find_checksum, job.expected_hash)
+            return await restore_cached(self.cache, job, self.bus, path, job.expected_hash)
+        if self.session is None or not await loop.run_in_executor(None, self.cache.knows, job.url):
+            return False
+        headers = {k: v for k, v in (job.headers or {}).items() if v}
+        try:
+            async with self.session.head(job.url, headers=headers, allow_redirects=True,
+                                         raise_for_status=False) as response:
+                if response.status != 200:
+                    return False  # the worker finds out what is wrong
+                etag = response.headers.get("etag", "").strip('"') or None
+                last_modified = response.headers.get("last-modified")
+                size = int(response.headers.get("content-length", 0)) or None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Error looking up {job.file_name} in the download cache: {e}")
+            return False
+        path, checksum = await loop.run_in_executor(None, self.cache.find, job.url, etag, last_modified, size)
+        return await restore_cached(self.cache, job, self.bus, path, checksum)
+
+    def on_event(self, state):
+        if self._done.done():
+            return
+        apply_state(self.job, state)
+        kind = state["kind"]
+        if kind == "completed":
+            self._done.set_result(True)
+        elif kind == "failed":
+            self.error = state["error"]
+            self._done.set_result(False)
+        elif kind == "stopped":
+            self.lose("it was stopped on the worker")
+        elif kind == "queued":
+            if state["status"] == "waiting":  # parked on the worker until its host answers
+                self.job.status = "waiting"
+                self.bus.touch(self.job)
+        elif not self.paused:
+            self.job.status = "downloading"
+            self.bus.touch(self.job)
+
+    def lose(self, reason):
+        if self._done is not None and not self._done.done():
+            self._done.set_exception(WorkerLost(f"Worker {self.worker.name} lost {self.job.file_name}: {reason}"))
+
+
+class WorkerPool:
+    """Accepts worker processes and leases the engine's jobs to them.
+
+    Workers connect over TCP (``host:port``) or a Unix socket
+    (``unix:/path``), introduce themselves with the number of jobs they run
+    at once and must present ``token`` if one is set. Messages are lines of
+    JSON in both directions. Each lease carries the job, its segment offsets
+    and the engine's settings; workers answer with batches of events and a
+    heartbeat every ``HEARTBEAT_SECONDS`` with their counters. A worker that
+    disconnects, or stays silent for ``LEASE_SECONDS``, loses its leases
+    (see ``RemoteTransfer``).
+
+    ``settings()`` gives the engine settings sent with every lease,
+    ``metrics`` receives the workers' counters and ``on_change`` is called
+    whenever a worker joins, so queued jobs can start.
+    """
+
+    def __init__(self, settings, metrics, on_change, token=None, lease_seconds=LEASE_SECONDS):
+        self.settings = settings
+        self.metrics = metrics
+        self.on_change = on_change
+        self.token = token
+        self.lease_seconds = lease_seconds
+        self.workers = {}  # name -> RemoteWorker
+        self.address = None
+        self._server = None
+        self._monitor = None
+
+    @property
+    def slots(self):
+        return sum(worker.slots for worker in self.workers.values())
+
+    async def start(self, address):
+        path, port = parse_address(address)
+        try:
+            if port is None:
+                self._server = await asyncio.start_unix_server(self._serve, path)
+                self.address = address
+            else:
+                self._server = await asyncio.start_server(self._serve, path, port)
+                self.address = f"{path}:{self._server.sockets[0].getsockname()[1]}"
+        except OSError as e:
+            logging.error(f"Error listening for workers on {address}: {e}")
+            raise
+        self._monitor = asyncio.get_running_loop().create_task(self._expire_leases())
+        return self.address
+
+    async def close(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        if self._server is not None:
+            self._server.close()
+        for worker in list(self.workers.values()):
+            self._drop(worker, "the coordinator is shutting down")
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def lease(self, transfer):
+        """Send ``transfer``'s job to the worker with the most free slots; ``WorkerLost`` if none is connected."""
+        if not self.workers:
+            # The last worker left between the engine taking a slot and the transfer starting
+            raise WorkerLost(f"No worker is connected to run {transfer.job.file_name}")
+        worker = max(self.workers.values(), key=lambda worker: worker.free)
+        worker.transfers[transfer.job.id] = transfer
+        settings = dict(self.settings(), max_segments=transfer.max_segments)
+        # Each worker shapes its own traffic, so both bandwidth limits are split between the workers; the
+        # per-host job limit needs no split, since the coordinator's scheduler counts leased jobs as its own
+        for name in ("global_rate", "host_rate"):
+            if settings[name]:
+                settings[name] = max(1, settings[name] // len(self.workers))
+        worker.send({"type": "lease", "job": job_to_wire(transfer.job), "settings": settings,
+                     "paused": transfer.paused})
+        return worker
+
+    def stats(self):
+        return [{"name": worker.name, "slots": worker.slots, "jobs": len(worker.transfers)}
+                for worker in self.workers.values()]
+
+    async def _serve(self, reader, writer):
+        messages = read_messages(reader)
+        worker = None
+        try:
+            hello = await asyncio.wait_for(messages.__anext__(), self.lease_seconds)
+            if hello.get("type") != "hello" or not self._authorized(hello.get("token")):
+                logging.error(f"Rejected worker connection from {writer.get_extra_info('peername')}")
+                return
+            name = str(hello.get("name") or f"worker-{len(self.workers) + 1}")
+            if name in self.workers:
+                self._drop(self.workers[name], "another worker connected under its name")
+            worker = RemoteWorker(name, int(hello.get("slots", 1)), writer)
+            self.workers[name] = worker
+            self.on_change()
+            async for message in messages:
+                worker.last_seen = time.monotonic()
+                kind = message.get("type")
+                if "counters" in message:
+                    add_counters(self.metrics, worker.counters, message["counters"])
+                    worker.counters = message["counters"]
+                if kind == "events":
+                    for state in message["events"]:
+                        transfer = worker.transfers.get(state["id"])
+                        if transfer is not None:
+                            transfer.on_event(state)
+                elif kind == "heartbeat":
+                    for job_id, connections in message["connections"]:
+                        transfer = worker.transfers.get(job_id)
+                        if transfer is not None:
+                            transfer.connections = connections
+        except (asyncio.TimeoutError, StopAsyncIteration, AttributeError, KeyError, TypeError, ValueError) as e:
+            logging.error(f"Error talking to worker {worker.name if worker else 'connection'}: {e!r}")
+        finally:
+            if worker is not None:
+                self._drop(worker, "it disconnected")
+            writer.close()
+
+    def _authorized(self, token):
+        return self.token is None or hmac.compare_digest(str(token or ""), self.token)
+
+    def _drop(self, worker, reason):
+        if self.workers.get(worker.name) is not worker:
+            return
+        del self.workers[worker.name]
+        if worker.transfers:
+            logging.error(f"Worker {worker.name} left with {len(worker.transfers)} jobs: {reason}")
+        for transfer in list(worker.transfers.values()):
+            transfer.lose(reason)
+        worker.writer.close()
+
+    async def _expire_leases(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            deadline = time.monotonic() - self.lease_seconds
+            for worker in list(self.workers.values()):
+                if worker.last_seen < deadline:
+                    self._drop(worker, f"no heartbeat for {self.lease_seconds:.0f} seconds")
+
+
+def spawn_workers(address, count, slots, token=None):
+    """Start ``count`` worker processes on this machine, connected to ``address``; returns their ``Popen``s."""
+    environment = dict(os.environ)
+    # Importable whatever the current directory, as it is for the GUI script next to the package
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, environment.get("PYTHONPATH")]))
+    if token:
+        environment[TOKEN_VARIABLE] = token  # not on the command line, where other users could read it
+    command = [sys.executable, "-m", "downloader.worker", address, "--slots", str(slots)]
+    # In their own session, so Ctrl-C reaches only the coordinator, which then stops them in order
+    return [subprocess.Popen(command + ["--name", f"local-{number}"], env=environment, start_new_session=True)
+            for number in range(1, count + 1)]
+
+
+def stop_workers(processes, timeout=5):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
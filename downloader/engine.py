@@ -0,0 +1,696 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+
+from .autotune import TUNE_SECONDS, ConcurrencyTuner, congestion
+from .bulk import BULK_CONCURRENT, Http2Session, http2_available
+from .cluster import RemoteTransfer, WorkerLost, WorkerPool
+from .events import MEGABYTE, DownloadEvent, ProgressBus
+from .jobs import DirectoryIndex, host_of
+from .metrics import Metrics, MetricsServer
+from .preflight import MAX_PROBES, probe
+from .ratelimit import BandwidthShaper
+from .retry import HostDown, HostHealth, RetryPolicy
+from .scheduler import Scheduler
+from .segments import HostStats, remove_parts
+from .transfer import TooLarge, Transfer
+
+STOP_DEADLINE = 2.0  # seconds stopped transfers get to close connections and files
+
+class DownloadEngine:
+    """Runs every transfer on one asyncio loop in a single background thread.
+
+    Callers only send commands (``submit``, ``pause``, ``resume``, ``stop``)
+    and receive lists of ``DownloadEvent`` objects through ``on_events``;
+    progress arrives in rate-limited batches (see ``ProgressBus``) while
+    state changes are delivered immediately. Each host gets one pooled
+    keep-alive session that all of its jobs share, so thread count and memory
+    stay flat no matter how many jobs are queued. Submitted jobs wait in a
+    ``Scheduler`` until one of ``max_concurrent`` slots is free and their
+    host runs fewer than ``per_host_limit`` jobs; higher priorities go first.
+
+    With a ``JobStore`` every job an event is about is marked for the
+    store's next batched write, so progress survives a crash. With a
+    ``DownloadCache`` jobs are served from, and added to, the cache.
+    """
+
+    def __init__(self, on_events=None, max_concurrent=3, per_host_limit=4, max_segments=10, retries=3,
+                 connections_per_host=16, max_ui_rate=5, global_rate=0, host_rate=0, store=None, cache=None,
+                 keep_partial=True, stop_deadline=STOP_DEADLINE, preallocate=True, postprocessor=None,
+                 bulk_threshold=0, bulk_concurrent=BULK_CONCURRENT, http2=False):
+        self.on_events = on_events
+        self.store = store
+        self.cache = cache
+        self.max_concurrent = max_concurrent
+        self.max_segments = max_segments
+        self.retries = retries
+        self.connections_per_host = connections_per_host
+        self.keep_partial = keep_partial
+        self.stop_deadline = stop_deadline
+        self.preallocate = preallocate
+        self.checksums = False  # hash every download, for a coordinator that caches what its workers fetch
+        self.postprocessor = postprocessor
+        self.bulk_threshold = bulk_threshold
+        self.bulk_concurrent = bulk_concurrent
+        self.http2 = http2
+        self._loop = asyncio.new_event_loop()
+        self._bus = ProgressBus(self._loop, self._deliver, max_ui_rate)
+        self._shaper = BandwidthShaper(self._loop, global_rate, host_rate)
+        self._thread = threading.Thread(target=self._run, name="download-engine", daemon=True)
+        self._sessions = {}
+        self._host_stats = {}
+        self._scheduler = Scheduler(per_host_limit)
+        self._bulk_scheduler = Scheduler(bulk_concurrent)  # small files, capped by bulk_concurrent alone
+        self._active = {}  # jobs holding a slot, running or paused
+        self._bulk = set()  # ids of the active jobs in the small-file lane
+        self._http2_session = None
+        self._tasks = {}
+        self._transfers = {}
+        self._queued_at = {}
+        self._processing = {}  # job id -> (job, task) for downloaded jobs in post-processing
+        self._processing_room = None  # semaphore of the postprocessor's backlog, made on the loop
+        self.metrics = Metrics()
+        self._metrics_server = None
+        self.health = HostHealth(self._park_host, self._unpark_host)
+        self.retry_policy = RetryPolicy()
+        self._probe_timers = {}  # host -> call_later handle that ends its cooldown
+        self.tuner = None
+        self._tuner_task = None
+        self.workers = None  # a WorkerPool once serve_workers is called
+
+    def start(self):
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    # Commands, safe to call from any thread
+
+    def submit(self, job):
+        self._loop.call_soon_threadsafe(self._start_job, job)
+
+    def pause(self, job_id):
+        """Pause a running job; resuming it does not probe the server again.
+
+        The job keeps its slot, and its ``Transfer`` with every segment
+        offset and open part file, until it is resumed or stopped.
+        """
+        self._loop.call_soon_threadsafe(self._pause_jobs, [job_id])
+
+    def resume(self, job_id):
+        self._loop.call_soon_threadsafe(self._resume_jobs, [job_id])
+
+    def pause_all(self):
+        """Pause every running job in one command; the events arrive as one batch, as for ``resume_all``."""
+        self._loop.call_soon_threadsafe(self._pause_jobs, None)
+
+    def resume_all(self):
+        self._loop.call_soon_threadsafe(self._resume_jobs, None)
+
+    def stop(self, job_id):
+        """Cancel the job's task, which closes its connections and part files.
+
+        The ``stopped`` event follows once the transfer has finished, or
+        after ``stop_deadline`` seconds at most. Part files are kept for
+        resuming later unless ``keep_partial`` is False, in which case they
+        are deleted along with the segment table and any unfinished file.
+        """
+        self._loop.call_soon_threadsafe(self._stop_jobs, [job_id])
+
+    def stop_all(self):
+        self._loop.call_soon_threadsafe(self._stop_jobs, None)
+
+    def preflight(self, jobs, files=None):
+        """Probe ``jobs`` concurrently over the pooled sessions before they are submitted.
+
+        Returns a ``concurrent.futures.Future`` resolving to one
+        ``ProbeResult`` per job, in order. ``files``, a ``DirectoryIndex``
+        of their directories, saves listing them again for every batch.
+        """
+        return asyncio.run_coroutine_threadsafe(self._preflight(list(jobs), files), self._loop)
+
+    def set_max_concurrent(self, value):
+        self._loop.call_soon_threadsafe(self._set_max_concurrent, value)
+
+    def set_per_host_limit(self, value):
+        self._loop.call_soon_threadsafe(self._set_per_host_limit, value)
+
+    def set_priority(self, job_id, priority):
+        self._loop.call_soon_threadsafe(self._set_priority, job_id, priority)
+
+    def set_bulk(self, threshold, concurrent=None, http2=None):
+        """Send jobs of at most ``threshold`` bytes (or unknown size) through the small-file lane; 0 turns it off.
+
+        Up to ``concurrent`` of them run next to the regular slots, each
+        with one GET and no probe, over the host's keep-alive session. With
+        ``http2`` (and httpx installed) https hosts are reached over one
+        HTTP/2 connection each instead (see ``Http2Session``). A job that
+        turns out to be larger moves to the regular queue. Only jobs queued
+        from now on are affected.
+        """
+        self._loop.call_soon_threadsafe(self._set_bulk, threshold, concurrent, http2)
+
+    def set_auto_concurrency(self, minimum, maximum=None):
+        """Tune the job slots between ``minimum`` and ``maximum`` automatically; ``minimum=None`` turns it off.
+
+        A ``ConcurrencyTuner`` adjusts ``max_concurrent`` and the segment
+        limit of transfers every ``TUNE_SECONDS`` from the measured goodput
+        and congestion. While it is off, ``max_concurrent`` and ``max_segments`` stay as set.
+        """
+        self._loop.call_soon_threadsafe(self._set_auto_concurrency, minimum, maximum)
+
+    def serve_metrics(self, port, host="127.0.0.1"):
+        """Start serving ``/metrics`` and ``/stats.json``; returns a future resolving to the bound port.
+
+        ``metrics`` counts bytes, retries, errors and latencies as transfers
+        run, and ``stats`` combines them with the live state of every job.
+        """
+        return asyncio.run_coroutine_threadsafe(self._serve_metrics(port, host), self._loop)
+
+    def serve_workers(self, address, token=None):
+        """Lease jobs to worker processes connecting to ``address`` (``host:port`` or ``unix:/path``).
+
+        The engine becomes a coordinator: jobs run on the workers (see
+        ``WorkerPool``) instead of its own loop, and at most as many run as
+        the connected workers have slots. Scheduling, events, the job store
+        and metrics work as before; a job whose worker goes away is queued
+        again and resumed by another. Returns a future resolving to the
+        address actually bound. Workers must present ``token``, if given.
+        """
+        return asyncio.run_coroutine_threadsafe(self._serve_workers(address, token), self._loop)
+
+    def snapshot(self):
+        """``stats()`` taken on the engine loop, for callers on other threads; returns a future."""
+        return asyncio.run_coroutine_threadsafe(self._snapshot(), self._loop)
+
+    def configure(self, max_segments=None, retries=None, preallocate=None, checksums=None):
+        """Change the settings given to transfers; jobs started from now on use them.
+
+        ``preallocate`` picks the output layout of segmented downloads (see ``Transfer``).
+        """
+        settings = {"max_segments": max_segments, "retries": retries, "preallocate": preallocate,
+                    "checksums": checksums}
+        for name, value in settings.items():
+            if value is not None:
+                self._loop.call_soon_threadsafe(setattr, self, name, value)
+
+    def set_keep_partial(self, keep):
+        """Keep part files of stopped jobs for resuming, or delete them when False."""
+        self._loop.call_soon_threadsafe(setattr, self, "keep_partial", bool(keep))
+
+    def set_rate_limits(self, global_rate, host_rate):
+        """Limit total and per-host bandwidth in bytes per second; 0 means unlimited."""
+        self._loop.call_soon_threadsafe(self._shaper.set_limits, global_rate, host_rate)
+
+    def record_startup(self, phase, seconds):
+        """Record how long the front end took to reach a startup ``phase``, e.g. ``first_paint``."""
+        self._loop.call_soon_threadsafe(self.metrics.startup.__setitem__, phase, round(seconds, 6))
+
+    def shutdown(self, timeout=5):
+        if not self._thread.is_alive():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            logging.error(f"Error shutting down download engine: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+    # Everything below runs on the engine loop
+
+    def stats(self):
+        """A JSON-ready snapshot of the metrics and of every active job."""
+        active = [{"id": job.id, "file_name": job.file_name, "host": job.host, "status": job.status,
+                   "size": job.size, "downloaded": job.downloaded,
+                   "bytes_per_second": round(job.speed * MEGABYTE),
+                   "connections": transfer.connections if transfer is not None else 0}
+                  for job, transfer in ((job, self._transfers.get(job.id)) for job in self._active.values())]
+        metrics = self.metrics
+        return {
+            "bytes_per_second": sum(job["bytes_per_second"] for job in active),
+            "bytes_by_host": dict(metrics.bytes_by_host),
+            "bytes_written": metrics.bytes_written,
+            "bytes_read": metrics.bytes_read,
+            "retries_by_host": dict(metrics.retries_by_host),
+            "throttles_by_host": dict(metrics.throttles_by_host),
+            "errors": [{"host": host, "status": status, "count": count}
+                       for (host, status), count in metrics.errors.items()],
+            "jobs": dict(metrics.jobs),
+            "slots_active": len(self._active) - len(self._bulk),
+            "bulk_active": len(self._bulk),
+            "slots_max": self._slot_limit(),
+            "segments_max": self._segment_limit(),
+            "auto_concurrency": self.tuner is not None,
+            "queued": len(self._scheduler) + len(self._bulk_scheduler),
+            "processing": len(self._processing),
+            "hosts_down": self.health.open_hosts(),
+            "workers": self.workers.stats() if self.workers is not None else [],
+            "segment_latency": metrics.segment_latency.as_dict(),
+            "queue_wait": metrics.queue_wait.as_dict(),
+            "startup": dict(metrics.startup),
+            "active": active,
+        }
+
+    async def _serve_metrics(self, port, host):
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+        self._metrics_server = MetricsServer(self, port, host)
+        await self._metrics_server.start()
+        return self._metrics_server.port
+
+    async def _serve_workers(self, address, token):
+        if self.workers is not None:
+            await self.workers.close()
+        self.workers = WorkerPool(self._worker_settings, self.metrics, self._fill_slots, token)
+        return await self.workers.start(address)
+
+    def _worker_settings(self):
+        # With a cache the workers hash every download, so the coordinator can add it under its checksum
+        return {"retries": self.retries, "keep_partial": self.keep_partial, "preallocate": self.preallocate,
+                "global_rate": self._shaper.global_bucket.rate, "host_rate": self._shaper.host_rate,
+                "checksums": self.cache is not None and self.cache.enabled}
+
+    async def _snapshot(self):
+        return self.stats()
+
+    def _deliver(self, events):
+        if self.store is not None:
+            for event in events:
+                self.store.mark(event.job)
+        if self.on_events is not None:
+            try:
+                self.on_events(events)
+            except Exception as e:
+                logging.error(f"Error delivering download events: {e}")
+
+    def _emit(self, kind, job, **data):
+        self._bus.publish(DownloadEvent(kind, job, **data))
+
+    def _session_for(self, host):
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.connections_per_host, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_read=60),
+                raise_for_status=True,
+            )
+            self._sessions[host] = session
+        return session
+
+    def _session_for_url(self, url):
+        return self._session_for(host_of(url))
+
+    def _start_job(self, job):
+        if job.id in self._active or job.id in self._scheduler or job.id in self._bulk_scheduler:
+            return
+        job.status = "queued"
+        self._queue(job)
+        self._emit("queued", job)
+        self._fill_slots()
+
+    def _queue(self, job):
+        self._queued_at[job.id] = time.monotonic()
+        if self._is_small(job):
+            self._bulk_scheduler.push(job)
+        else:
+            self._scheduler.push(job)
+
+    def _is_small(self, job):
+        # Unknown sizes count as small: the GET's headers tell, and a large file moves on from there
+        return bool(self.bulk_threshold and not job.segments and not job.mirrors
+                    and (job.size or 0) <= self.bulk_threshold)
+
+    def _scheduler_of(self, job_id):
+        return self._bulk_scheduler if job_id in self._bulk else self._scheduler
+
+    def _slot_limit(self):
+        if self.workers is None:
+            return self.max_concurrent
+        return min(self.max_concurrent, self.workers.slots)
+
+    def _fill_slots(self):
+        while len(self._active) - len(self._bulk) < self._slot_limit():
+            job = self._scheduler.pop()
+            if job is None:
+                break
+            self._take_slot(job)
+        while len(self._bulk) < self.bulk_concurrent:
+            job = self._bulk_scheduler.pop()
+            if job is None:
+                break
+            self._bulk.add(job.id)
+            self._take_slot(job)
+
+    def _take_slot(self, job):
+        self._active[job.id] = job
+        self.metrics.queue_wait.observe(time.monotonic() - self._queued_at.pop(job.id, time.monotonic()))
+        self._launch(job)
+        self._emit("started", job)
+
+    def _bulk_session_for(self, job):
+        # HTTP/2 is only offered on TLS connections; plain http stays on the host's aiohttp session
+        if not self.http2 or not job.url.lower().startswith("https:") or not http2_available():
+            return self._session_for(job.host)
+        if self._http2_session is None or self._http2_session.closed:
+            self._http2_session = Http2Session(self.connections_per_host)
+        return self._http2_session
+
+    def _launch(self, job):
+        job.status = "downloading"
+        sink = None
+        if job.id in self._bulk:
+            # Small files run on this loop in worker mode too: a lease would cost more than the download
+            transfer = Transfer(job, self._bulk_session_for(job), self._bus, 1, self.retries, None, self._shaper,
+                                self.cache, self.metrics, None, self.preallocate, self.health, self.retry_policy,
+                                self.bulk_threshold)
+        elif self.workers is not None:
+            transfer = RemoteTransfer(job, self.workers, self._bus, self._segment_limit(), self.cache,
+                                      self._session_for(job.host))
+        else:
+            host_stats = self._host_stats.setdefault(job.host, HostStats())
+            transfer = Transfer(job, self._session_for(job.host), self._bus, self._segment_limit(), self.retries,
+                                host_stats, self._shaper, self.cache, self.metrics, self._session_for_url,
+                                self.preallocate, self.health, self.retry_policy, checksum=self.checksums)
+            if self.postprocessor:
+                sink = transfer.sink = self.postprocessor.stream_for(job)
+        self._transfers[job.id] = transfer
+        self._tasks[job.id] = self._loop.create_task(self._drive(job, transfer, sink))
+
+    def _set_max_concurrent(self, value):
+        self.max_concurrent = max(1, int(value))
+        self._fill_slots()
+
+    def _segment_limit(self):
+        return self.tuner.segments if self.tuner is not None else self.max_segments
+
+    def _set_bulk(self, threshold, concurrent, http2):
+        self.bulk_threshold = max(0, int(threshold or 0))
+        if http2 is not None:
+            self.http2 = bool(http2)
+        if concurrent is not None:
+            self.bulk_concurrent = max(1, int(concurrent))
+            self._bulk_scheduler.set_per_host_limit(self.bulk_concurrent)
+        self._fill_slots()
+
+    def _set_auto_concurrency(self, minimum, maximum):
+        if self._tuner_task is not None:
+            self._tuner_task.cancel()
+            self._tuner_task = None
+        if minimum is None:
+            self.tuner = None
+            for transfer in self._transfers.values():
+                transfer.max_segments = self.max_segments
+            return
+        self.tuner = ConcurrencyTuner(minimum, maximum or minimum, self.max_segments, self.max_concurrent)
+        self._set_max_concurrent(self.tuner.jobs)
+        self._tuner_task = self._loop.create_task(self._auto_tune())
+
+    async def _auto_tune(self):
+        received = sum(self.metrics.bytes_by_host.values())
+        congested = congestion(self.metrics)
+        while True:
+            await asyncio.sleep(TUNE_SECONDS)
+            last_received, received = received, sum(self.metrics.bytes_by_host.values())
+            last_congested, congested = congested, congestion(self.metrics)
+            if not self._active:
+                continue  # nothing to measure
+            # A paused job holds its slot but measures nothing, so it does not count as busy
+            running = [transfer for job_id, transfer in self._transfers.items()
+                       if not transfer.paused and job_id not in self._bulk]
+            saturated = len(running) >= self._slot_limit() and len(self._scheduler) > 0
+            jobs, segments = self.tuner.update((received - last_received) / TUNE_SECONDS,
+                                               congested > last_congested, saturated)
+            for transfer in self._transfers.values():
+                transfer.max_segments = segments
+            if jobs != self.max_concurrent:
+                self._set_max_concurrent(jobs)
+
+    def _set_per_host_limit(self, value):
+        self._scheduler.set_per_host_limit(value)
+        self._fill_slots()
+
+    def _set_priority(self, job_id, priority):
+        if job_id in self._scheduler:
+            self._scheduler.reprioritize(job_id, priority)
+        elif job_id in self._bulk_scheduler:
+            self._bulk_scheduler.reprioritize(job_id, priority)
+        else:
+            job = self._active.get(job_id)
+            if job is not None:
+                job.priority = priority
+
+    def _pause_jobs(self, job_ids):
+        """Pause the given jobs, or every running job for None, with one batch of events."""
+        events = []
+        for job_id in list(self._active) if job_ids is None else job_ids:
+            job = self._active.get(job_id)
+            transfer = self._transfers.get(job_id)
+            if job is None or transfer is None or transfer.paused:
+                continue
+            transfer.pause()
+            self._shaper.forget(job)
+            job.status = "paused"
+            job.speed = 0.0
+            job.resume_latency = None
+            events.append(DownloadEvent("paused", job))
+        self._bus.publish_all(events)
+
+    def _resume_jobs(self, job_ids):
+        events = []
+        for job_id in list(self._active) if job_ids is None else job_ids:
+            job = self._active.get(job_id)
+            transfer = self._transfers.get(job_id)
+            if job is None or transfer is None or not transfer.paused:
+                continue
+            transfer.resume()
+            job.status = "downloading"
+            events.append(DownloadEvent("resumed", job))
+        self._bus.publish_all(events)
+
+    def _stop_jobs(self, job_ids):
+        """Stop the given jobs, or every queued, active and processing job for None."""
+        if job_ids is None:
+            job_ids = (self._scheduler.job_ids() + self._bulk_scheduler.job_ids() + list(self._active)
+                       + list(self._processing))
+        stopped = []  # (job, transfer, task); no transfer or task for jobs that were still queued
+        for job_id in job_ids:
+            queue = next((queue for queue in (self._scheduler, self._bulk_scheduler) if job_id in queue), None)
+            if queue is not None:
+                stopped.append((queue.remove(job_id), None, None))
+                self._queued_at.pop(job_id, None)
+                continue
+            if job_id in self._processing:
+                # Downloaded already: only the post-processing is cancelled
+                job, task = self._processing.pop(job_id)
+                task.cancel()
+                stopped.append((job, None, task))
+                continue
+            job = self._active.pop(job_id, None)
+            if job is None:
+                continue
+            task = self._tasks.pop(job_id, None)
+            if task is not None:
+                task.cancel()
+            stopped.append((job, self._transfers.pop(job_id, None), task))
+            self._scheduler_of(job_id).release(job)
+            self._bulk.discard(job_id)
+        for job, _, _ in stopped:
+            job.status = "stopped"
+            job.speed = 0.0
+            self.metrics.add_job("stopped")
+        self._fill_slots()
+        if stopped:
+            self._loop.create_task(self._finish_stop(stopped))
+
+    async def _finish_stop(self, stopped):
+        """Wait, at most ``stop_deadline`` seconds, for cancelled transfers to clean up, then report them."""
+        tasks = [task for _, _, task in stopped if task is not None]
+        unfinished = set()
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=self.stop_deadline)
+            for task in unfinished:
+                logging.error(f"Download task did not stop within {self.stop_deadline} seconds: {task!r}")
+        if not self.keep_partial:
+            # Files of a transfer that is still running are left alone rather than pulled from under it
+            discard = [(job, transfer) for job, transfer, task in stopped if task not in unfinished]
+            await self._loop.run_in_executor(None, self._discard_partial, discard)
+        self._bus.publish_all([DownloadEvent("stopped", job) for job, _, _ in stopped])
+
+    @staticmethod
+    def _discard_partial(stopped):
+        for job, transfer in stopped:
+            if transfer is not None:
+                transfer.discard_partial()
+            elif job.segments:
+                remove_parts(job.file_path, job.segments)
+                job.segments = []
+                job.downloaded = 0
+                job.progress = 0
+
+    async def _preflight(self, jobs, files=None):
+        if files is None:
+            # One directory listing per target directory, off the loop, instead of a stat per job
+            directories = {job.download_path for job in jobs}
+            files = await self._loop.run_in_executor(None, DirectoryIndex, directories)
+        semaphore = asyncio.Semaphore(MAX_PROBES)
+        return await asyncio.gather(*(probe(self._session_for(job.host), job, semaphore, files) for job in jobs))
+
+    async def _drive(self, job, transfer, sink=None):
+        """Run ``transfer`` in the job's slot and report how it ended.
+
+        Retries back off with jitter (``RetryPolicy``) and every host has a
+        circuit breaker (``HostHealth``): when a host keeps failing, the
+        transfer raises ``HostDown`` and the job is parked as ``waiting``
+        without a slot, so other hosts use the slots, until one job has
+        probed the host after a cooldown. With a ``PostProcessor`` a
+        finished download is reported as ``downloaded`` and gives its slot
+        back while ``_process`` runs the steps, once fewer than the
+        postprocessor's ``backlog`` jobs are processing.
+        """
+        parked = None
+        try:
+            success = await transfer.run()
+            if success and self.postprocessor:
+                # Holding the slot until there is room keeps finished archives from piling up in the pool
+                if self._processing_room is None:
+                    self._processing_room = asyncio.Semaphore(self.postprocessor.backlog)
+                await self._processing_room.acquire()
+        except asyncio.CancelledError:
+            if sink is not None:
+                sink.abandon()
+            return
+        except (HostDown, WorkerLost, TooLarge) as e:
+            success, parked = False, e
+        finally:
+            self._shaper.forget(job)
+        if sink is not None and not success:
+            sink.abandon()
+        self._tasks.pop(job.id, None)
+        self._transfers.pop(job.id, None)
+        self._active.pop(job.id, None)
+        self._scheduler_of(job.id).release(job)
+        self._bulk.discard(job.id)
+        job.speed = 0.0
+        if parked is not None:
+            # Back in the queue with its segment offsets; it runs again once the host answers,
+            # for a lost worker as soon as another worker has a free slot, and for a small file
+            # that was not small in a regular slot
+            job.status = "waiting" if isinstance(parked, HostDown) else "queued"
+            if not isinstance(parked, TooLarge):
+                job.error = str(parked)
+            self._queue(job)
+            self._emit("queued", job)
+            self._fill_slots()
+            return
+        if success and self.postprocessor:
+            # The slot is free for the next download while the steps run in the post-processing pool
+            job.progress = 100
+            job.status = "processing"
+            task = self._loop.create_task(self._process(job, self.postprocessor, sink))
+            task.add_done_callback(lambda _: self._processing_room.release())
+            self._processing[job.id] = (job, task)
+            self._emit("downloaded", job, progress=100)
+            self._fill_slots()
+            return
+        self.metrics.add_job("completed" if success else "failed")
+        if success:
+            job.progress = 100
+            job.status = "completed"
+            self._emit("completed", job, progress=100)
+        else:
+            job.status = "failed"
+            job.error = transfer.error or "An error occurred."
+            self._emit("failed", job, error=job.error)
+        self._fill_slots()
+
+    async def _process(self, job, postprocessor, sink):
+        """Run the post-processing steps in their own pool while the job is ``processing``.
+
+        A single-stream tar or gzip download ``sink`` extracted as it
+        arrived is only waited for, then ``completed`` (or ``failed``)
+        follows once the remaining steps are done.
+        """
+        try:
+            streamed = sink is not None and await self._loop.run_in_executor(None, sink.finish)
+            path = await asyncio.wrap_future(postprocessor.submit(job, streamed))
+        except asyncio.CancelledError:
+            if sink is not None:
+                sink.abandon()
+            raise
+        except Exception as e:
+            logging.error(f"Error post-processing {job.file_name}: {e}")
+            self._processing.pop(job.id, None)
+            self.metrics.add_job("failed")
+            job.status = "failed"
+            job.error = f"Post-processing failed: {e}"
+            self._emit("failed", job, error=job.error)
+            return
+        self._processing.pop(job.id, None)
+        job.download_path = os.path.dirname(path)
+        self.metrics.add_job("completed")
+        job.status = "completed"
+        self._emit("completed", job, progress=100)
+
+    def _park_host(self, host, seconds):
+        self._scheduler.limit_host(host, 0)
+        self._bulk_scheduler.limit_host(host, 0)
+        timer = self._probe_timers.pop(host, None)
+        if timer is not None:
+            timer.cancel()
+        self._probe_timers[host] = self._loop.call_later(seconds, self._probe_host, host)
+
+    def _probe_host(self, host):
+        self._probe_timers.pop(host, None)
+        self.health.half_open(host)
+        self._scheduler.limit_host(host, 1)
+        self._bulk_scheduler.limit_host(host, 1)
+        self._fill_slots()
+
+    def _unpark_host(self, host):
+        timer = self._probe_timers.pop(host, None)
+        if timer is not None:
+            timer.cancel()
+        self._scheduler.limit_host(host)
+        self._bulk_scheduler.limit_host(host)
+        self._fill_slots()
+
+    async def _close(self):
+        if self._tuner_task is not None:
+            self._tuner_task.cancel()
+            self._tuner_task = None
+        for timer in self._probe_timers.values():
+            timer.cancel()
+        self._probe_timers.clear()
+        self._scheduler = Scheduler(self._scheduler.per_host_limit)
+        self._bulk_scheduler = Scheduler(self.bulk_concurrent)
+        processing = [job for job, _ in self._processing.values()]
+        tasks = list(self._tasks.values()) + [task for _, task in self._processing.values()]
+        self._tasks.clear()
+        self._processing.clear()
+        self._transfers.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.stop_deadline)
+        if self.store is not None:
+            for job in list(self._active.values()) + processing:
+                self.store.mark(job)
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+            self._metrics_server = None
+        if self.workers is not None:
+            await self.workers.close()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        if self._http2_session is not None:
+            await self._http2_session.close()
+            self._http2_session = None
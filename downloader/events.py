@@ -0,0 +1,93 @@
+import time
+
+MEGABYTE = 1048576
+
+
+class DownloadEvent:
+    """Something that happened to a job; delivered in batches by ``ProgressBus``."""
+
+    def __init__(self, kind, job, **data):
+        self.kind = kind
+        self.job = job
+        self.progress = data.get("progress", job.progress)
+        self.speed = data.get("speed", 0.0)
+        self.error = data.get("error")
+
+    def __repr__(self):
+        return f"DownloadEvent({self.kind!r}, {self.job.file_name!r}, progress={self.progress})"
+
+
+class ProgressBus:
+    """Merges progress from every active job into batched, rate-limited ticks.
+
+    Transfers call ``touch`` for every chunk they write, which only marks the
+    job dirty. At most ``max_rate`` times per second the dirty jobs are turned
+    into one batch of ``progress`` events, so the receiver gets a single
+    delivery per tick however many downloads are running. Every other event
+    kind (completed, failed, paused, ...) is delivered immediately.
+    """
+
+    def __init__(self, loop, deliver, max_rate=5):
+        self.loop = loop
+        self.deliver = deliver
+        self.interval = 1.0 / max_rate
+        self._dirty = {}
+        self._rates = {}  # job id -> (job, bytes at last tick, time of last tick, speed)
+        self._handle = None
+        self._last_flush = 0.0
+
+    def touch(self, job):
+        self._dirty[job.id] = job
+        self._schedule()
+
+    def publish(self, event):
+        """Deliver a state change right away, dropping any pending progress for the job."""
+        self._dirty.pop(event.job.id, None)
+        if event.kind != "progress":
+            self._rates.pop(event.job.id, None)
+        self.deliver([event])
+
+    def publish_all(self, events):
+        """Deliver the state changes of a batch command, such as pausing every job, together."""
+        for event in events:
+            self._dirty.pop(event.job.id, None)
+            self._rates.pop(event.job.id, None)
+        if events:
+            self.deliver(events)
+
+    def _schedule(self):
+        if self._handle is None:
+            delay = max(0.0, self._last_flush + self.interval - time.monotonic())
+            self._handle = self.loop.call_later(delay, self._flush)
+
+    def _flush(self):
+        self._handle = None
+        now = time.monotonic()
+        self._last_flush = now
+        dirty, self._dirty = self._dirty, {}
+
+        batch = [self._progress_event(job, now) for job in dirty.values()]
+        # Jobs that stopped receiving bytes still need one tick reporting zero speed
+        for job, downloaded, last_time, speed in list(self._rates.values()):
+            if job.id not in dirty and speed and now - last_time >= 1.0:
+                self._rates[job.id] = (job, downloaded, now, 0.0)
+                job.speed = 0.0
+                batch.append(DownloadEvent("progress", job, speed=0.0))
+
+        if any(rate[3] for rate in self._rates.values()):
+            self._schedule()
+        if batch:
+            self.deliver(batch)
+
+    def _progress_event(self, job, now):
+        _, last_bytes, last_time, last_speed = self._rates.get(job.id, (job, job.downloaded, now, 0.0))
+        elapsed = now - last_time
+        speed = last_speed
+        if elapsed > 0:
+            current = (job.downloaded - last_bytes) / MEGABYTE / elapsed
+            speed = current if not last_speed else 0.5 * current + 0.5 * last_speed
+        self._rates[job.id] = (job, job.downloaded, now, speed)
+        job.speed = speed
+        if job.size:
+            job.progress = min(100, int(job.downloaded * 100 / job.size))
+        return DownloadEvent("progress", job, speed=speed)
@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from .checksums import read_manifest
+from .jobs import open_link_file, parse_link
+
+BATCH_SIZE = 50000
+
+
+class LinkIngester:
+    """Streams link files into a ``JobStore`` on a background thread.
+
+    Lines are read one at a time (``.gz`` files are decompressed on the
+    fly), normalized with ``normalize_url`` and handed to the store in
+    batches of ``batch_size``, which drops duplicates and resolves file name
+    collisions. Only one batch is held in memory, however long the files are.
+    Further URLs on a line are mirrors of the first (see ``parse_link``).
+    Checksum manifests next to the link files (see ``read_manifest``) give
+    the new jobs their expected checksums.
+
+    ``on_batch(added)`` is called after every committed batch and
+    ``on_finished(ingester)`` once at the end, both on the ingest thread.
+    After ``cancel`` no further file is opened and no further batch is
+    committed; links already committed stay in the store.
+    """
+
+    def __init__(self, store, paths, download_path, headers=None, on_batch=None, on_finished=None,
+                 batch_size=BATCH_SIZE):
+        self.store = store
+        self.paths = list(paths)
+        self.download_path = download_path
+        self.headers = dict(headers or {})
+        self.on_batch = on_batch
+        self.on_finished = on_finished
+        self.batch_size = batch_size
+        self.read = 0
+        self.added = 0
+        self.invalid = 0
+        self.errors = []  # (path, message) for files that could not be read
+        self.checksums = {}
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="link-ingest", daemon=True)
+
+    @property
+    def duplicates(self):
+        return self.read - self.invalid - self.added
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def run(self):
+        batch = []
+        mirrors = {}
+        for path in self.paths:
+            if self._cancelled.is_set():
+                break
+            try:
+                self.checksums.update(read_manifest(path))
+                with open_link_file(path) as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        self.read += 1
+                        url, line_mirrors = parse_link(line)
+                        if url is None:
+                            self.invalid += 1
+                            continue
+                        batch.append(url)
+                        if line_mirrors:
+                            mirrors.setdefault(url, line_mirrors)
+                        if len(batch) >= self.batch_size:
+                            if self._cancelled.is_set():
+                                break
+                            self._commit(batch, mirrors)
+                            batch = []
+                            mirrors = {}
+            except (IOError, EOFError) as e:
+                logging.error(f"Error reading file {path}: {e}")
+                self.errors.append((path, str(e)))
+        if not self._cancelled.is_set():
+            self._commit(batch, mirrors)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def _commit(self, batch, mirrors):
+        if not batch:
+            return
+        added = self.store.add_links(batch, self.download_path, self.headers, self.checksums, mirrors)
+        self.added += added
+        if self.on_batch is not None and added:
+            self.on_batch(added)
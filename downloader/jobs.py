@@ -0,0 +1,166 @@
+import gzip
+import os
+import re
+from urllib.parse import urlsplit
+
+DEFAULT_PORTS = {"http": "80", "https": "443", "ftp": "21"}
+URL_PATTERN = re.compile(r"([A-Za-z][A-Za-z0-9+.-]*)://([^/?#]+)([^#]*)")
+
+
+class Job:
+    """A single download request as seen by the engine."""
+
+    def __init__(self, job_id, url, download_path, headers=None, progress=0, priority=0):
+        self.id = job_id
+        self.url = url
+        self.download_path = download_path
+        self.headers = dict(headers or {})
+        self.progress = progress
+        self.priority = priority
+        self.size = None
+        self.downloaded = 0
+        self.speed = 0.0
+        self.status = "idle"
+        self.error = None
+        self.etag = None
+        self.last_modified = None
+        self.expected_hash = None  # "algorithm:hexdigest" from a checksum manifest
+        self.file_hash = None  # checksum of the finished file, same format
+        self.segments = []  # segments of the last segmented attempt, for resuming
+        self.mirrors = []  # further URLs serving the same file
+        self.resume_latency = None  # seconds from the last resume to its first byte
+        self.host, path = split_url(url)
+        self.file_name = file_name_for(path)
+
+    @property
+    def file_path(self):
+        return os.path.join(self.download_path, self.file_name)
+
+
+class DirectoryIndex:
+    """Sizes and modification times of the files in the directories jobs save to.
+
+    Each directory is read once with ``os.scandir`` when a path in it is
+    first looked up (or up front with ``scan``), so checking thousands of
+    jobs costs one directory listing per target directory instead of one
+    ``stat`` per job. The index is a snapshot: files created afterwards are
+    not in it.
+    """
+
+    def __init__(self, directories=()):
+        self._directories = {}  # directory -> {file name: os.stat_result}
+        for directory in directories:
+            self.scan(directory)
+
+    def scan(self, directory):
+        directory = os.path.normpath(directory or ".")
+        files = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            files[entry.name] = entry.stat()
+                    except OSError:
+                        pass  # removed while listing
+        except OSError:
+            pass  # a directory that does not exist yet has no files
+        self._directories[directory] = files
+        return files
+
+    def stat(self, path):
+        """The ``os.stat_result`` of the file at ``path``, or None if there is none."""
+        directory, name = os.path.split(path)
+        files = self._directories.get(os.path.normpath(directory or "."))
+        if files is None:
+            files = self.scan(directory)
+        return files.get(name)
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+
+def host_of(url):
+    """``scheme://host[:port]`` of ``url``; jobs and mirrors on the same host share a session."""
+    return split_url(url)[0]
+
+
+def split_url(url):
+    """``(host_of(url), path)``, with the regular expression of ``normalize_url`` where it matches."""
+    match = URL_PATTERN.match(url)
+    if match is None:
+        parsed = urlsplit(url)
+        return f"{parsed.scheme}://{parsed.netloc}", parsed.path
+    scheme, netloc, rest = match.groups()
+    return f"{scheme.lower()}://{netloc}", rest.partition("?")[0]
+
+
+def file_name_for(path):
+    """The file name a URL path is saved under."""
+    return path.rpartition("/")[2] or "download"
+
+
+def numbered_name(name, number):
+    """``name`` with `` (number)`` before its extension, e.g. ``file (2).zip``."""
+    stem, extension = os.path.splitext(name)
+    return f"{stem} ({number}){extension}"
+
+
+def normalize_url(link):
+    """Return the canonical form of ``link`` used to spot duplicates, or None if it is not a URL.
+
+    The scheme and host are lower-cased, default ports and fragments are
+    dropped and an empty path becomes ``/``; everything else is kept as is.
+    A regular expression instead of ``urlsplit`` keeps this fast enough for
+    link files with millions of lines.
+    """
+    match = URL_PATTERN.match(link.strip())
+    if match is None:
+        return None
+    scheme, netloc, rest = match.groups()
+    scheme = scheme.lower()
+    userinfo, at, host = netloc.rpartition("@")
+    host = host.lower()
+    if host.endswith(":" + DEFAULT_PORTS.get(scheme, "-")):
+        host = host.rpartition(":")[0]
+    if not rest.startswith("/"):
+        rest = "/" + rest
+    return f"{scheme}://{userinfo}{at}{host}{rest}"
+
+
+def parse_link(line):
+    """Split a link file line into its normalized URL and mirror URLs.
+
+    Several URLs on one line, separated by spaces or tabs, are mirrors of
+    the same file; the first is the one the job is known by. Returns
+    ``(None, [])`` if the first is not a URL; other invalid entries are
+    dropped.
+    """
+    if " " not in line and "\t" not in line:
+        return normalize_url(line), []
+    urls = line.split()
+    url = normalize_url(urls[0])
+    if url is None:
+        return None, []
+    mirrors = []
+    for link in urls[1:]:
+        mirror = normalize_url(link)
+        if mirror is not None and mirror != url and mirror not in mirrors:
+            mirrors.append(mirror)
+    return url, mirrors
+
+
+def open_link_file(path):
+    """Open a link file for reading text, decompressing ``.gz`` files on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, "r", errors="replace")
+
+
+def read_links(path):
+    """Yield the non-empty, stripped lines of a link file."""
+    with open_link_file(path) as f:
+        for line in f:
+            link = line.strip()
+            if link:
+                yield link
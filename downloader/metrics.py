@@ -0,0 +1,171 @@
+import bisect
+import json
+import logging
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "buckets": {("+Inf" if bound == float("inf") else str(bound)): total
+                            for bound, total in self.cumulative()}}
+
+
+class Metrics:
+    """Counters the engine and its transfers update while downloading.
+
+    Everything is updated on the engine loop, so plain ints and dicts are
+    enough: recording a chunk costs one dictionary update.
+    """
+
+    def __init__(self):
+        self.bytes_by_host = {}
+        self.bytes_written = 0  # to disk, including copies made while joining part files
+        self.bytes_read = 0  # back from disk, to hash segments written ahead of the checksum
+        self.retries_by_host = {}
+        self.throttles_by_host = {}  # range requests refused with 429/503
+        self.errors = {}  # (host, status) -> failed attempts; status is "error" without an HTTP status
+        self.jobs = {}  # outcome -> finished jobs
+        self.segment_latency = Histogram(LATENCY_BUCKETS)
+        self.queue_wait = Histogram(WAIT_BUCKETS)
+        self.startup = {}  # phase -> seconds from process start, reported by the front end
+
+    def add_bytes(self, host, length):
+        self.bytes_by_host[host] = self.bytes_by_host.get(host, 0) + length
+
+    def add_error(self, host, status, retrying):
+        key = (host, str(status or "error"))
+        self.errors[key] = self.errors.get(key, 0) + 1
+        if retrying:
+            self.retries_by_host[host] = self.retries_by_host.get(host, 0) + 1
+
+    def add_throttle(self, host):
+        self.throttles_by_host[host] = self.throttles_by_host.get(host, 0) + 1
+
+    def add_job(self, outcome):
+        self.jobs[outcome] = self.jobs.get(outcome, 0) + 1
+
+
+def render_prometheus(stats):
+    """Format a ``DownloadEngine.stats()`` snapshot in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    def histogram(name, help_text, data):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for bound, total in data["buckets"].items():
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f"{name}_sum {data['sum']}")
+        lines.append(f"{name}_count {data['count']}")
+
+    metric("downloader_bytes_total", "counter", "Bytes received, by host.",
+           [({"host": host}, count) for host, count in stats["bytes_by_host"].items()])
+    metric("downloader_disk_written_bytes_total", "counter", "Bytes written to disk, including part file joins.",
+           [({}, stats["bytes_written"])])
+    metric("downloader_disk_read_bytes_total", "counter", "Bytes read back from disk to compute checksums.",
+           [({}, stats["bytes_read"])])
+    metric("downloader_throughput_bytes_per_second", "gauge", "Current download speed of all jobs together.",
+           [({}, stats["bytes_per_second"])])
+    metric("downloader_job_throughput_bytes_per_second", "gauge", "Current download speed of each active job.",
+           [({"job": job["id"], "file": job["file_name"]}, job["bytes_per_second"]) for job in stats["active"]])
+    metric("downloader_retries_total", "counter", "Download attempts retried after an error, by host.",
+           [({"host": host}, count) for host, count in stats["retries_by_host"].items()])
+    metric("downloader_throttled_total", "counter", "Range requests refused with 429 or 503, by host.",
+           [({"host": host}, count) for host, count in stats["throttles_by_host"].items()])
+    metric("downloader_errors_total", "counter", "Failed download attempts, by host and HTTP status.",
+           [({"host": error["host"], "status": error["status"]}, error["count"]) for error in stats["errors"]])
+    metric("downloader_jobs_total", "counter", "Finished jobs, by outcome.",
+           [({"outcome": outcome}, count) for outcome, count in stats["jobs"].items()])
+    metric("downloader_slots_active", "gauge", "Download slots in use, running or paused.",
+           [({}, stats["slots_active"])])
+    metric("downloader_slots_max", "gauge", "Download slots available.", [({}, stats["slots_max"])])
+    metric("downloader_bulk_active", "gauge", "Small files downloading in the bulk lane.", [({}, stats["bulk_active"])])
+    metric("downloader_segments_max", "gauge", "Segments a new transfer may open.", [({}, stats["segments_max"])])
+    metric("downloader_jobs_queued", "gauge", "Jobs waiting for a slot.", [({}, stats["queued"])])
+    metric("downloader_jobs_processing", "gauge", "Downloaded jobs waiting for or running their post-processing.",
+           [({}, stats["processing"])])
+    metric("downloader_host_down", "gauge", "Hosts whose circuit breaker has parked their jobs.",
+           [({"host": host}, 1) for host in stats["hosts_down"]])
+    metric("downloader_worker_jobs", "gauge", "Jobs leased to each connected worker process.",
+           [({"worker": worker["name"]}, worker["jobs"]) for worker in stats["workers"]])
+    metric("downloader_startup_seconds", "gauge", "Seconds from process start to each startup phase.",
+           [({"phase": phase}, seconds) for phase, seconds in stats["startup"].items()])
+    histogram("downloader_segment_latency_seconds", "Time from sending a GET to receiving its response headers.",
+              stats["segment_latency"])
+    histogram("downloader_queue_wait_seconds", "Time jobs waited in the queue for a slot.", stats["queue_wait"])
+    return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsServer:
+    """Serves ``/metrics`` (Prometheus) and ``/stats.json`` for an engine, on the engine's loop.
+
+    Handlers run on the same loop as the transfers, so every response is
+    a consistent snapshot without any locking. Only listens on localhost
+    unless told otherwise.
+    """
+
+    def __init__(self, engine, port, host="127.0.0.1"):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_get("/stats.json", self._stats)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        try:
+            await site.start()
+        except OSError as e:
+            logging.error(f"Error starting metrics server on {self.host}:{self.port}: {e}")
+            await self.stop()
+            raise
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request):
+        return web.Response(text=render_prometheus(self.engine.stats()), content_type="text/plain", charset="utf-8")
+
+    async def _stats(self, request):
+        return web.Response(text=json.dumps(self.engine.stats(), indent=2), content_type="application/json")
@@ -0,0 +1,83 @@
+import logging
+
+from .jobs import host_of
+
+MIRROR_FAILURES = 2  # failed requests after which a mirror gets no more ranges
+SLOW_RATIO = 0.2  # a mirror this much slower per connection than the fastest one is dropped
+SAMPLE_SECONDS = 0.5  # how often a running request reports its throughput
+
+
+class Mirror:
+    """One URL serving the file, with the throughput measured on it so far."""
+
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+        self.host = host_of(url)  # errors, throttles and circuit breaker state are counted per host
+        self.speed = 0.0  # bytes per second per connection, smoothed
+        self.connections = 0
+        self.failures = 0
+        self.dropped = False
+
+    def record(self, length, seconds):
+        if seconds <= 0 or length <= 0:
+            return
+        rate = length / seconds
+        self.speed = 0.7 * self.speed + 0.3 * rate if self.speed else rate
+
+
+class MirrorSet:
+    """The mirrors a segmented download spreads its ranges over.
+
+    Each new range goes to the mirror expected to deliver it fastest: one
+    that has not been measured yet, otherwise the one with the highest
+    per-connection speed divided among the connections it already has.
+    A mirror is dropped after ``MIRROR_FAILURES`` failed requests, or when
+    it is far slower than the fastest one, but the last mirror standing is
+    never dropped.
+    """
+
+    def __init__(self, mirrors):
+        self.mirrors = list(mirrors)
+
+    def __len__(self):
+        return len(self.usable)
+
+    @property
+    def usable(self):
+        return [mirror for mirror in self.mirrors if not mirror.dropped]
+
+    def pick(self):
+        return max(self.usable, key=lambda mirror: (not mirror.speed and not mirror.connections,
+                                                    mirror.speed / (mirror.connections + 1)))
+
+    def fail(self, mirror, error):
+        """Count a failed request; returns True if other mirrors can take over the range."""
+        mirror.failures += 1
+        if len(self) < 2:
+            return False
+        if mirror.failures >= MIRROR_FAILURES:
+            self._drop(mirror, f"failed {mirror.failures} times, last with {error}")
+        return True
+
+    def drop_slow(self):
+        usable = self.usable
+        measured = [mirror for mirror in usable if mirror.speed]
+        if len(usable) < 2 or len(measured) < 2:
+            return
+        fastest = max(mirror.speed for mirror in measured)
+        for mirror in measured:
+            if mirror.speed < fastest * SLOW_RATIO and len(self) > 1:
+                self._drop(mirror, f"{mirror.speed / 1048576:.2f} MB/s against {fastest / 1048576:.2f} MB/s")
+
+    def _drop(self, mirror, reason):
+        mirror.dropped = True
+        logging.error(f"Dropping mirror {mirror.url}: {reason}")
+
+
+def matches(headers, size, etag):
+    """Whether a mirror's response headers describe the same file: equal length and, if both have one, ETag."""
+    mirror_size = int(headers.get("content-length", 0)) or None
+    mirror_etag = headers.get("etag", "").strip('"') or None
+    ranges = headers.get("accept-ranges", "none").lower() == "bytes"
+    return ranges and mirror_size == size and (not etag or not mirror_etag or mirror_etag == etag)
@@ -0,0 +1,362 @@
+import gzip
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .checksums import algorithm_of, new_hash
+
+MEGABYTE = 1048576
+STREAM_BUFFER = 64  # chunks (4 MB) a streamed extraction may fall behind before it gives up
+BACKLOG_PER_WORKER = 2  # downloaded jobs per pool process that may wait for post-processing
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# Python 3.12 (and security releases back to 3.8) can refuse members that would leave the destination
+EXTRACT_FILTER = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+def archive_kind(path):
+    """``"tar"``, ``"zip"`` or ``"gzip"`` (a single compressed file) from the file name, or None."""
+    name = path.lower()
+    if name.endswith(TAR_SUFFIXES):
+        return "tar"
+    if name.endswith(".zip"):
+        return "zip"
+    if name.endswith(".gz"):
+        return "gzip"
+    return None
+
+
+def archive_stem(path):
+    """The file name without its archive suffix, e.g. ``data`` for ``data.tar.gz``."""
+    name = os.path.basename(path)
+    for suffix in TAR_SUFFIXES + (".zip", ".gz"):
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)] or name
+    return name
+
+
+def safe_member(member):
+    """Whether a tar member stays inside the destination, for Pythons without extraction filters."""
+    if EXTRACT_FILTER:
+        return True
+    parts = member.name.replace("\\", "/").split("/")
+    return not (member.name.startswith(("/", "\\")) or ".." in parts or member.islnk() or member.issym()
+                or member.isdev())
+
+
+def extract_tar(tar, destination, created=None):
+    """Extract every safe member; their paths are appended to ``created``, if given, before each is written."""
+    for member in tar:
+        if safe_member(member):
+            if created is not None:
+                created.append(os.path.join(destination, member.name))
+            tar.extract(member, destination, **EXTRACT_FILTER)
+        else:
+            logging.error(f"Skipping unsafe archive member {member.name}")
+
+
+class Extract:
+    """Unpack tar archives (plain, gzip, bzip2 or xz), zip archives and single gzip files.
+
+    Archives go into a directory named after them (``data.tar.gz`` into
+    ``data/``), a gzip file becomes the file without ``.gz``, next to the
+    download or in ``directory``. Other files are left alone.
+    """
+    name = "extract"
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def destination(self, path):
+        return os.path.join(self.directory or os.path.dirname(path), archive_stem(path))
+
+    def __call__(self, path, file_hash=None):
+        kind = archive_kind(path)
+        destination = self.destination(path)
+        if kind == "tar":
+            with tarfile.open(path) as tar:
+                extract_tar(tar, destination)
+        elif kind == "zip":
+            with zipfile.ZipFile(path) as archive:
+                archive.extractall(destination)  # drops absolute paths and ".." from member names
+        elif kind == "gzip":
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with gzip.open(path, "rb") as src, open(destination, "wb") as dest:
+                shutil.copyfileobj(src, dest, MEGABYTE)
+        return path
+
+
+class WriteChecksum:
+    """Write ``<file>.<algorithm>`` in the format of ``sha256sum`` and friends."""
+    name = "checksum"
+
+    def __init__(self, algorithm="sha256"):
+        self.algorithm = algorithm
+
+    def __call__(self, path, file_hash=None):
+        if file_hash and algorithm_of(file_hash) == self.algorithm:
+            digest = file_hash.partition(":")[2]  # computed while downloading
+        else:
+            hasher = new_hash(self.algorithm)
+            with open(path, "rb") as f:
+                while chunk := f.read(MEGABYTE):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+        with open(f"{path}.{self.algorithm}", "w") as f:
+            f.write(f"{digest}  {os.path.basename(path)}\n")
+        return path
+
+
+class MoveTo:
+    """Move the downloaded file into ``directory``; later steps and the job see the new path."""
+    name = "move"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, path, file_hash=None):
+        os.makedirs(self.directory, exist_ok=True)
+        target = os.path.join(self.directory, os.path.basename(path))
+        shutil.move(path, target)
+        return target
+
+
+class RunCommand:
+    """Run a command for the file; ``{}`` in it is replaced by the path, which is appended otherwise."""
+    name = "command"
+
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self, path, file_hash=None):
+        args = shlex.split(self.command)
+        args = [arg.replace("{}", path) for arg in args] if "{}" in self.command else args + [path]
+        result = subprocess.run(args, capture_output=True, text=True, errors="replace")
+        if result.returncode != 0:
+            output = result.stderr.strip().splitlines()
+            detail = f": {output[-1]}" if output else ""
+            raise RuntimeError(f"{args[0]} exited with status {result.returncode}{detail}")
+        return path
+
+
+def run_steps(steps, path, file_hash=None, skip=()):
+    """Run ``steps`` on the file at ``path`` in order; returns where the file ends up. Runs in a pool process."""
+    for step in steps:
+        if step.name not in skip:
+            path = step(path, file_hash)
+    return path
+
+
+class QueueReader(io.RawIOBase):
+    """A file object reading the chunks a ``StreamExtractor`` was fed, as they arrive."""
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self._chunk = b""
+        self._ended = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            chunk = None if self._ended else self.extractor.next_chunk()
+            if chunk is None:
+                self._ended = True  # readers look past the end again, e.g. for another gzip member
+                return 0
+            self._chunk = chunk
+        length = min(len(buffer), len(self._chunk))
+        buffer[:length] = self._chunk[:length]
+        self._chunk = self._chunk[length:]
+        return length
+
+
+class StreamAbandoned(Exception):
+    """The download went on without the streamed extraction."""
+
+
+class StreamExtractor:
+    """Extracts a tar or gzip download on a thread while its bytes arrive.
+
+    ``feed`` is called with every chunk of a single-stream download and
+    never blocks it: if the extraction falls ``STREAM_BUFFER`` chunks
+    behind, or the stream does not continue where the last chunk ended
+    (it was restarted), the extraction is abandoned and the archive is
+    extracted from the finished file instead. ``finish`` waits for the end
+    of the archive and says whether it was extracted completely.
+
+    An abandoned extraction removes what it wrote, whether the download
+    goes on without it or failed, so neither a fallback extraction nor
+    the user finds half an archive. Files that were in the destination
+    before are left alone.
+    """
+
+    def __init__(self, path, destination, buffer_chunks=STREAM_BUFFER):
+        self.path = path
+        self.destination = destination
+        self.abandoned = False
+        self.error = None
+        self._queue = queue.Queue(buffer_chunks)
+        self._offset = 0
+        self._thread = None
+        self._existed = True
+        self._created = []  # paths the extraction wrote, for removing them if it is abandoned
+
+    def feed(self, offset, chunk):
+        if self.abandoned:
+            return
+        if offset != self._offset:
+            self.abandon("the download restarted")
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stream-extract", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(chunk)
+        except queue.Full:
+            self.abandon("extraction fell behind the download")
+            return
+        self._offset += len(chunk)
+
+    def abandon(self, reason=None):
+        if not self.abandoned:
+            self.abandoned = True
+            if reason:
+                logging.error(f"Extracting {os.path.basename(self.path)} after the download: {reason}")
+            if self._thread is not None and not self._thread.is_alive():
+                self._discard_output()  # finished already; otherwise the thread does it on its way out
+
+    def finish(self):
+        """Wait for the extraction to end; True if the whole archive came out of the stream."""
+        if self._thread is None:
+            return False
+        if not self.abandoned:
+            self._queue.put(None)  # end of the stream
+        self._thread.join()
+        return not self.abandoned and self.error is None
+
+    def next_chunk(self):
+        while True:
+            if self.abandoned:
+                raise StreamAbandoned()
+            try:
+                return self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def _run(self):
+        reader = io.BufferedReader(QueueReader(self), MEGABYTE)
+        self._existed = os.path.exists(self.destination)
+        try:
+            if archive_kind(self.path) == "tar":
+                with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                    extract_tar(tar, self.destination, self._created)
+            else:
+                os.makedirs(os.path.dirname(self.destination), exist_ok=True)
+                self._created.append(self.destination)
+                with gzip.GzipFile(fileobj=reader) as src, open(self.destination, "wb") as dest:
+                    shutil.copyfileobj(src, dest, MEGABYTE)
+        except StreamAbandoned:
+            pass
+        except Exception as e:
+            # Most likely a damaged archive; extracting the finished file reports it properly
+            self.error = e
+            self.abandon(f"{e}")
+        if self.abandoned:
+            self._discard_output()
+
+    def _discard_output(self):
+        created, self._created = self._created, []
+        if not self._existed and os.path.isdir(self.destination):
+            shutil.rmtree(self.destination, ignore_errors=True)
+            return
+        for path in reversed(created):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path)  # only if it is empty, i.e. the archive put nothing else there
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+            # Directories tar made for the member on the way, as long as nothing else is in them
+            parent = os.path.dirname(path)
+            while parent.startswith(self.destination + os.sep):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+
+class PostProcessor:
+    """Runs a list of steps (``Extract``, ``WriteChecksum``, ``MoveTo``, ``RunCommand``) on finished downloads.
+
+    The steps run in a pool of ``workers`` processes after the job has
+    given back its download slot, so extracting or hashing never holds up
+    the next download; jobs waiting for the pool are ``processing``. At
+    most ``backlog`` jobs are in post-processing at once: a download that
+    finishes beyond that keeps its slot until there is room, so a batch
+    of archives slows the downloads down instead of piling up. When
+    ``Extract`` is the first step, tar and gzip files that arrive as one
+    sequential stream are extracted while they download (see
+    ``StreamExtractor``) and only the remaining steps run afterwards. Zip
+    files need their central directory at the end, so they are always
+    extracted once complete.
+
+    ``steps`` may be replaced at any time; jobs already handed to the pool
+    keep the steps they were given.
+    """
+
+    def __init__(self, steps, workers=2, stream=True):
+        self.steps = list(steps)
+        self.workers = workers
+        self.stream = stream
+        self.backlog = workers * BACKLOG_PER_WORKER  # jobs in post-processing before downloads wait for it
+        self._pool = None
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def stream_for(self, job):
+        """A ``StreamExtractor`` for ``job``, or None if its file cannot be extracted as it downloads."""
+        steps = self.steps
+        if not self.stream or not steps or not isinstance(steps[0], Extract):
+            return None
+        if archive_kind(job.file_name) not in ("tar", "gzip"):
+            return None
+        return StreamExtractor(job.file_path, steps[0].destination(job.file_path))
+
+    def submit(self, job, streamed=False):
+        """Run the steps for ``job`` in the pool; returns a future resolving to the file's final path."""
+        if self._pool is None:
+            # Spawned rather than forked: the engine and the GUI are running threads
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        skip = ("extract",) if streamed else ()
+        return self._pool.submit(run_steps, self.steps, job.file_path, job.file_hash, skip)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def build_steps(extract=False, extract_to=None, checksum=None, move_to=None, command=None):
+    """The steps for the command line and settings options, in the order they run."""
+    steps = []
+    if extract or extract_to:
+        steps.append(Extract(extract_to))
+    if checksum:
+        steps.append(WriteChecksum(checksum))
+    if move_to:
+        steps.append(MoveTo(move_to))
+    if command:
+        steps.append(RunCommand(command))
+    return steps
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from email.utils import parsedate_to_datetime
+
+MAX_PROBES = 32  # HEAD requests in flight at once across all hosts
+ORDERS = ("listed", "smallest", "largest")
+
+
+class ProbeResult:
+    """What a preflight HEAD request found out about one job."""
+
+    def __init__(self, job):
+        self.job = job
+        self.status = None
+        self.error = None
+        self.size = None
+        self.accept_ranges = False
+        self.etag = None
+        self.last_modified = None
+        self.local_size = None  # size of the file already at the target, if any
+        self.unchanged = False  # the server says that file is still current
+
+    @property
+    def exists(self):
+        return self.local_size is not None
+
+
+async def probe(session, job, semaphore, files=None):
+    """Send one HEAD request for ``job`` and return a ``ProbeResult``.
+
+    When the target file already exists and has the size recorded by the
+    last finished download, the request is conditional: ``If-None-Match``
+    with that download's ETag and ``If-Modified-Since`` with its
+    Last-Modified, and a 304 marks the file as unchanged. Otherwise, and for
+    servers that ignore conditional requests, the file is unchanged only if
+    its length equals the Content-Length and either the ETag is unchanged
+    or, without a recorded ETag, Last-Modified is no later than the file's
+    modification time; a partial file is never taken for a finished one.
+    Only ``job.size`` is updated, for ordering and ETAs; the validators stay
+    those of the last download, which resuming relies on.
+    The target file is looked up in ``files``, a ``DirectoryIndex``, if given.
+    """
+    headers = {k: v for k, v in (job.headers or {}).items() if v}
+    result = ProbeResult(job)
+    mtime = None
+    conditional = False
+    try:
+        stat = files.stat(job.file_path) if files is not None else os.stat(job.file_path)
+        if stat is None:
+            raise FileNotFoundError(job.file_path)
+        result.local_size = stat.st_size
+        mtime = stat.st_mtime
+        # Validators only vouch for the file they were saved with, not for a partial or replaced one
+        conditional = bool(job.etag or job.last_modified) and job.size == stat.st_size
+        if conditional and job.etag:
+            headers["if-none-match"] = f'"{job.etag}"'
+        if conditional and job.last_modified:
+            headers["if-modified-since"] = job.last_modified
+    except OSError:
+        pass
+
+    try:
+        async with semaphore:
+            async with session.head(job.url, headers=headers, allow_redirects=True,
+                                    raise_for_status=False) as response:
+                result.status = response.status
+                response_headers = response.headers
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result.error = str(e) or e.__class__.__name__
+        logging.error(f"Error probing {job.file_name}: {result.error}")
+        return result
+
+    if result.status == 304:
+        # The length was compared with the size recorded by the last download before asking
+        result.unchanged = conditional
+    elif result.status < 400:
+        result.size = int(response_headers.get("content-length", 0)) or None
+        result.accept_ranges = response_headers.get("accept-ranges", "none").lower() == "bytes"
+        result.etag = response_headers.get("etag", "").strip('"') or None
+        result.last_modified = response_headers.get("last-modified")
+        if result.exists and result.size == result.local_size:
+            if job.etag:
+                result.unchanged = result.etag == job.etag
+            else:
+                result.unchanged = modified_before(result.last_modified, mtime)
+        job.size = result.size or job.size
+    else:
+        result.error = f"{result.status} {response.reason}"
+    return result
+
+
+def modified_before(last_modified, mtime):
+    """True if the HTTP date ``last_modified`` is no later than the timestamp ``mtime``."""
+    try:
+        return parsedate_to_datetime(last_modified).timestamp() <= mtime
+    except (TypeError, ValueError):
+        return False
+
+
+def order_jobs(jobs, order="listed"):
+    """Sort jobs for submission by their preflight size; unknown sizes go last."""
+    if order == "smallest":
+        return sorted(jobs, key=lambda job: (job.size is None, job.size or 0))
+    if order == "largest":
+        return sorted(jobs, key=lambda job: (job.size is None, -(job.size or 0)))
+    return list(jobs)
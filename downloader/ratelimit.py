@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import time
+
+BURST_SECONDS = 0.25
+
+
+def parse_rate(text):
+    """Parse a rate such as ``500K``, ``2M`` or ``1048576`` into bytes per second."""
+    text = str(text).strip().upper().rstrip("B/S")
+    multiplier = 1
+    if text and text[-1] in "KMG":
+        multiplier = 1024 ** ("KMG".index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text or 0) * multiplier)
+
+
+class TokenBucket:
+    """Byte tokens refilled at ``rate`` per second; a rate of 0 means unlimited.
+
+    Tokens may go negative: a chunk that has already been read is always
+    charged in full and the debt delays whoever asks next.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = 0
+        self.tokens = 0.0
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = max(0, int(rate))
+        self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self):
+        """Seconds until the bucket has a positive balance again."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        return 0.0 if self.tokens > 0 else -self.tokens / self.rate + 1e-3
+
+    def take(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+
+class BandwidthShaper:
+    """Global and per-host token buckets shared by every segment of every job.
+
+    With no limit set ``limited`` is false and transfers skip the shaper
+    entirely. Otherwise each chunk waits for both its buckets, and waiting
+    chunks are served in start-time fair queueing order: a job's chunks are
+    tagged with a virtual finish time that grows with the bytes that job has
+    been granted, so a job with ten segments gets the same share as a job
+    with one. Waiting is done with loop timers only, never extra syscalls
+    per chunk.
+    """
+
+    def __init__(self, loop, global_rate=0, host_rate=0):
+        self.loop = loop
+        self.global_bucket = TokenBucket(global_rate)
+        self.host_rate = host_rate
+        self._host_buckets = {}
+        self._waiters = {}  # host -> heap of (tag, seq, amount, job id, future)
+        self._finish = {}  # job id -> virtual finish time of its last chunk
+        self._virtual = 0.0
+        self._sequence = itertools.count()
+        self._timer = None
+
+    @property
+    def limited(self):
+        return bool(self.global_bucket.rate or self.host_rate)
+
+    def set_limits(self, global_rate, host_rate):
+        self.global_bucket.set_rate(global_rate)
+        self.host_rate = max(0, int(host_rate))
+        for bucket in self._host_buckets.values():
+            bucket.set_rate(self.host_rate)
+        self._dispatch()
+
+    def forget(self, job):
+        self._finish.pop(job.id, None)
+
+    def _host_bucket(self, host):
+        bucket = self._host_buckets.get(host)
+        if bucket is None:
+            bucket = self._host_buckets[host] = TokenBucket(self.host_rate)
+        return bucket
+
+    async def acquire(self, job, amount):
+        tag = max(self._virtual, self._finish.get(job.id, 0.0)) + amount
+        self._finish[job.id] = tag
+        if not self._waiters and self._ready(job.host):
+            self._grant(job.host, amount, tag)
+            return
+        future = self.loop.create_future()
+        heapq.heappush(self._waiters.setdefault(job.host, []), (tag, next(self._sequence), amount, job.id, future))
+        self._dispatch()
+        await future
+
+    def _ready(self, host):
+        return self.global_bucket.wait_time() == 0 and self._host_bucket(host).wait_time() == 0
+
+    def _grant(self, host, amount, tag):
+        self.global_bucket.take(amount)
+        self._host_bucket(host).take(amount)
+        self._virtual = max(self._virtual, tag - amount)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            global_wait = self.global_bucket.wait_time()
+            if global_wait:
+                self._timer = self.loop.call_later(global_wait, self._dispatch)
+                return
+            # Serve the lowest tag among hosts whose own bucket has tokens
+            best, host_wait = None, None
+            for host, heap in self._waiters.items():
+                wait = self._host_bucket(host).wait_time()
+                if wait:
+                    host_wait = wait if host_wait is None else min(host_wait, wait)
+                elif best is None or heap[0] < self._waiters[best][0]:
+                    best = host
+            if best is None:
+                self._timer = self.loop.call_later(host_wait, self._dispatch)
+                return
+            heap = self._waiters[best]
+            tag, _, amount, _, future = heapq.heappop(heap)
+            if not heap:
+                del self._waiters[best]
+            if future.cancelled():
+                continue
+            self._grant(best, amount, tag)
+            future.set_result(None)
@@ -0,0 +1,137 @@
+import logging
+import threading
+from concurrent.futures import wait
+
+from .jobs import DirectoryIndex
+
+PAGE_SIZE = 256
+
+
+def reconcile(job, files):
+    """Reset a completed ``job`` whose file is gone or no longer has its size; returns True if it changed.
+
+    ``files`` is a ``DirectoryIndex`` of the job's download directory.
+    """
+    if job.status != "completed":
+        return False
+    stat = files.stat(job.file_path)
+    if stat is not None and (not job.size or stat.st_size == job.size):
+        return False
+    job.status = "idle"
+    job.progress = 0
+    job.downloaded = 0
+    job.file_hash = None
+    return True
+
+
+class JobRestorer:
+    """Reads the saved jobs of a ``JobStore`` on a background thread at startup.
+
+    The window can be shown before the store has been touched: the restorer
+    counts the saved jobs and loads the first ``page_size`` of them for
+    ``on_page(total, jobs)``, then lists every directory the jobs download
+    to once (see ``DirectoryIndex``) and calls ``on_finished(restorer)``
+    with the result in ``files``, against which loaded jobs are checked
+    with ``reconcile``. Both callbacks run on the restore thread.
+    """
+
+    def __init__(self, store, on_page=None, on_finished=None, page_size=PAGE_SIZE):
+        self.store = store
+        self.on_page = on_page
+        self.on_finished = on_finished
+        self.page_size = page_size
+        self.total = 0
+        self.jobs = []  # the first page
+        self.files = DirectoryIndex()
+        self.error = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="job-restore", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def run(self):
+        try:
+            self.total = self.store.count()
+            self.jobs = self.store.load(0, self.page_size)
+            if self.on_page is not None:
+                self.on_page(self.total, self.jobs)
+            for directory in self.store.download_paths():
+                if self._cancelled.is_set():
+                    break
+                self.files.scan(directory)
+        except Exception as e:
+            logging.error(f"Error restoring saved jobs: {e}")
+            self.error = str(e)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+
+class JobFeeder:
+    """Reads the saved jobs after ``after_id`` that still need downloading, on a background thread.
+
+    Starting every checked job must not mean loading each of them into the
+    table first. The feeder pages through the store from ``after_id``,
+    resets completed jobs whose file is gone (``reconcile`` against
+    ``files``, if the restorer has listed the directories yet) and leaves
+    out the other completed ones. Each remaining page goes to
+    ``check(jobs, targets)``, where ``targets`` is a ``DirectoryIndex`` of
+    ``directory``, listed once for the whole run. ``check`` returns a future,
+    and the next page is read only once it is done, so a million jobs are
+    never all being probed at once. ``on_finished(feeder)`` is called at
+    the end. Both callbacks run on the feeder thread.
+    """
+
+    def __init__(self, store, check, directory, after_id=0, files=None, on_finished=None, page_size=PAGE_SIZE):
+        self.store = store
+        self.check = check
+        self.directory = directory
+        self.after_id = after_id
+        self.files = files
+        self.on_finished = on_finished
+        self.page_size = page_size
+        self.fed = 0
+        self.error = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="job-feed", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def run(self):
+        try:
+            targets = DirectoryIndex([self.directory])
+            after_id = self.after_id
+            while not self._cancelled.is_set():
+                page = self.store.load(after_id, self.page_size)
+                if not page:
+                    break
+                after_id = page[-1].id
+                jobs = []
+                for job in page:
+                    if self.files is not None and reconcile(job, self.files):
+                        self.store.mark(job)
+                    if job.status != "completed":
+                        jobs.append(job)
+                if jobs:
+                    self.fed += len(jobs)
+                    future = self.check(jobs, targets)
+                    while not self._cancelled.is_set() and not future.done():
+                        wait([future], timeout=0.5)
+        except Exception as e:
+            logging.error(f"Error reading saved jobs to download: {e}")
+            self.error = str(e)
+        if self.on_finished is not None:
+            self.on_finished(self)
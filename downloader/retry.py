@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+FAILURE_THRESHOLD = 5  # consecutive failed attempts on a host that open its circuit
+BASE_COOLDOWN = 15.0  # seconds an opened circuit waits before letting one job probe the host
+MAX_COOLDOWN = 600.0
+MAX_RETRY_AFTER = 3600.0  # longer Retry-After values are treated as this
+RETRYABLE_CLIENT_STATUSES = (408, 425, 429)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+class HostDown(Exception):
+    """The host's circuit opened; the job goes back to the queue instead of using up its retries."""
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header (delta seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(float(value), MAX_RETRY_AFTER)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return min(max(0.0, when.timestamp() - time.time()), MAX_RETRY_AFTER)
+
+
+def retry_after_of(error):
+    """The ``Retry-After`` delay an HTTP error response asked for, if any."""
+    headers = getattr(error, "headers", None) or getattr(error.__cause__, "headers", None)
+    return parse_retry_after(headers.get("Retry-After")) if headers else None
+
+
+def status_of(error):
+    return getattr(error, "status", None) or getattr(error.__cause__, "status", None)
+
+
+def is_retryable(error):
+    """Client errors other than timeouts and rate limiting will not go away by trying again."""
+    status = status_of(error)
+    return not (status and 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUSES)
+
+
+def is_host_failure(error):
+    """Whether an error says something about the host rather than about one file on it."""
+    if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)):
+        return True
+    status = status_of(error)
+    return bool(status and (status >= 500 or status == 429))
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter: attempt ``n`` waits between half and all of ``base * 2**n``.
+
+    The jitter keeps jobs that failed together from retrying together. A
+    ``Retry-After`` from the server is a lower bound on the wait.
+    """
+
+    def __init__(self, base=2.0, cap=60.0):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        backoff = min(self.cap, self.base * 2 ** attempt)
+        return max(random.uniform(backoff / 2, backoff), retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """Failure count and state of one host's circuit."""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = 0.0
+
+
+class HostHealth:
+    """Circuit breakers for every host, shared by all transfers of an engine.
+
+    ``FAILURE_THRESHOLD`` failed attempts in a row on one host (connection
+    errors, timeouts, 5xx and 429, see ``is_host_failure``) open its
+    circuit: ``on_open(host, seconds)`` is called so the engine can park the
+    host's jobs. When the cooldown ends the engine calls ``half_open`` and
+    lets a single job through. A successful request closes the circuit
+    again (``on_close(host)``); another failure reopens it with twice the
+    cooldown, up to ``MAX_COOLDOWN``, or longer if the server sent a
+    ``Retry-After``.
+    """
+
+    def __init__(self, on_open=None, on_close=None, threshold=FAILURE_THRESHOLD):
+        self.on_open = on_open
+        self.on_close = on_close
+        self.threshold = threshold
+        self.breakers = {}  # only hosts that failed since their last success
+
+    def state(self, host):
+        breaker = self.breakers.get(host)
+        return breaker.state if breaker is not None else CLOSED
+
+    def is_open(self, host):
+        return self.state(host) == OPEN
+
+    def open_hosts(self):
+        return sorted(host for host, breaker in self.breakers.items() if breaker.state != CLOSED)
+
+    def success(self, host):
+        breaker = self.breakers.pop(host, None)
+        if breaker is not None and breaker.state != CLOSED:
+            logging.info(f"Host {host} is reachable again")
+            if self.on_close is not None:
+                self.on_close(host)
+
+    def failure(self, host, error):
+        if not is_host_failure(error):
+            if status_of(error):
+                self.success(host)  # any other HTTP answer shows the host is up
+            return
+        breaker = self.breakers.setdefault(host, CircuitBreaker())
+        breaker.failures += 1
+        if breaker.state == OPEN or (breaker.state == CLOSED and breaker.failures < self.threshold):
+            return
+        breaker.state = OPEN
+        breaker.cooldown = min(MAX_COOLDOWN, breaker.cooldown * 2 or BASE_COOLDOWN)
+        seconds = max(breaker.cooldown, retry_after_of(error) or 0.0)
+        logging.error(f"Host {host} failed {breaker.failures} times in a row, last with {error}; "
+                      f"pausing its jobs for {seconds:.0f} seconds")
+        if self.on_open is not None:
+            self.on_open(host, seconds)
+
+    def half_open(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is not None and breaker.state == OPEN:
+            breaker.state = HALF_OPEN
@@ -0,0 +1,131 @@
+import heapq
+import itertools
+from collections import defaultdict
+
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+
+class Scheduler:
+    """Queued jobs, grouped per host, handed out by priority with per-host caps.
+
+    Every host has its own heap ordered by (priority, submission order), and
+    a heap of hosts orders the host heads by priority, then by how many jobs
+    that host already runs, then by submission order. A host
+    that reached ``per_host_limit`` drops out of the host heap until one of
+    its jobs is released, so one slow host can never take every slot.
+    Pushing and popping a job are O(log n); the host heap uses lazy
+    invalidation, so stale entries are skipped when they surface.
+
+    ``limit_host`` overrides the cap for one host: 0 parks its jobs while
+    its circuit is open, 1 lets a single probe through.
+    """
+
+    def __init__(self, per_host_limit=4):
+        self.per_host_limit = per_host_limit
+        self._queues = defaultdict(list)  # host -> heap of [-priority, seq, job]
+        self._entries = {}  # job id -> its heap entry, for removal
+        self._running = defaultdict(int)
+        self._limits = {}  # host -> cap overriding per_host_limit
+        self._hosts = []  # heap of (-priority, running, seq, version, host)
+        self._versions = defaultdict(int)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, job_id):
+        return job_id in self._entries
+
+    def job_ids(self):
+        return list(self._entries)
+
+    def push(self, job):
+        entry = [-job.priority, next(self._sequence), job]
+        self._entries[job.id] = entry
+        queue = self._queues[job.host]
+        heapq.heappush(queue, entry)
+        if queue[0] is entry:
+            self._refresh(job.host)  # only a new head changes the host's position
+
+    def remove(self, job_id):
+        """Drop a queued job; its heap entry is discarded lazily."""
+        entry = self._entries.pop(job_id, None)
+        if entry is None:
+            return None
+        job = entry[2]
+        entry[2] = None
+        queue = self._queues.get(job.host)
+        if queue and queue[0] is entry:
+            self._refresh(job.host)
+        return job
+
+    def reprioritize(self, job_id, priority):
+        job = self.remove(job_id)
+        if job is not None:
+            job.priority = priority
+            self.push(job)
+
+    def pop(self):
+        """Return the next job whose host still has a free slot, or None."""
+        while self._hosts:
+            _, _, _, version, host = heapq.heappop(self._hosts)
+            if version != self._versions[host]:
+                continue
+            job = self._pop_host(host)
+            if job is None:
+                continue
+            self._running[host] += 1
+            self._refresh(host)
+            return job
+        return None
+
+    def release(self, job):
+        """A job that ``pop`` handed out has finished or been stopped."""
+        if self._running[job.host] > 0:
+            self._running[job.host] -= 1
+        self._refresh(job.host)
+
+    def set_per_host_limit(self, limit):
+        self.per_host_limit = max(1, int(limit))
+        for host in list(self._queues):
+            self._refresh(host)
+
+    def limit_host(self, host, limit=None):
+        """Cap one host at ``limit`` running jobs, or go back to ``per_host_limit`` for None."""
+        if limit is None:
+            self._limits.pop(host, None)
+        else:
+            self._limits[host] = limit
+        self._refresh(host)
+
+    def _pop_host(self, host):
+        queue = self._queues[host]
+        while queue:
+            _, _, job = heapq.heappop(queue)
+            if job is not None:
+                del self._entries[job.id]
+                return job
+        return None
+
+    def _head(self, host):
+        queue = self._queues.get(host)
+        while queue and queue[0][2] is None:
+            heapq.heappop(queue)
+        if not queue:
+            self._queues.pop(host, None)
+            return None
+        return queue[0]
+
+    def _refresh(self, host):
+        self._versions[host] += 1
+        head = self._head(host)
+        if head is None or self._running[host] >= self._limits.get(host, self.per_host_limit):
+            return
+        key = (head[0], self._running[host], head[1], self._versions[host], host)
+        heapq.heappush(self._hosts, key)
+        if len(self._hosts) > 2 * len(self._queues) + 1024:
+            # Too many stale entries: keep only the current one of each host
+            self._hosts = [entry for entry in self._hosts if entry[3] == self._versions[entry[4]]]
+            heapq.heapify(self._hosts)
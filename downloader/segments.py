@@ -0,0 +1,362 @@
+import errno
+import json
+import logging
+import math
+import os
+import shutil
+import time
+
+MEGABYTE = 1048576
+SINGLE_STREAM_SIZE = 2 * MEGABYTE  # below this one connection is always enough
+MIN_SEGMENT_SIZE = MEGABYTE  # never split a range into pieces smaller than this
+INITIAL_SEGMENTS = 4
+TARGET_SECONDS = 2.0  # aim for each segment to need at least this long
+WRITE_BUFFER = MEGABYTE  # bytes a segment collects before writing them into the preallocated file
+THROTTLE_RECOVERY = 30.0  # seconds without a 429/503 that give a throttled host one connection back
+COPY_CHUNK = 1 << 30  # bytes per in-kernel copy call
+# Errors meaning an in-kernel copy is not possible between these files, rather than that the copy failed
+NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+class Segment:
+    """A byte range of the target file, written to its own part file or in place."""
+
+    def __init__(self, index, start, end, path, downloaded=0):
+        self.index = index
+        self.start = start
+        self.end = end  # inclusive, like the Range header
+        self.path = path
+        self.downloaded = downloaded
+        self.pending = 0  # received bytes still in a write buffer
+
+    @property
+    def written(self):
+        """Bytes known to be in the file, which is what may be committed for resuming."""
+        return self.downloaded - self.pending
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def remaining(self):
+        return max(0, self.size - self.downloaded)
+
+    @property
+    def done(self):
+        return self.downloaded >= self.size
+
+
+class HostStats:
+    """What the engine has learned about one host across all of its jobs."""
+
+    def __init__(self):
+        self.connection_speed = 0.0  # bytes per second per connection, smoothed
+        self._throttle_limit = None  # connections allowed right after the last 429/503
+        self._throttled_at = 0.0
+
+    @property
+    def max_segments(self):
+        """Connections a transfer may open to the host, or None if it never throttled us.
+
+        The limit set by the last throttled request grows back by one every
+        ``THROTTLE_RECOVERY`` seconds, so one burst of 503s does not hold
+        the host to a single connection for good.
+        """
+        if self._throttle_limit is None:
+            return None
+        return self._throttle_limit + int((time.monotonic() - self._throttled_at) / THROTTLE_RECOVERY)
+
+    def record_speed(self, bytes_per_second):
+        if bytes_per_second <= 0:
+            return
+        if self.connection_speed:
+            self.connection_speed = 0.7 * self.connection_speed + 0.3 * bytes_per_second
+        else:
+            self.connection_speed = bytes_per_second
+
+    def record_throttle(self, segments):
+        limit = max(1, segments - 1)
+        current = self.max_segments
+        self._throttle_limit = limit if current is None else min(current, limit)
+        self._throttled_at = time.monotonic()
+
+
+def supports_segments(size, accept_ranges, max_segments):
+    """Whether a download is worth splitting into ranges at all."""
+    return bool(size and accept_ranges and max_segments > 1 and size >= SINGLE_STREAM_SIZE)
+
+
+def plan_segments(size, accept_ranges, max_segments, host_stats=None):
+    """Pick the number of segments a download should start with."""
+    if not supports_segments(size, accept_ranges, max_segments):
+        return 1
+    limit = min(max_segments, size // MIN_SEGMENT_SIZE)
+    if host_stats is not None and host_stats.max_segments:
+        limit = min(limit, host_stats.max_segments)
+    if host_stats is not None and host_stats.connection_speed:
+        # Enough connections that each one still has TARGET_SECONDS of work
+        wanted = math.ceil(size / (host_stats.connection_speed * TARGET_SECONDS))
+    else:
+        wanted = INITIAL_SEGMENTS
+    return max(1, min(limit, wanted))
+
+
+def remove_parts(file_path, segments):
+    """Delete the part files of ``segments``, the preallocated ``<file>.part`` and the ``<file>.json`` table."""
+    for path in [segment.path for segment in segments] + [file_path + ".part", file_path + ".json"]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error removing partial file {path}: {e}")
+
+
+def open_preallocated(path, size):
+    """Open ``path`` for writes at offsets, reserving ``size`` bytes of disk for it up front.
+
+    File systems that cannot allocate ahead get a sparse file of the right
+    size instead; running out of space is an error straight away rather
+    than half way through the download.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        if os.fstat(fd).st_size != size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError) as e:
+                if getattr(e, "errno", None) == errno.ENOSPC:
+                    raise
+                os.ftruncate(fd, size)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def write_at(fd, data, offset):
+    """Write all of ``data`` at ``offset`` without moving any shared file position."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Every write happens on the engine loop, so seeking first is safe
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def append_file(dest, source):
+    """Copy the rest of the open file ``source`` to ``dest`` at its position; returns the bytes copied.
+
+    The copy stays in the kernel where it can: ``copy_file_range`` (which
+    may even share blocks on file systems with reflinks), then
+    ``sendfile``. Only if neither works here do the bytes pass through a
+    Python buffer.
+    """
+    dest.flush()
+    start = dest.tell()
+    kernel_copies = (lambda: os.copy_file_range(source.fileno(), dest.fileno(), COPY_CHUNK),
+                     lambda: os.sendfile(dest.fileno(), source.fileno(), None, COPY_CHUNK))
+    for copy in kernel_copies:
+        try:
+            while copy():
+                pass
+            return os.lseek(dest.fileno(), 0, os.SEEK_CUR) - start
+        except (AttributeError, OSError) as e:
+            if getattr(e, "errno", None) not in NO_KERNEL_COPY | {None}:
+                raise
+    shutil.copyfileobj(source, dest, MEGABYTE)
+    return dest.tell() - start
+
+
+class RangeWriter:
+    """Writes one segment's bytes into the preallocated output at the segment's offset.
+
+    Chunks are collected and written with one ``pwrite`` per
+    ``WRITE_BUFFER`` bytes. Until then they count as the segment's
+    ``pending`` bytes, so offsets committed for resuming never run ahead
+    of what the file holds.
+    """
+
+    def __init__(self, fd, segment):
+        self.fd = fd
+        self.segment = segment
+        self.offset = segment.start + segment.written
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        self.segment.pending += len(data)
+        if len(self.buffer) >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        write_at(self.fd, self.buffer, self.offset)
+        self.offset += len(self.buffer)
+        self.segment.pending -= len(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+
+
+class SegmentTable:
+    """The segments of one file plus the ``<file>.json`` that lets it resume.
+
+    With ``preallocate`` every segment writes into ``<file>.part`` at its
+    own offset; the file is reserved at full size up front and only renamed
+    when complete. The table then also records each segment's written
+    offset. Otherwise every segment has its own part file, whose size is
+    its offset, to be joined at the end.
+
+    The JSON keeps Pypdl's ``url``/``etag``/``segments`` keys; ``ranges`` is
+    added because segments can be split while the download runs. Tables
+    written by Pypdl (no ``ranges``) are rebuilt by dividing the file evenly.
+    A table left by a download in the other layout decides the layout, so
+    it resumes instead of starting over.
+    """
+
+    def __init__(self, url, file_path, size, etag, preallocate=False):
+        self.url = url
+        self.file_path = file_path
+        self.size = size
+        self.etag = etag
+        self.preallocate = preallocate
+        self.segments = []
+
+    @property
+    def progress_file(self):
+        return self.file_path + ".json"
+
+    @property
+    def output_path(self):
+        return self.file_path + ".part"
+
+    def load_or_create(self, count, saved=None):
+        """Build the segment list, resuming from ``saved`` segments or the JSON table.
+
+        ``saved`` are segments whose ``downloaded`` offsets were committed to
+        the job store; a part file is cut back to its committed offset, since
+        bytes past it may not have reached the disk before a crash.
+        """
+        ranges = None
+        committed = {}
+        table = self._read()
+        if table is not None:
+            self.preallocate = bool(table.get("preallocated"))
+        elif os.path.exists(self.output_path):
+            self.preallocate = True
+        if saved:
+            ranges = [[segment.start, segment.end] for segment in saved]
+            committed = {segment.index: segment.downloaded for segment in saved}
+        elif table is not None:
+            try:
+                ranges = table.get("ranges") or self._even_ranges(table["segments"])
+                committed = dict(enumerate(table.get("downloaded", [])))
+            except (KeyError, TypeError, ValueError):
+                ranges = None
+        if self.preallocate:
+            return self._load_preallocated(count, ranges, committed)
+        if not ranges or max(end for _, end in ranges) != self.size - 1:
+            ranges = self._even_ranges(count)
+            committed = {}
+            # Part files without a matching table belong to another version of the file
+            for index in range(count):
+                if os.path.exists(f"{self.file_path}.{index}"):
+                    os.remove(f"{self.file_path}.{index}")
+
+        self.segments = []
+        for index, (start, end) in enumerate(ranges):
+            segment = Segment(index, start, end, f"{self.file_path}.{index}")
+            if os.path.exists(segment.path):
+                existing = os.path.getsize(segment.path)
+                if existing > segment.size:
+                    os.remove(segment.path)
+                else:
+                    segment.downloaded = min(existing, committed.get(index, existing))
+                    if segment.downloaded < existing:
+                        os.truncate(segment.path, segment.downloaded)
+            self.segments.append(segment)
+        self.save()
+        return self.segments
+
+    def _load_preallocated(self, count, ranges, committed):
+        # Offsets only mean something if the output they point into is still there
+        if not ranges or max(end for _, end in ranges) != self.size - 1:
+            ranges = self._even_ranges(count)
+            committed = {}
+        if os.path.exists(self.output_path) and os.path.getsize(self.output_path) != self.size:
+            os.remove(self.output_path)
+        if not os.path.exists(self.output_path):
+            committed = {}
+        self.segments = []
+        for index, (start, end) in enumerate(ranges):
+            segment = Segment(index, start, end, f"{self.file_path}.{index}")
+            segment.downloaded = max(0, min(committed.get(index, 0), segment.size))
+            self.segments.append(segment)
+        self.save()
+        return self.segments
+
+    def _read(self):
+        """The saved table if it belongs to this URL and version of the file, otherwise None."""
+        if not os.path.exists(self.progress_file):
+            return None
+        try:
+            with open(self.progress_file) as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(table, dict) or table.get("url") != self.url or table.get("etag") != self.etag:
+            return None
+        return table
+
+    def split(self, segment):
+        """Give the second half of ``segment``'s remaining bytes to a new segment; the caller saves the table."""
+        if segment.remaining < 2 * MIN_SEGMENT_SIZE:
+            return None
+        middle = segment.start + segment.downloaded + segment.remaining // 2
+        index = max(s.index for s in self.segments) + 1
+        new = Segment(index, middle, segment.end, f"{self.file_path}.{index}")
+        if os.path.exists(new.path):
+            os.remove(new.path)
+        segment.end = middle - 1
+        self.segments.append(new)
+        return new
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def snapshot(self):
+        """The table as it is now, for ``write`` to save from another thread while the download goes on."""
+        # Listed by index so that position N always describes part file <file>.N
+        segments = sorted(self.segments, key=lambda s: s.index)
+        table = {"url": self.url, "etag": self.etag, "segments": len(segments),
+                 "ranges": [[s.start, s.end] for s in segments]}
+        if self.preallocate:
+            table["preallocated"] = True
+            table["downloaded"] = [s.written for s in segments]
+        return table
+
+    def write(self, table):
+        with open(self.progress_file, "w") as f:
+            json.dump(table, f, indent=4)
+
+    def ordered(self):
+        return sorted(self.segments, key=lambda s: s.start)
+
+    def _even_ranges(self, count):
+        partition, extra = divmod(self.size, count)
+        ranges = []
+        for index in range(count):
+            start = partition * index
+            end = partition * (index + 1) - 1
+            if index == count - 1:
+                end += extra
+            ranges.append([start, end])
+        return ranges
@@ -0,0 +1,312 @@
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+from .jobs import Job, file_name_for, numbered_name
+from .segments import Segment
+
+FLUSH_INTERVAL = 1.0  # seconds to gather updates into one transaction
+QUERY_CHUNK = 500  # values per IN (...) lookup, well below SQLite's variable limit
+INGEST_CACHE = -65536  # 64 MiB of pages, so the lookup indexes stay in memory
+FILTER_BITS = 24  # 2 MiB per HashFilter, about 6% of it set by a million jobs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    download_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    headers TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'idle',
+    progress INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    etag TEXT,
+    segments TEXT,
+    error TEXT,
+    url_hash INTEGER,
+    expected_hash TEXT,
+    file_hash TEXT,
+    last_modified TEXT,
+    mirrors TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_file_name ON jobs (file_name);
+"""
+
+COLUMNS = ("url", "download_path", "file_name", "headers", "priority", "status", "progress", "size",
+           "downloaded", "etag", "segments", "error", "url_hash", "expected_hash", "file_hash",
+           "last_modified", "mirrors")
+
+# A job that was running when the program ended has to be started again
+RESTORED_STATUS = {"queued": "idle", "waiting": "idle", "downloading": "stopped", "paused": "stopped",
+                   "processing": "stopped"}
+
+
+def url_hash(url):
+    return zlib.crc32(url.encode())
+
+
+class HashFilter:
+    """The top ``bits`` bits of every CRC-32 added, as a fixed-size bitmap.
+
+    A clear bit means no value with those bits was added, so a key can be
+    known to be new without a lookup in the database; a set bit only means
+    it might not be.
+    """
+
+    def __init__(self, values=(), bits=FILTER_BITS):
+        self.shift = 32 - bits
+        self.bitmap = bytearray(1 << (bits - 3))
+        self.update(values)
+
+    def update(self, values):
+        bitmap, shift = self.bitmap, self.shift
+        for value in values:
+            value >>= shift
+            bitmap[value >> 3] |= 1 << (value & 7)
+
+    def select(self, pairs):
+        """The keys of the ``(value, key)`` pairs whose value may have been added."""
+        bitmap, shift = self.bitmap, self.shift
+        return {key for value, key in pairs if bitmap[value >> shift >> 3] >> (value >> shift & 7) & 1}
+
+
+class JobStore:
+    """Every job, its progress and its segment offsets in a SQLite database.
+
+    The database runs in WAL mode, so the window can read pages of jobs
+    while updates are written. ``mark`` only remembers that a job changed;
+    a background thread writes the changed jobs in one transaction every
+    ``flush_interval`` seconds while downloads run, and ``close`` writes
+    whatever is left. After a crash each job resumes from the segment
+    offsets of the last committed batch.
+
+    Job IDs come from ``ids``, which continues after the highest saved ID.
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(f"PRAGMA cache_size={INGEST_CACHE}")
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        self.ids = itertools.count(self._db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM jobs").fetchone()[0])
+        self._suffixes = {}  # file name -> last suffix handed out for it
+        self._url_filter = None  # HashFilters of the saved URLs and file names, read on the first add_links
+        self._name_filter = None
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._pending = threading.Event()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-store", daemon=True)
+        self._thread.start()
+
+    def count(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def load(self, after_id=0, limit=256):
+        """Return up to ``limit`` jobs with an ID above ``after_id``, in ID order."""
+        with self._db_lock:
+            rows = self._db.execute(f"SELECT id, {', '.join(COLUMNS)} FROM jobs WHERE id > ? ORDER BY id LIMIT ?",
+                                    (after_id, limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def download_paths(self):
+        """The distinct directories saved jobs download to."""
+        with self._db_lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT download_path FROM jobs")]
+
+    def add(self, jobs):
+        rows = [(job.id, *self._row(job)) for job in jobs]
+        with self._db_lock, self._db:
+            self._db.executemany(f"INSERT OR REPLACE INTO jobs (id, {', '.join(COLUMNS)}) "
+                                 f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})", rows)
+
+    def add_links(self, urls, download_path, headers=None, checksums=None, mirrors=None):
+        """Save a new job for every URL not saved yet and return how many were added.
+
+        URLs should already be normalized; duplicates are found within the
+        batch and through the index on ``url_hash``, a CRC-32 of the URL that
+        is far smaller and faster to update than an index on the URL text;
+        equal hashes are confirmed by comparing the URLs. A file name that another job
+        already uses gets a `` (n)`` suffix, so no two jobs share a target.
+        ``checksums`` maps URLs or file names to expected checksums (see
+        ``read_manifest``) and ``mirrors`` URLs to lists of mirror URLs.
+        """
+        checksums = checksums or {}
+        mirrors = mirrors or {}
+        headers = json.dumps(dict(headers or {}))
+        with self._db_lock, self._db:
+            if self._url_filter is None:
+                self._load_filters()
+            hashes = {url: zlib.crc32(url.encode()) for url in urls}
+            # Only URLs and names the filters cannot rule out are looked up
+            known = self._existing("url", "url_hash", self._url_filter.select((h, h) for h in hashes.values()))
+            new = [url for url in hashes if url not in known]
+            names = [file_name_for(url.partition("?")[0]) for url in new]
+            name_hashes = [zlib.crc32(name.encode()) for name in names]
+            free_names = self._free_names(names, self._existing("file_name", "file_name",
+                                                                self._name_filter.select(zip(name_hashes, names))))
+            rows = []
+            for url, name, free_name in zip(new, names, free_names):
+                expected = (checksums.get(url) or checksums.get(name)) if checksums else None
+                urls_mirrors = json.dumps(mirrors[url]) if url in mirrors else None
+                rows.append((next(self.ids), url, download_path, free_name, headers, hashes[url], expected,
+                             urls_mirrors))
+            self._url_filter.update(hashes[url] for url in new)
+            self._name_filter.update(value if free_name is name else zlib.crc32(free_name.encode())
+                                     for value, name, free_name in zip(name_hashes, names, free_names))
+            self._db.executemany("INSERT INTO jobs (id, url, download_path, file_name, headers, url_hash, expected_hash, "
+                                 "mirrors) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def remove(self, job_ids):
+        with self._lock:
+            for job_id in job_ids:
+                self._dirty.pop(job_id, None)
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def clear(self):
+        with self._lock:
+            self._dirty.clear()
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM jobs")
+            self._suffixes.clear()
+            self._url_filter = self._name_filter = None
+
+    def mark(self, job):
+        """Schedule ``job`` to be written with the next batch; safe to call from any thread."""
+        with self._lock:
+            self._dirty[job.id] = job
+        self._pending.set()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._pending.clear()
+        if not dirty:
+            return
+        rows = [(*self._row(job), job.id) for job in dirty.values()]
+        try:
+            with self._db_lock, self._db:
+                self._db.executemany(f"UPDATE jobs SET {', '.join(c + ' = ?' for c in COLUMNS)} WHERE id = ?", rows)
+        except sqlite3.Error as e:
+            logging.error(f"Error saving download progress: {e}")
+
+    def close(self):
+        self._closing.set()
+        self._pending.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _run(self):
+        while not self._closing.is_set():
+            self._pending.wait()
+            # Let a batch of updates pile up before writing them together
+            self._closing.wait(self.flush_interval)
+            self.flush()
+
+    def _migrate(self):
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "url_hash" not in columns:
+            # Stores written before duplicate detection indexed the URL text instead
+            with self._db:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN url_hash INTEGER")
+                self._db.create_function("url_hash", 1, url_hash, deterministic=True)
+                self._db.execute("UPDATE jobs SET url_hash = url_hash(url)")
+                self._db.execute("DROP INDEX IF EXISTS jobs_url")
+        # Nothing looks jobs up by status, and every insert had to update it
+        self._db.execute("DROP INDEX IF EXISTS jobs_status")
+        for column in ("expected_hash", "file_hash", "last_modified", "mirrors"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_url_hash ON jobs (url_hash)")
+
+    def _load_filters(self):
+        rows = self._db.execute("SELECT url_hash, file_name FROM jobs").fetchall()
+        self._url_filter = HashFilter(url_hash for url_hash, _ in rows)
+        self._name_filter = HashFilter(zlib.crc32(name.encode()) for _, name in rows)
+
+    def _existing(self, column, key_column, keys):
+        """Return the values of ``column`` in rows whose ``key_column`` is one of ``keys``."""
+        keys = list(keys)
+        found = set()
+        for i in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[i:i + QUERY_CHUNK]
+            query = f"SELECT {column} FROM jobs WHERE {key_column} IN ({', '.join('?' * len(chunk))})"
+            found.update(row[0] for row in self._db.execute(query, chunk))
+        return found
+
+    def _free_names(self, names, taken):
+        """``names`` with a `` (n)`` suffix on every one in ``taken`` or earlier in the list.
+
+        Candidates for all clashing names are looked up together, a round per
+        suffix that turns out to be taken as well, rather than one query each.
+        """
+        names = list(names)
+        seen = set(taken)
+        clashing = {}  # position -> name still without a free suffix
+        for position, name in enumerate(names):
+            if name in seen:
+                clashing[position] = name
+            else:
+                seen.add(name)
+        while clashing:
+            candidates = {}
+            for position, name in clashing.items():
+                suffix = self._suffixes[name] = self._suffixes.get(name, 0) + 1
+                candidates[position] = numbered_name(name, suffix)
+            unseen = set(candidates.values()) - seen
+            saved = self._existing("file_name", "file_name",
+                                   self._name_filter.select((zlib.crc32(name.encode()), name) for name in unseen))
+            still = {}
+            for position, candidate in candidates.items():
+                if candidate in seen or candidate in saved:
+                    still[position] = clashing[position]
+                else:
+                    seen.add(candidate)
+                    names[position] = candidate
+            clashing = still
+        return names
+
+    def _row(self, job):
+        segments = json.dumps([[s.start, s.end, s.written] for s in list(job.segments)]) if job.segments else None
+        return (job.url, job.download_path, job.file_name, json.dumps(job.headers), job.priority, job.status,
+                job.progress, job.size, job.downloaded, job.etag, segments, job.error, url_hash(job.url),
+                job.expected_hash, job.file_hash, job.last_modified, json.dumps(job.mirrors) if job.mirrors else None)
+
+    def _job(self, row):
+        (job_id, url, download_path, file_name, headers, priority, status, progress, size,
+         downloaded, etag, segments, error, _, expected_hash, file_hash, last_modified, mirrors) = row
+        job = Job(job_id, url, download_path, json.loads(headers) if headers and headers != "{}" else {}, progress,
+                  priority)
+        job.file_name = file_name
+        job.status = RESTORED_STATUS.get(status, status)
+        job.size = size
+        job.downloaded = downloaded
+        job.etag = etag
+        job.error = error
+        job.expected_hash = expected_hash
+        job.file_hash = file_hash
+        job.last_modified = last_modified
+        job.mirrors = json.loads(mirrors) if mirrors else []
+        if segments:
+            job.segments = [Segment(index, start, end, f"{job.file_path}.{index}", done)
+                            for index, (start, end, done) in enumerate(json.loads(segments))]
+        return job
@@ -0,0 +1,735 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+from .checksums import algorithm_of, new_hash
+from .mirrors import SAMPLE_SECONDS, Mirror, MirrorSet, matches
+from .retry import HostDown, RetryPolicy, is_retryable, retry_after_of
+from .segments import (HostStats, RangeWriter, SegmentTable, append_file, open_preallocated, plan_segments,
+                       remove_parts, supports_segments)
+
+CHUNK_SIZE = 64 * 1024
+MEGABYTE = 1048576
+TUNE_INTERVAL = 1.0
+GROWTH_THRESHOLD = 1.1  # another connection must add at least 10% throughput
+THROTTLE_STATUSES = (429, 503)
+
+
+class Throttled(Exception):
+    """The server refused a range request with 429 or 503."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ChecksumMismatch(Exception):
+    """The finished file does not have the checksum the manifest expects."""
+
+
+class TooLarge(Exception):
+    """A job sent down the small-file path is larger than ``size_limit``."""
+
+
+async def restore_cached(cache, job, bus, path, checksum):
+    """Put the cached file at ``path`` in place of ``job``'s download; False if it cannot be used."""
+    if path is None or (job.expected_hash and checksum != job.expected_hash):
+        return False
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, cache.materialize, path, job.file_path):
+        return False
+    job.size = job.downloaded = os.path.getsize(job.file_path)
+    job.file_hash = checksum
+    job.segments = []
+    bus.touch(job)
+    return True
+
+
+class Transfer:
+    """Downloads one job over a shared aiohttp session.
+
+    Small files and servers without Range support get a single stream.
+    Everything else starts with the number of segments ``plan_segments``
+    picks from the preflight and the host's measured per-connection speed,
+    and adds or drops connections as it runs (see ``_tune``). A job with
+    ``mirrors`` spreads its ranges over every mirror that serves the same
+    file; ``session_for(url)`` gives the pooled session of a mirror's host.
+    When a bandwidth limit is set every chunk is charged to the engine's
+    shared ``BandwidthShaper`` before the next one is read.
+
+    Part files use the ``<file>.<n>`` / ``<file>.json`` layout Pypdl used, so
+    partial downloads left behind by older versions resume instead of
+    starting over.
+    """
+
+    def __init__(self, job, session, bus, max_segments=10, retries=3, host_stats=None, shaper=None, cache=None,
+                 metrics=None, session_for=None, preallocate=True, health=None, retry_policy=None, size_limit=None,
+                 checksum=False):
+        self.job = job
+        self.session = session
+        self.session_for = session_for or (lambda url: session)
+        self.mirrors = MirrorSet([Mirror(job.url, session)])
+        self.bus = bus
+        self.shaper = shaper
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.max_segments = max_segments
+        self.retries = retries
+        self.host_stats = host_stats or HostStats()
+        self.metrics = metrics
+        self.health = health
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.preallocate = preallocate
+        self.size_limit = size_limit
+        self.checksum = checksum  # hash segmented downloads even without an expected checksum or a cache
+        self.etag = None
+        self.last_modified = None
+        self.accept_ranges = False
+        self.error = None
+        self.error_host = None  # the mirror's host if the last error came from a mirror
+        self.table = None
+        self._hash = None
+        self._hashed = 0  # length of the prefix of a segmented download that has been hashed
+        self._catch_up = None  # task reading finished segments back for the checksum
+        self._table_writer = None  # task writing the segment table in a worker thread
+        self._table_changed = False
+        self._pending = deque()
+        self._in_flight = set()
+        self._workers = set()
+        self._throttled = False
+        self._files = {}  # part file path -> file or RangeWriter kept open across pauses
+        self._output_fd = None  # the preallocated <file>.part
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._resumed_at = None
+        self._paused_connections = 0
+        self._partial_output = False  # job.file_path is being written and not finished yet
+        self.sink = None  # e.g. a StreamExtractor fed the bytes of a single stream as they arrive
+        self.paused = False
+
+    @property
+    def headers(self):
+        return {k: v for k, v in (self.job.headers or {}).items() if v}
+
+    @property
+    def connections(self):
+        return len(self._workers)
+
+    def pause(self):
+        """Drop the connections, keeping offsets, open files, validators and checksum state for ``resume``.
+
+        ``resume`` reconnects every range from its exact byte offset without
+        probing the server again (a single stream continues with a Range
+        request where the server allows it), and records in
+        ``job.resume_latency`` how long the first byte took to arrive.
+        Stopping is cancellation of the task running ``run``: connections
+        are closed and part files flushed and closed on the way out, after
+        which ``discard_partial`` can delete whatever was left behind.
+        """
+        if self.paused:
+            return
+        self.paused = True
+        self._resume.clear()
+        self._paused_connections = len(self._workers)
+        for task in self._workers:
+            task.cancel()
+        for f in self._files.values():
+            f.flush()
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        self._resumed_at = time.monotonic()
+        self._resume.set()
+
+    def discard_partial(self):
+        """Delete part files, the segment table and an unfinished output file, and reset progress."""
+        remove_parts(self.job.file_path, self.table.segments if self.table is not None else self.job.segments)
+        if self._partial_output:
+            try:
+                os.remove(self.job.file_path)
+            except OSError:
+                pass
+            self._partial_output = False
+        self.job.segments = []
+        self.job.downloaded = 0
+        self.job.progress = 0
+
+    async def _wait_resumed(self):
+        while self.paused:
+            await self._resume.wait()
+
+    async def run(self):
+        """Download the job, retrying failed attempts; True on success.
+
+        Retries wait for the backoff of ``retry_policy`` and are skipped for
+        client errors that a retry cannot fix. Every attempt is reported to
+        the engine's ``HostHealth``, charged to the host the failed request
+        went to; once the job's host has an open circuit ``HostDown`` is
+        raised instead, so the job waits in the queue without holding a
+        slot or using up its retries. A failing mirror never parks the job.
+        """
+        for attempt in range(self.retries + 1):
+            self.error_host = None
+            try:
+                await self._download()
+                return True
+            except (asyncio.CancelledError, TooLarge):
+                raise
+            except Exception as e:
+                self.error = str(e) or e.__class__.__name__
+                logging.error(f"Error downloading {self.job.file_name} (attempt {attempt + 1}): {e}")
+                retrying = attempt < self.retries and is_retryable(e)
+                self._record_failure(self.error_host or self.job.host, e, retrying)
+                self._check_host()
+                if not retrying:
+                    return False
+                await asyncio.sleep(self.retry_policy.delay(attempt, retry_after_of(e)))
+                self._check_host()
+        return False
+
+    def _record_failure(self, host, error, retrying):
+        if self.metrics is not None:
+            self.metrics.add_error(host, getattr(error, "status", None), retrying)
+        if self.health is not None:
+            self.health.failure(host, error)
+
+    def _check_host(self):
+        if self.health is not None and self.health.is_open(self.job.host):
+            raise HostDown(f"{self.job.host} is not responding: {self.error}")
+
+    async def _probe(self):
+        async with self.session.head(self.job.url, headers=self.headers, allow_redirects=True,
+                                     raise_for_status=False) as response:
+            if response.status == 200:
+                return response.headers
+        async with self.session.get(self.job.url, headers=self.headers) as response:
+            return response.headers
+
+    async def _probe_mirrors(self):
+        """Return the mirrors, the primary URL first, whose file matches the primary's."""
+        mirrors = [Mirror(self.job.url, self.session)]
+        candidates = [Mirror(url, self.session_for(url)) for url in self.job.mirrors]
+        if self.health is not None:
+            candidates = [mirror for mirror in candidates if not self.health.is_open(mirror.host)]
+        results = await asyncio.gather(*(self._probe_mirror(mirror) for mirror in candidates), return_exceptions=True)
+        for mirror, headers in zip(candidates, results):
+            if isinstance(headers, Exception):
+                logging.error(f"Error probing mirror {mirror.url}: {headers}")
+            elif not matches(headers, self.job.size, self.etag):
+                logging.error(f"Skipping mirror {mirror.url}: it serves a different file or no ranges")
+            else:
+                if self.health is not None:
+                    self.health.success(mirror.host)
+                mirrors.append(mirror)
+        return MirrorSet(mirrors)
+
+    async def _probe_mirror(self, mirror):
+        async with mirror.session.head(mirror.url, headers=self.headers, allow_redirects=True) as response:
+            return response.headers
+
+    async def _download(self):
+        """One attempt at the whole file.
+
+        With an enabled ``DownloadCache`` a job whose expected checksum, or
+        whose URL with unchanged validators, is cached is linked into place
+        instead, and every finished download is added to it. With a
+        ``size_limit`` (the engine's bulk mode) the job is taken to be a
+        small file: a single GET whose response headers stand in for the
+        probe, saving a round trip per file (see ``_check_size``).
+        """
+        if self.cache is not None and self.job.expected_hash:
+            # A known checksum needs no request at all
+            if await self._restore(self.cache.find_checksum(self.job.expected_hash), self.job.expected_hash):
+                return
+
+        if self.size_limit is not None:
+            self._reset_output()
+            await self._fetch_single()  # reads the headers from its own response
+            self._finish_hash()
+            await self._add_to_cache()
+            return
+
+        headers = await self._probe()
+        if self.health is not None:
+            self.health.success(self.job.host)
+        self._read_headers(headers)
+        if self.cache is not None:
+            if await self._restore(*self.cache.find(self.job.url, self.etag, self.last_modified, self.job.size)):
+                return
+        # Offsets committed to the job store only apply to the same version of the file
+        saved = self.job.segments if self.job.etag == self.etag else None
+        self.job.etag = self.etag
+        self._reset_output()
+
+        if supports_segments(self.job.size, self.accept_ranges, self.max_segments):
+            if self.job.mirrors:
+                self.mirrors = await self._probe_mirrors()
+            await self._fetch_segmented(saved)
+        else:
+            await self._fetch_single()
+        self._finish_hash()
+        await self._add_to_cache()
+
+    def _read_headers(self, headers):
+        self.job.size = int(headers.get("content-length", 0)) or None
+        self.etag = headers.get("etag", "").strip('"') or None
+        self.last_modified = headers.get("last-modified")
+        self.job.last_modified = self.last_modified
+        self.accept_ranges = headers.get("accept-ranges", "none").lower() == "bytes"
+
+    def _reset_output(self):
+        self.job.segments = []
+        self.job.downloaded = 0
+        self.job.file_hash = None
+        self._hash = new_hash(algorithm_of(self.job.expected_hash))
+        self._hashed = 0
+        self._catch_up = None
+
+    def _finish_hash(self):
+        if self._hash is None:
+            return  # a segmented download nobody needed the checksum of
+        self.job.file_hash = f"{algorithm_of(self.job.expected_hash)}:{self._hash.hexdigest()}"
+        if self.job.expected_hash and self.job.file_hash != self.job.expected_hash:
+            raise ChecksumMismatch(f"Checksum mismatch: expected {self.job.expected_hash}, got {self.job.file_hash}")
+
+    async def _add_to_cache(self):
+        if self.cache is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.cache.add, self.job.file_path, self.job.url,
+                                                             self.job.file_hash, self.etag, self.last_modified)
+
+    async def _restore(self, path, checksum):
+        return await restore_cached(self.cache, self.job, self.bus, path, checksum)
+
+    async def _fetch_segmented(self, saved=None):
+        """Download the ranges of the segment table over several connections.
+
+        With ``preallocate`` (the default) the whole ``<file>.part`` is
+        reserved up front and each connection writes its range in place
+        with large ``pwrite`` calls, so every byte is written once and
+        finishing is a rename (``_finish_preallocated``). Downloads that
+        started with per-segment part files are joined by ``_combine``.
+        The download is only hashed when the checksum is checked or cached
+        (see ``_hash_chunk``).
+        """
+        count = plan_segments(self.job.size, self.accept_ranges, self.max_segments, self.host_stats)
+        # At least one connection per mirror, so each one gets measured
+        count = max(count, min(len(self.mirrors), self.max_segments))
+        if not (self.job.expected_hash or self.cache is not None or self.checksum):
+            self._hash = None  # only worth reading bytes back for if it is checked or cached
+        self.table = SegmentTable(self.job.url, self.job.file_path, self.job.size, self.etag, self.preallocate)
+        segments = await self._blocking(self.table.load_or_create, count, saved)
+        if self.table.preallocate:
+            self._output_fd = await self._blocking(open_preallocated, self.table.output_path, self.job.size)
+        self.job.segments = self.table.segments
+        self.job.downloaded = sum(segment.downloaded for segment in segments)
+        self.bus.touch(self.job)
+
+        self._pending = deque(segment for segment in segments if not segment.done)
+        self._in_flight = set()
+        self._workers = set()
+        self._throttled = False
+        await self._wait_resumed()
+        for _ in range(min(count, len(self._pending))):
+            self._spawn_worker()
+
+        tuner = asyncio.get_running_loop().create_task(self._tune())
+        try:
+            while True:
+                await self._wait_for_workers()
+                if not self.paused or not self._pending:
+                    break
+                # Ranges cut off by the pause went back to the front of the queue
+                await self._wait_resumed()
+                for _ in range(max(1, min(self._paused_connections, len(self._pending)))):
+                    self._spawn_worker()
+        finally:
+            tuner.cancel()
+            for task in self._workers:
+                task.cancel()
+            await asyncio.gather(tuner, *self._workers, return_exceptions=True)
+            self._workers.clear()
+            self._close_files()
+            if self.table.preallocate:
+                self._save_table()  # the offsets the writers just flushed
+            if self._table_writer is not None:
+                await self._table_writer
+
+        missing = [segment for segment in self.table.segments if not segment.done]
+        if missing:
+            raise Exception(f"{len(missing)} segments incomplete")
+        await self._hash_segments()
+        if self.table.preallocate:
+            await self._blocking(self._finish_preallocated)
+        else:
+            self._count_written(await self._blocking(self._combine, self.table.ordered()))
+        self.job.segments = []
+
+    async def _wait_for_workers(self):
+        """Wait until every worker has finished or was cancelled by ``pause``; re-raise the first error."""
+        while self._workers:
+            done, _ = await asyncio.wait(self._workers, return_when=asyncio.FIRST_EXCEPTION)
+            self._workers -= done
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+
+    def _spawn_worker(self):
+        self._workers.add(asyncio.get_running_loop().create_task(self._worker()))
+
+    async def _worker(self):
+        await self._work()
+        # Gone at once, so the connections still running see how many are left; a failed or
+        # cancelled one stays until _wait_for_workers collects it with its error
+        self._workers.discard(asyncio.current_task())
+
+    async def _work(self):
+        while self._pending:
+            segment = self._pending.popleft()
+            mirror = self.mirrors.pick()
+            self._in_flight.add(segment)
+            try:
+                await self._fetch_segment(segment, mirror)
+            except Throttled as e:
+                self._pending.appendleft(segment)
+                self._throttled = True
+                if self.metrics is not None:
+                    self.metrics.add_throttle(mirror.host)
+                if mirror.host == self.job.host:
+                    self.host_stats.record_throttle(len(self._workers))  # what it learns applies to this host
+                if self.mirrors.fail(mirror, e):
+                    continue  # another mirror takes the range over; one that keeps refusing is dropped
+                if len(self._workers) > 1:
+                    return  # give the connection back; the remaining ones pick the range up
+                # The last connection waits for the server and carries on
+                await asyncio.sleep(max(TUNE_INTERVAL, e.retry_after or 0))
+                continue
+            except asyncio.CancelledError:
+                self._pending.appendleft(segment)  # continued from its offset on resume
+                raise
+            except Exception as e:
+                if not self.mirrors.fail(mirror, e):
+                    self.error_host = mirror.host
+                    raise
+                logging.error(f"Error downloading {self.job.file_name} from mirror {mirror.url}: {e}")
+                self._record_failure(mirror.host, e, True)
+                self._pending.appendleft(segment)  # another mirror continues from its offset
+                continue
+            finally:
+                self._in_flight.discard(segment)
+            self._hash_finished()
+            if not self._pending:
+                self._steal_work()
+
+    def _steal_work(self):
+        """Split the largest in-flight range so an idle connection has something to do."""
+        if not self._in_flight:
+            return None
+        largest = max(self._in_flight, key=lambda segment: segment.remaining)
+        new = self.table.split(largest)
+        if new is not None:
+            self._pending.append(new)
+            self._save_table()
+        return new
+
+    async def _tune(self):
+        """Add a connection while each new one still raises throughput.
+
+        Connections are dropped when the server answers a range request with
+        429/503 (``Throttled``), and a connection that runs out of work
+        splits the largest range still in flight (``_steal_work``), so all
+        of them finish together.
+        """
+        last_bytes = self.job.downloaded
+        baseline = None
+        growing = True
+        while True:
+            await asyncio.sleep(TUNE_INTERVAL)
+            rate = (self.job.downloaded - last_bytes) / TUNE_INTERVAL
+            last_bytes = self.job.downloaded
+            if self.table.preallocate:
+                self._save_table()  # the part file's size says nothing, so the offsets are written down
+            if self.paused or not self._workers:
+                continue
+            self.mirrors.drop_slow()
+            self.host_stats.record_speed(rate / len(self._workers))
+
+            if self._throttled:
+                self._throttled = False
+                growing = False
+                continue
+            limit = min(self.max_segments, self.host_stats.max_segments or self.max_segments)
+            if not growing or len(self._workers) >= limit:
+                continue
+            if baseline is not None and rate < baseline * GROWTH_THRESHOLD:
+                growing = False  # the last connection did not help, bandwidth is used up
+                continue
+            if self._pending or self._steal_work() is not None:
+                baseline = rate
+                self._spawn_worker()
+
+    def _save_table(self):
+        """Write the segment table in a worker thread; changes made meanwhile are written once it is done."""
+        self._table_changed = True
+        if self._table_writer is None or self._table_writer.done():
+            self._table_writer = asyncio.get_running_loop().create_task(self._write_table())
+
+    async def _write_table(self):
+        try:
+            while self._table_changed:
+                self._table_changed = False
+                await self._blocking(self.table.write, self.table.snapshot())
+        finally:
+            self._table_writer = None
+
+    async def _fetch_segment(self, segment, mirror):
+        if segment.done:
+            return
+        headers = self.headers
+        headers["range"] = f"bytes={segment.start + segment.downloaded}-{segment.end}"
+        sent = time.monotonic()
+        mirror.connections += 1
+        try:
+            async with mirror.session.get(mirror.url, headers=headers) as response:
+                self._record_latency(sent)
+                if response.status != 206:
+                    raise Exception(f"Server ignored the range request (status {response.status})")
+                f = self._writer(segment)
+                sample_start = time.monotonic()
+                sampled = 0
+                measured = False
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    # The range may have been split while this request was running
+                    remaining = segment.remaining
+                    if len(chunk) >= remaining:
+                        chunk = chunk[:remaining]
+                    f.write(chunk)
+                    self._hash_chunk(segment.start + segment.downloaded, chunk)
+                    segment.downloaded += len(chunk)
+                    self._count_written(len(chunk))
+                    sampled += len(chunk)
+                    now = time.monotonic()
+                    if now - sample_start >= SAMPLE_SECONDS:
+                        mirror.record(sampled, now - sample_start)
+                        sample_start, sampled, measured = now, 0, True
+                    await self._on_chunk(len(chunk))
+                    if segment.done:
+                        break
+                if not measured:
+                    # A short request is measured as a whole; a leftover bit of a long one is too noisy
+                    mirror.record(sampled, time.monotonic() - sample_start)
+        except aiohttp.ClientResponseError as e:
+            if e.status in THROTTLE_STATUSES:
+                raise Throttled(f"{e.status} {e.message}", retry_after_of(e)) from e
+            raise
+        finally:
+            mirror.connections -= 1
+            writer = self._files.get(segment.path)
+            if writer is not None:
+                # The offset a paused or failed range continues from must be on disk, and a finished
+                # range may be read back for the checksum
+                writer.flush()
+        if not segment.done:
+            raise Exception(f"Incorrect segment size: expected {segment.size} bytes, received {segment.downloaded} bytes")
+
+    def _writer(self, segment):
+        f = self._files.get(segment.path)
+        if f is None:
+            if self._output_fd is not None:
+                f = RangeWriter(self._output_fd, segment)
+            else:
+                f = open(segment.path, "ab")
+            self._files[segment.path] = f
+        return f
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        if self._output_fd is not None:
+            os.close(self._output_fd)
+            self._output_fd = None
+
+    async def _blocking(self, func, *args):
+        """Run file work in a thread; a cancelled download still waits for it, so no file is removed under it."""
+        future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def _fetch_single(self):
+        """Stream the file in one request, hashed as it is written; ``sink`` gets each chunk with its offset."""
+        await self._wait_resumed()
+        with self._open_output() as f:
+            while True:
+                stream = asyncio.get_running_loop().create_task(self._stream_single(f))
+                self._workers = {stream}
+                try:
+                    await self._wait_for_workers()
+                finally:
+                    stream.cancel()
+                    self._workers.clear()
+                if not stream.cancelled():
+                    self._partial_output = False
+                    return
+                await self._wait_resumed()
+
+    async def _stream_single(self, f):
+        headers = self.headers
+        offset = f.tell()
+        if offset and self.accept_ranges:
+            headers["range"] = f"bytes={offset}-"
+        sent = time.monotonic()
+        async with self.session.get(self.job.url, headers=headers) as response:
+            self._record_latency(sent)
+            if self.size_limit is not None and not offset:
+                self._check_size(response.headers)
+            if offset and response.status != 206:
+                # No way to continue where the pause left off: start the file over
+                f.seek(0)
+                f.truncate()
+                self._hash = new_hash(algorithm_of(self.job.expected_hash))
+                self.job.downloaded -= offset
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if self.sink is not None:
+                    self.sink.feed(f.tell(), chunk)
+                f.write(chunk)
+                self._hash.update(chunk)
+                self._count_written(len(chunk))
+                await self._on_chunk(len(chunk))
+
+    def _check_size(self, headers):
+        """Take the validators of a small-file GET and stop it if the file is not small after all."""
+        if self.health is not None:
+            self.health.success(self.job.host)
+        self._read_headers(headers)
+        self.job.etag = self.etag
+        if self.job.size and self.job.size > self.size_limit:
+            raise TooLarge(f"{self.job.file_name} is {self.job.size} bytes, over {self.size_limit}")
+
+    def _open_output(self):
+        # Unlink first: the old file may be a hardlink into the download cache
+        if os.path.exists(self.job.file_path):
+            os.remove(self.job.file_path)
+        self._partial_output = True
+        return open(self.job.file_path, "wb")
+
+    def _finish_preallocated(self):
+        """Rename the part file into place; ``metrics.bytes_written`` already counted every byte once."""
+        os.replace(self.table.output_path, self.job.file_path)
+        os.remove(self.table.progress_file)
+
+    def _combine(self, segments):
+        """Join part files: the first becomes the output and the rest are appended in the kernel; returns bytes copied."""
+        self._partial_output = True
+        copied = 0
+        # Replacing rather than writing over: the old file may be a hardlink into the download cache
+        os.replace(segments[0].path, self.job.file_path)
+        with open(self.job.file_path, "r+b") as dest:
+            dest.seek(0, os.SEEK_END)
+            for segment in segments[1:]:
+                with open(segment.path, "rb") as src:
+                    copied += append_file(dest, src)
+                os.remove(segment.path)
+        os.remove(self.table.progress_file)
+        self._partial_output = False
+        return copied
+
+    def _hash_chunk(self, offset, chunk):
+        """Hash a chunk of a segmented download from memory if it continues the hashed prefix.
+
+        Ranges written ahead of the prefix are read back in a worker thread
+        as soon as the prefix reaches them (``_hash_finished``), counted in
+        ``metrics.bytes_read``. ``_finish_hash`` stores the result in
+        ``job.file_hash`` and fails the attempt if it is not the job's
+        ``expected_hash``.
+        """
+        if self._hash is not None and self._catch_up is None and offset == self._hashed:
+            self._hash.update(chunk)
+            self._hashed += len(chunk)
+
+    def _hash_finished(self):
+        """Start reading back the finished ranges the hashed prefix has reached, while the others download."""
+        if self._hash is not None and self._catch_up is None and self._hashable_end() > self._hashed:
+            self._catch_up = asyncio.get_running_loop().create_task(self._read_back_finished())
+
+    async def _hash_segments(self):
+        """Complete the checksum of a finished segmented download."""
+        if self._hash is None:
+            return
+        if self._catch_up is not None:
+            await self._catch_up
+        self._hash_finished()
+        if self._catch_up is not None:
+            await self._catch_up
+
+    def _hashable_end(self):
+        """Where the run of finished ranges starting at the hashed prefix ends."""
+        end = self._hashed
+        for segment in self.table.ordered():
+            if segment.end < end:
+                continue
+            if not segment.done:
+                break
+            end = segment.end + 1
+        return end
+
+    async def _read_back_finished(self):
+        hasher = self._hash
+        try:
+            # A retry starts over with a new hash; whatever this task read then no longer counts
+            while hasher is self._hash and self._hashable_end() > self._hashed:
+                end = self._hashable_end()
+                read = await self._blocking(self._read_back, hasher, self._pieces(self._hashed, end))
+                if hasher is self._hash:
+                    self._hashed = end
+                    if self.metrics is not None:
+                        self.metrics.bytes_read += read
+        finally:
+            if self._catch_up is asyncio.current_task():
+                self._catch_up = None
+
+    def _pieces(self, start, end):
+        """The (path, offset, length) on disk of bytes ``start`` to ``end`` of the output."""
+        if self.table.preallocate:
+            return [(self.table.output_path, start, end - start)]
+        return [(segment.path, max(start, segment.start) - segment.start,
+                 min(end, segment.end + 1) - max(start, segment.start))
+                for segment in self.table.ordered() if segment.start < end and segment.end >= start]
+
+    @staticmethod
+    def _read_back(hasher, pieces):
+        read = 0
+        for path, offset, length in pieces:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while length > 0 and (chunk := f.read(min(MEGABYTE, length))):
+                    hasher.update(chunk)
+                    length -= len(chunk)
+                    read += len(chunk)
+        return read
+
+    def _count_written(self, length):
+        if self.metrics is not None:
+            self.metrics.bytes_written += length
+
+    def _record_latency(self, sent):
+        if self.metrics is not None:
+            self.metrics.segment_latency.observe(time.monotonic() - sent)
+
+    async def _on_chunk(self, length):
+        if self._resumed_at is not None:
+            self.job.resume_latency = time.monotonic() - self._resumed_at
+            self._resumed_at = None
+        self.job.downloaded += length
+        if self.metrics is not None:
+            self.metrics.add_bytes(self.job.host, length)
+        self.bus.touch(self.job)
+        if self.shaper is not None and self.shaper.limited:
+            await self.shaper.acquire(self.job, length)
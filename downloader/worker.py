@@ -0,0 +1,120 @@
+"""Worker process for a coordinating download engine.
+
+Usage: python -m downloader.worker HOST:PORT [--slots 3] [--name NAME]
+
+Connects to an engine serving workers (``--workers`` or ``--listen`` on
+the command line, ``workers``/``worker_listen`` in the GUI's settings) and
+downloads the jobs it leases, each process with its own interpreter,
+event loop and connections. The shared secret is read from the
+``DOWNLOADER_TOKEN`` environment variable. Files are written to the paths
+the coordinator gives, so workers on other machines need the download
+directory mounted under the same path.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+
+from .cluster import (HEARTBEAT_SECONDS, TOKEN_VARIABLE, counters_of, event_to_wire, job_from_wire,
+                      open_connection, read_messages, send)
+from .engine import DownloadEngine
+
+
+class Worker:
+    """Runs the jobs a coordinator leases on a local ``DownloadEngine`` and reports back.
+
+    Events go back in the batches the engine delivers them in, and a
+    heartbeat every ``HEARTBEAT_SECONDS`` carries the engine's counters and
+    the connections of each job. When the coordinator goes away every
+    transfer is cancelled, keeping its part files for whichever worker
+    gets the job next.
+    """
+
+    def __init__(self, address, slots=3, name=None, token=None):
+        self.address = address
+        self.slots = slots
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.token = token
+        self.engine = None
+        self._loop = None
+        self._writer = None
+
+    async def run(self):
+        try:
+            reader, self._writer = await open_connection(self.address)
+        except OSError as e:
+            logging.error(f"Error connecting to coordinator {self.address}: {e}")
+            return 1
+        self._loop = asyncio.get_running_loop()
+        try:
+            # Being terminated ends the session like a closed connection: transfers stop and files are flushed
+            self._loop.add_signal_handler(signal.SIGTERM, reader.feed_eof)
+        except (NotImplementedError, RuntimeError):
+            pass  # no signal handlers on Windows or outside the main thread
+        send(self._writer, {"type": "hello", "name": self.name, "slots": self.slots, "token": self.token})
+        self.engine = DownloadEngine(on_events=self._on_events, max_concurrent=self.slots)
+        self.engine.start()
+        heartbeat = self._loop.create_task(self._heartbeat())
+        try:
+            async for message in read_messages(reader):
+                self._handle(message)
+        finally:
+            heartbeat.cancel()
+            await self._loop.run_in_executor(None, self.engine.shutdown)
+            self._writer.close()
+        return 0
+
+    def _handle(self, message):
+        kind = message.get("type")
+        if kind == "lease":
+            settings = message["settings"]
+            self.engine.configure(settings["max_segments"], settings["retries"], settings["preallocate"],
+                                  settings.get("checksums"))
+            self.engine.set_keep_partial(settings["keep_partial"])
+            self.engine.set_rate_limits(settings["global_rate"], settings["host_rate"])
+            job = job_from_wire(message["job"])
+            self.engine.submit(job)
+            if message.get("paused"):
+                self.engine.pause(job.id)
+        elif kind == "pause":
+            self.engine.pause(message["id"])
+        elif kind == "resume":
+            self.engine.resume(message["id"])
+        elif kind == "stop":
+            self.engine.stop(message["id"])
+
+    def _on_events(self, events):
+        # Called on the engine thread, where the jobs' state can be read consistently
+        message = {"type": "events", "events": [event_to_wire(event) for event in events]}
+        if any(event.kind in ("completed", "failed", "stopped") for event in events):
+            # A finished job's bytes are counted by the time the coordinator hears of it
+            message["counters"] = counters_of(self.engine.stats())
+        self._loop.call_soon_threadsafe(send, self._writer, message)
+
+    async def _heartbeat(self):
+        while True:
+            stats = await asyncio.wrap_future(self.engine.snapshot())
+            send(self._writer, {"type": "heartbeat", "counters": counters_of(stats),
+                                "connections": [[job["id"], job["connections"]] for job in stats["active"]]})
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m downloader.worker",
+                                     description="Download the jobs a coordinating engine leases to this process.")
+    parser.add_argument("address", help="coordinator to connect to, HOST:PORT or unix:/path/to/socket")
+    parser.add_argument("--slots", type=int, default=3, help="jobs to run at once (default: 3)")
+    parser.add_argument("--name", help="name to report to the coordinator (default: host name and process ID)")
+    args = parser.parse_args(argv)
+    worker = Worker(args.address, args.slots, args.name, os.environ.get(TOKEN_VARIABLE))
+    try:
+        return asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
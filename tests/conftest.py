@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+from benchmarks.server import ServerConfig, create_app
+
+
+class ServerThread:
+    """A ``benchmarks.server`` on a free local port, running on a loop in a thread of its own."""
+
+    def __init__(self, config):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="test-server", daemon=True)
+        self.thread.start()
+        self.runner = web.AppRunner(create_app(config), access_log=None)
+        port = asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def _start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def serve():
+    """Start servers with ``serve(ServerConfig(...))``; returns the base URL. They stop after the test."""
+    servers = []
+
+    def start(config=None):
+        server = ServerThread(config or ServerConfig())
+        servers.append(server)
+        return server.url
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def server_url(serve):
+    """The base URL of a ``benchmarks.server`` without latency, bandwidth cap or faults."""
+    return serve()
@@ -0,0 +1,50 @@
+from downloader.autotune import HOLD_WINDOWS, WARMUP_WINDOWS, ConcurrencyTuner, congestion
+from downloader.metrics import Metrics
+
+MEGABYTE = 1048576
+
+
+def test_busy_engine_keeps_a_slot_that_raises_goodput():
+    tuner = ConcurrencyTuner(2, 8, 10)
+    assert tuner.update(10 * MEGABYTE, False, True) == (3, 10)
+    for _ in range(WARMUP_WINDOWS):
+        assert tuner.update(10 * MEGABYTE, False, True)[0] == 3
+    assert tuner.update(12 * MEGABYTE, False, True)[0] == 3  # kept
+    assert tuner.update(12 * MEGABYTE, False, True)[0] == 4  # and the next one is tried
+
+
+def test_slot_that_adds_nothing_is_taken_back_and_held():
+    tuner = ConcurrencyTuner(2, 8, 10)
+    tuner.update(10 * MEGABYTE, False, True)
+    for _ in range(WARMUP_WINDOWS):
+        tuner.update(10 * MEGABYTE, False, True)
+    assert tuner.update(10 * MEGABYTE, False, True)[0] == 2
+    for _ in range(HOLD_WINDOWS):
+        assert tuner.update(10 * MEGABYTE, False, True)[0] == 2
+    assert tuner.update(10 * MEGABYTE, False, True)[0] == 3
+
+
+def test_congestion_halves_jobs_and_segments_then_segments_creep_back():
+    tuner = ConcurrencyTuner(1, 16, 10, jobs=8)
+    assert tuner.update(10 * MEGABYTE, True, True) == (4, 5)
+    assert tuner.update(10 * MEGABYTE, True, True) == (2, 2)
+    assert tuner.update(10 * MEGABYTE, False, True) == (2, 3)
+    assert tuner.update(10 * MEGABYTE, False, False) == (2, 4)
+
+
+def test_idle_engine_and_limits_are_respected():
+    tuner = ConcurrencyTuner(2, 3, 4, jobs=3)
+    assert tuner.update(10 * MEGABYTE, False, True) == (3, 4)  # at the maximum
+    tuner = ConcurrencyTuner(2, 8, 4)
+    assert tuner.update(10 * MEGABYTE, False, False) == (2, 4)  # nothing waiting for a slot
+    assert tuner.update(10 * MEGABYTE, True, False) == (2, 2)  # never below the minimum
+
+
+def test_congestion_counts_throttles_and_overload_errors():
+    metrics = Metrics()
+    metrics.add_throttle("http://a")
+    metrics.add_error("http://a", "503", True)
+    metrics.add_error("http://a", "429", True)
+    metrics.add_error("http://a", "error", True)
+    metrics.add_error("http://a", "404", True)  # the file is missing, the host is fine
+    assert congestion(metrics) == 4
@@ -0,0 +1,47 @@
+import os
+import threading
+
+from downloader.engine import DownloadEngine
+from downloader.jobs import Job
+
+THRESHOLD = 65536
+
+
+def run_jobs(jobs, **kwargs):
+    """Run ``jobs`` on an engine until each has completed or failed; returns every job's event kinds."""
+    kinds = {job.id: [] for job in jobs}
+    finished = threading.Event()
+
+    def on_events(events):
+        for event in events:
+            if event.kind != "progress":
+                kinds[event.job.id].append(event.kind)
+        if all(job_kinds and job_kinds[-1] in ("completed", "failed") for job_kinds in kinds.values()):
+            finished.set()
+
+    engine = DownloadEngine(on_events, **kwargs)
+    engine.start()
+    try:
+        for job in jobs:
+            engine.submit(job)
+        assert finished.wait(30), kinds
+        return kinds
+    finally:
+        engine.shutdown()
+
+
+def test_small_file_is_fetched_in_the_bulk_lane(server_url, tmp_path):
+    job = Job(1, f"{server_url}/4096", str(tmp_path))
+    kinds = run_jobs([job], bulk_threshold=THRESHOLD)
+    assert kinds[1] == ["queued", "started", "completed"]
+    assert os.path.getsize(job.file_path) == 4096
+
+
+def test_large_file_in_the_bulk_lane_is_requeued_to_a_regular_slot(server_url, tmp_path):
+    # The size is unknown up front, so the job starts as a small file and its GET tells otherwise
+    job = Job(1, f"{server_url}/1M", str(tmp_path))
+    kinds = run_jobs([job], bulk_threshold=THRESHOLD)
+    assert kinds[1] == ["queued", "started", "queued", "started", "completed"]
+    assert job.error is None
+    assert job.size == 1048576
+    assert os.path.getsize(job.file_path) == 1048576
@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import pytest
+
+from downloader.cluster import RemoteTransfer, WorkerLost, WorkerPool
+from downloader.events import ProgressBus
+from downloader.jobs import Job
+from downloader.metrics import Metrics
+
+
+def settings():
+    return {"global_rate": 0, "host_rate": 0}
+
+
+async def remote_transfer(pool):
+    bus = ProgressBus(asyncio.get_running_loop(), lambda events: None)
+    return RemoteTransfer(Job(1, "http://127.0.0.1:1/file.bin", "/tmp"), pool, bus)
+
+
+def test_lease_without_workers_raises_worker_lost():
+    async def run():
+        pool = WorkerPool(settings, Metrics(), lambda: None)
+        transfer = await remote_transfer(pool)
+        with pytest.raises(WorkerLost):
+            await transfer.run()
+
+    asyncio.run(run())
+
+
+def test_job_is_lost_when_its_worker_disconnects():
+    async def run():
+        changes = asyncio.Event()
+        pool = WorkerPool(settings, Metrics(), changes.set)
+        address = await pool.start("127.0.0.1:0")
+        host, port = address.rsplit(":", 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+        try:
+            writer.write(json.dumps({"type": "hello", "name": "w1", "slots": 2}).encode() + b"\n")
+            await asyncio.wait_for(changes.wait(), 10)
+            transfer = await remote_transfer(pool)
+            task = asyncio.get_running_loop().create_task(transfer.run())
+            lease = json.loads(await asyncio.wait_for(reader.readline(), 10))
+            assert lease["type"] == "lease" and lease["job"]["id"] == 1
+            writer.close()
+            with pytest.raises(WorkerLost):
+                await asyncio.wait_for(task, 10)
+            assert pool.workers == {}
+
+            # With the last worker gone the next lease fails right away instead of waiting
+            with pytest.raises(WorkerLost):
+                await (await remote_transfer(pool)).run()
+        finally:
+            writer.close()
+            await pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+
+from downloader.events import DownloadEvent, ProgressBus
+from downloader.jobs import Job
+
+
+def jobs(count):
+    return [Job(n, f"http://a/{n}.bin", "/tmp") for n in range(count)]
+
+
+def test_progress_of_every_job_arrives_in_one_batch():
+    async def run():
+        batches = []
+        bus = ProgressBus(asyncio.get_running_loop(), batches.append, max_rate=10)
+        for job in jobs(3):
+            for _ in range(100):
+                job.downloaded += 1024
+                bus.touch(job)
+        await asyncio.sleep(0.05)
+        return batches
+
+    batches = asyncio.run(run())
+    assert len(batches) == 1
+    assert sorted(event.job.id for event in batches[0]) == [0, 1, 2]
+    assert all(event.kind == "progress" for event in batches[0])
+
+
+def test_ticks_are_capped_at_max_rate():
+    async def run():
+        batches = []
+        bus = ProgressBus(asyncio.get_running_loop(), batches.append, max_rate=5)
+        job = jobs(1)[0]
+        loop = asyncio.get_running_loop()
+        end = loop.time() + 1.0
+        while loop.time() < end:
+            job.downloaded += 1024
+            bus.touch(job)
+            await asyncio.sleep(0.001)
+        return batches
+
+    batches = asyncio.run(run())
+    # One immediate tick, then one every 0.2 s
+    assert 4 <= len(batches) <= 6
+
+
+def test_state_change_is_immediate_and_drops_pending_progress():
+    async def run():
+        batches = []
+        bus = ProgressBus(asyncio.get_running_loop(), batches.append, max_rate=5)
+        first, second = jobs(2)
+        bus.touch(first)
+        await asyncio.sleep(0.01)  # the first tick goes out right away
+        bus.touch(first)
+        bus.touch(second)
+        bus.publish(DownloadEvent("completed", first))
+        assert [event.kind for event in batches[-1]] == ["completed"]
+        await asyncio.sleep(0.3)
+        return batches
+
+    batches = asyncio.run(run())
+    assert [[event.job.id for event in batch] for batch in batches] == [[0], [0], [1]]
@@ -0,0 +1,104 @@
+import asyncio
+
+import aiohttp
+
+from benchmarks.bench import pattern_checksum
+from benchmarks.server import ServerConfig
+from downloader.events import ProgressBus
+from downloader.jobs import Job, host_of
+from downloader.metrics import Metrics
+from downloader.mirrors import MIRROR_FAILURES, Mirror, MirrorSet
+from downloader.retry import CLOSED, OPEN, HostHealth
+from downloader.segments import HostStats
+from downloader.transfer import Transfer
+
+MEGABYTE = 1048576
+SIZE = 8 * MEGABYTE
+
+
+def mirror_set(count):
+    return MirrorSet([Mirror(f"http://mirror{n}/x.bin", None) for n in range(count)])
+
+
+def test_unmeasured_mirrors_are_tried_first_then_the_fastest():
+    mirrors = mirror_set(3)
+    first, second, third = mirrors.mirrors
+    first.record(MEGABYTE, 1)
+    second.record(4 * MEGABYTE, 1)
+    assert mirrors.pick() is third
+    third.record(2 * MEGABYTE, 1)
+    assert mirrors.pick() is second
+    second.connections = 3  # 1 MB/s left per connection
+    assert mirrors.pick() is third
+
+
+def test_failing_mirror_is_dropped_but_never_the_last():
+    mirrors = mirror_set(2)
+    first, second = mirrors.mirrors
+    for _ in range(MIRROR_FAILURES):
+        assert mirrors.fail(second, Exception("broken"))
+    assert second.dropped
+    assert mirrors.usable == [first]
+    assert not mirrors.fail(first, Exception("broken"))
+    assert not first.dropped
+
+
+def test_slow_mirror_is_dropped():
+    mirrors = mirror_set(3)
+    for mirror, speed in zip(mirrors.mirrors, (10, 9, 1)):
+        mirror.record(speed * MEGABYTE, 1)
+    mirrors.drop_slow()
+    assert [mirror.dropped for mirror in mirrors.mirrors] == [False, False, True]
+
+
+def download_with_mirror(primary, mirror, **kwargs):
+    job = Job(1, f"{primary}/{SIZE}", kwargs.pop("directory"))
+    job.mirrors = [f"{mirror}/{SIZE}"]
+    job.expected_hash = pattern_checksum(SIZE)
+
+    async def run():
+        async with aiohttp.ClientSession(raise_for_status=True) as session:
+            bus = ProgressBus(asyncio.get_running_loop(), lambda events: None)
+            transfer = Transfer(job, session, bus, max_segments=4, retries=0, **kwargs)
+            return await transfer.run(), transfer
+
+    success, transfer = asyncio.run(run())
+    assert success, transfer.error
+    assert job.file_hash == job.expected_hash
+    return transfer
+
+
+def test_ranges_are_spread_over_both_mirrors(serve, tmp_path):
+    primary, mirror = serve(), serve()
+    metrics = Metrics()
+    download_with_mirror(primary, mirror, directory=str(tmp_path), metrics=metrics)
+    assert set(metrics.bytes_by_host) == {host_of(primary)}  # progress is the job's
+    assert metrics.errors == {}
+
+
+def test_broken_mirror_is_charged_to_its_own_host(serve, tmp_path):
+    primary, mirror = serve(), serve(ServerConfig(disconnect_rate=1.0))
+    health = HostHealth(threshold=1)
+    metrics = Metrics()
+    transfer = download_with_mirror(primary, mirror, directory=str(tmp_path), health=health, metrics=metrics)
+    assert health.state(host_of(mirror)) == OPEN
+    assert health.state(host_of(primary)) == CLOSED
+    assert {host for host, _ in metrics.errors} == {host_of(mirror)}
+    assert [m.url for m in transfer.mirrors.usable] == [transfer.job.url]
+
+
+def test_throttling_mirror_does_not_limit_the_primary_host(serve, tmp_path):
+    primary, mirror = serve(), serve(ServerConfig(error_rate=1.0))
+    host_stats = HostStats()
+    metrics = Metrics()
+    download_with_mirror(primary, mirror, directory=str(tmp_path), host_stats=host_stats, metrics=metrics)
+    assert set(metrics.throttles_by_host) == {host_of(mirror)}
+    assert host_stats.max_segments is None
+
+
+def test_mirror_with_an_open_circuit_is_not_used(serve, tmp_path):
+    primary, mirror = serve(), serve()
+    health = HostHealth(threshold=1)
+    health.failure(host_of(mirror), aiohttp.ClientConnectionError())
+    transfer = download_with_mirror(primary, mirror, directory=str(tmp_path), health=health)
+    assert [m.url for m in transfer.mirrors.mirrors] == [transfer.job.url]
@@ -0,0 +1,123 @@
+import gzip
+import io
+import os
+import sys
+import tarfile
+import threading
+import time
+
+import pytest
+
+from downloader.engine import DownloadEngine
+from downloader.jobs import Job
+from downloader.postprocess import (Extract, MoveTo, PostProcessor, RunCommand, StreamExtractor, WriteChecksum,
+                                    run_steps)
+
+CHUNK = 65536
+
+
+def make_tar_gz(path, files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(path, "wb") as f:
+        f.write(buffer.getvalue())
+    return buffer.getvalue()
+
+
+def feed(extractor, data, start=0, end=None):
+    for offset in range(start, len(data) if end is None else end, CHUNK):
+        extractor.feed(offset, data[offset:offset + CHUNK])
+
+
+FILES = {"data/a.bin": os.urandom(300000), "data/b.txt": b"hello\n"}
+
+
+def test_steps_extract_checksum_move_and_run(tmp_path):
+    path = str(tmp_path / "data.tar.gz")
+    make_tar_gz(path, FILES)
+    done = tmp_path / "done"
+    steps = [Extract(), WriteChecksum("sha256"), MoveTo(str(done)),
+             RunCommand(f"{sys.executable} -c 'import sys, os; assert os.path.exists(sys.argv[1])'")]
+    assert run_steps(steps, path) == str(done / "data.tar.gz")
+    with open(tmp_path / "data" / "data" / "a.bin", "rb") as f:
+        assert f.read() == FILES["data/a.bin"]
+    assert (tmp_path / "data.tar.gz.sha256").read_text().endswith("  data.tar.gz\n")
+
+
+def test_failing_command_fails_the_steps(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"x")
+    with pytest.raises(RuntimeError, match="exited with status 3"):
+        run_steps([RunCommand(f"{sys.executable} -c 'raise SystemExit(3)'")], str(path))
+
+
+def test_stream_is_extracted_as_it_arrives(tmp_path):
+    path = str(tmp_path / "data.tar.gz")
+    data = make_tar_gz(path, FILES)
+    extractor = StreamExtractor(path, Extract().destination(path))
+    feed(extractor, data)
+    assert extractor.finish()
+    assert (tmp_path / "data" / "data" / "b.txt").read_bytes() == b"hello\n"
+
+
+def test_restarted_stream_removes_what_it_extracted(tmp_path):
+    path = str(tmp_path / "data.tar.gz")
+    data = make_tar_gz(path, FILES)
+    destination = tmp_path / "data"
+    destination.mkdir()
+    (destination / "kept.txt").write_text("there before")
+    extractor = StreamExtractor(path, str(destination))
+    feed(extractor, data, end=len(data) // 2)
+    time.sleep(0.2)  # let the thread write part of the archive
+    extractor.feed(0, data[:CHUNK])  # the download started over
+    assert not extractor.finish()
+    assert sorted(os.listdir(destination)) == ["kept.txt"]
+
+    # The fallback extraction from the finished file starts from a clean destination
+    Extract()(path)
+    assert sorted(os.listdir(destination)) == ["data", "kept.txt"]
+
+
+def test_failed_download_removes_the_extracted_file(tmp_path):
+    path = str(tmp_path / "log.gz")
+    data = gzip.compress(os.urandom(200000))
+    extractor = StreamExtractor(path, Extract().destination(path))
+    feed(extractor, data, end=len(data) // 2)
+    time.sleep(0.2)
+    extractor.abandon()
+    extractor._thread.join()
+    assert not os.path.exists(tmp_path / "log")
+
+
+def test_finished_downloads_wait_for_room_in_post_processing(server_url, tmp_path):
+    # One pool process: two jobs may be processing, the other downloads keep their slots meanwhile
+    postprocessor = PostProcessor([RunCommand(f"{sys.executable} -c 'import time; time.sleep(0.5)'")], workers=1)
+    completed = []
+    finished = threading.Event()
+
+    def on_events(events):
+        completed.extend(event.job.id for event in events if event.kind == "completed")
+        if len(completed) == 5:
+            finished.set()
+
+    engine = DownloadEngine(on_events, max_concurrent=5, postprocessor=postprocessor)
+    engine.start()
+    try:
+        for n in range(5):
+            (tmp_path / str(n)).mkdir()
+            engine.submit(Job(n, f"{server_url}/4096", str(tmp_path / str(n))))
+        most = 0
+        deadline = time.monotonic() + 60
+        while not finished.wait(0.05):
+            assert time.monotonic() < deadline, f"completed: {completed}"
+            stats = engine.snapshot().result(10)
+            most = max(most, stats["processing"])
+            assert stats["processing"] <= postprocessor.backlog
+        assert most == postprocessor.backlog
+    finally:
+        engine.shutdown()
+        postprocessor.shutdown()
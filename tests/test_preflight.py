@@ -0,0 +1,61 @@
+import asyncio
+
+import aiohttp
+
+from benchmarks.server import LAST_MODIFIED, pattern_bytes
+from downloader.jobs import Job
+from downloader.preflight import probe
+
+SIZE = 4096
+
+
+def probe_job(job):
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            return await probe(session, job, asyncio.Semaphore(1))
+    return asyncio.run(run())
+
+
+def finished_job(server_url, tmp_path, local_size=SIZE, etag=str(SIZE), last_modified=LAST_MODIFIED):
+    job = Job(1, f"{server_url}/{SIZE}", str(tmp_path))
+    job.size = SIZE
+    job.etag = etag
+    job.last_modified = last_modified
+    with open(job.file_path, "wb") as f:
+        f.write(pattern_bytes(0, local_size))
+    return job
+
+
+def test_not_modified_file_is_unchanged(server_url, tmp_path):
+    result = probe_job(finished_job(server_url, tmp_path))
+    assert result.status == 304
+    assert result.unchanged
+
+
+def test_last_modified_alone_is_asked_for(server_url, tmp_path):
+    result = probe_job(finished_job(server_url, tmp_path, etag=None))
+    assert result.status == 304
+    assert result.unchanged
+
+
+def test_file_of_another_size_is_not_trusted(server_url, tmp_path):
+    # A partial or replaced file: the request is not conditional, so the server cannot answer 304
+    job = finished_job(server_url, tmp_path, local_size=SIZE // 2)
+    result = probe_job(job)
+    assert result.status == 200
+    assert result.local_size == SIZE // 2
+    assert not result.unchanged
+
+
+def test_changed_etag_is_downloaded_again(server_url, tmp_path):
+    result = probe_job(finished_job(server_url, tmp_path, etag="old"))
+    assert result.status == 200
+    assert not result.unchanged
+
+
+def test_missing_file_is_probed_for_its_size(server_url, tmp_path):
+    job = Job(1, f"{server_url}/3M", str(tmp_path))
+    result = probe_job(job)
+    assert not result.exists
+    assert result.size == job.size == 3 * 1048576
+    assert result.accept_ranges
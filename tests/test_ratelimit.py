@@ -0,0 +1,72 @@
+import asyncio
+
+from downloader.jobs import Job
+from downloader.ratelimit import BandwidthShaper, parse_rate
+
+CHUNK = 65536
+MEGABYTE = 1048576
+
+
+def test_parse_rate():
+    assert parse_rate("500K") == 500 * 1024
+    assert parse_rate("2M") == 2 * MEGABYTE
+    assert parse_rate("1.5mb/s") == int(1.5 * MEGABYTE)
+    assert parse_rate("1048576") == MEGABYTE
+    assert parse_rate("") == 0
+
+
+async def pull(shaper, job, granted, connections, seconds):
+    """Run ``connections`` loops taking chunks for ``job`` for ``seconds``; counts the bytes granted in time."""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + seconds
+
+    async def connection():
+        while loop.time() < end:
+            await shaper.acquire(job, CHUNK)
+            if loop.time() < end:  # not the chunks still waiting when time was up
+                granted[job.id] = granted.get(job.id, 0) + CHUNK
+
+    await asyncio.gather(*(connection() for _ in range(connections)))
+
+
+def test_unlimited_shaper_is_skipped():
+    async def run():
+        return BandwidthShaper(asyncio.get_running_loop()).limited
+
+    assert not asyncio.run(run())
+
+
+def test_global_rate_is_kept():
+    async def run():
+        shaper = BandwidthShaper(asyncio.get_running_loop(), global_rate=MEGABYTE)
+        granted = {}
+        await pull(shaper, Job(1, "http://a/1.bin", "/tmp"), granted, 4, 1.0)
+        return granted[1]
+
+    # At most a quarter second of burst on top of one second at the rate
+    assert 0.9 * MEGABYTE <= asyncio.run(run()) <= 1.25 * MEGABYTE
+
+
+def test_job_with_many_segments_gets_the_same_share():
+    async def run():
+        shaper = BandwidthShaper(asyncio.get_running_loop(), global_rate=2 * MEGABYTE)
+        granted = {}
+        many, one = Job(1, "http://a/1.bin", "/tmp"), Job(2, "http://a/2.bin", "/tmp")
+        await asyncio.gather(pull(shaper, many, granted, 8, 1.0), pull(shaper, one, granted, 1, 1.0))
+        return granted
+
+    granted = asyncio.run(run())
+    assert 0.8 <= granted[1] / granted[2] <= 1.25
+
+
+def test_each_host_has_its_own_limit():
+    async def run():
+        shaper = BandwidthShaper(asyncio.get_running_loop(), host_rate=MEGABYTE // 2)
+        granted = {}
+        first, second = Job(1, "http://a/1.bin", "/tmp"), Job(2, "http://b/2.bin", "/tmp")
+        await asyncio.gather(pull(shaper, first, granted, 2, 1.0), pull(shaper, second, granted, 2, 1.0))
+        return granted
+
+    granted = asyncio.run(run())
+    for job_id in (1, 2):
+        assert 0.4 * MEGABYTE <= granted[job_id] <= 0.75 * MEGABYTE
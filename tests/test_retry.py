@@ -0,0 +1,68 @@
+import aiohttp
+import pytest
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from downloader.retry import (BASE_COOLDOWN, CLOSED, FAILURE_THRESHOLD, HALF_OPEN, OPEN, HostHealth, RetryPolicy,
+                              is_retryable, parse_retry_after)
+
+HOST = "http://example.test"
+
+
+def response_error(status, headers=None):
+    info = aiohttp.RequestInfo(URL(HOST), "GET", CIMultiDictProxy(CIMultiDict()), URL(HOST))
+    return aiohttp.ClientResponseError(info, (), status=status, message="", headers=headers)
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap():
+    policy = RetryPolicy(base=1.0, cap=5.0)
+    for attempt, backoff in enumerate((1.0, 2.0, 4.0, 5.0, 5.0)):
+        for _ in range(20):
+            assert backoff / 2 <= policy.delay(attempt) <= backoff
+
+
+def test_retry_after_is_a_lower_bound():
+    assert RetryPolicy(base=1.0).delay(0, retry_after=30) == 30
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("soon") is None
+
+
+def test_client_errors_are_not_retried():
+    assert not is_retryable(response_error(404))
+    assert is_retryable(response_error(429))
+    assert is_retryable(response_error(503))
+    assert is_retryable(aiohttp.ClientConnectionError())
+
+
+def test_circuit_opens_after_repeated_host_failures():
+    opened = []
+    health = HostHealth(on_open=lambda host, seconds: opened.append((host, seconds)))
+    for _ in range(FAILURE_THRESHOLD - 1):
+        health.failure(HOST, aiohttp.ClientConnectionError())
+    assert health.state(HOST) == CLOSED
+    health.failure(HOST, aiohttp.ClientConnectionError())
+    assert health.is_open(HOST)
+    assert opened == [(HOST, BASE_COOLDOWN)]
+
+
+def test_file_errors_do_not_count_against_the_host():
+    health = HostHealth(threshold=1)
+    health.failure(HOST, response_error(404))
+    assert health.state(HOST) == CLOSED
+
+
+@pytest.mark.parametrize("probe_succeeds", [True, False])
+def test_half_open_probe_closes_or_reopens(probe_succeeds):
+    opened, closed = [], []
+    health = HostHealth(on_open=lambda host, seconds: opened.append(seconds), on_close=closed.append, threshold=1)
+    health.failure(HOST, response_error(503, {"Retry-After": "1"}))
+    health.half_open(HOST)
+    assert health.state(HOST) == HALF_OPEN
+    if probe_succeeds:
+        health.success(HOST)
+        assert health.state(HOST) == CLOSED
+        assert closed == [HOST]
+    else:
+        health.failure(HOST, aiohttp.ClientConnectionError())
+        assert health.state(HOST) == OPEN
+        assert opened == [BASE_COOLDOWN, 2 * BASE_COOLDOWN]
@@ -0,0 +1,60 @@
+from downloader.jobs import Job
+from downloader.scheduler import PRIORITY_HIGH, Scheduler
+
+
+def jobs_on(host, count, first_id, priority=0):
+    return [Job(first_id + n, f"http://{host}/{n}.bin", "/tmp", priority=priority) for n in range(count)]
+
+
+def pop_all(scheduler):
+    popped = []
+    while (job := scheduler.pop()) is not None:
+        popped.append(job)
+    return popped
+
+
+def test_hosts_take_turns():
+    scheduler = Scheduler(per_host_limit=10)
+    for job in jobs_on("a", 4, 0) + jobs_on("b", 2, 100) + jobs_on("c", 2, 200):
+        scheduler.push(job)
+    hosts = [job.host for job in pop_all(scheduler)]
+    # Every host gets a job before any host gets a second one
+    assert sorted(hosts[:3]) == ["http://a", "http://b", "http://c"]
+    assert sorted(hosts[3:6]) == ["http://a", "http://b", "http://c"]
+    assert hosts[6:] == ["http://a", "http://a"]
+
+
+def test_per_host_limit_leaves_slots_to_other_hosts():
+    scheduler = Scheduler(per_host_limit=2)
+    for job in jobs_on("slow", 10, 0) + jobs_on("fast", 1, 100):
+        scheduler.push(job)
+    popped = pop_all(scheduler)
+    assert [job.host for job in popped].count("http://slow") == 2
+    assert "http://fast" in [job.host for job in popped]
+    assert len(scheduler) == 8
+
+    scheduler.release(popped[0] if popped[0].host == "http://slow" else popped[1])
+    assert scheduler.pop().host == "http://slow"
+    assert scheduler.pop() is None
+
+
+def test_priority_goes_before_fairness():
+    scheduler = Scheduler(per_host_limit=10)
+    for job in jobs_on("a", 3, 0):
+        scheduler.push(job)
+    urgent = jobs_on("b", 1, 100, priority=PRIORITY_HIGH)[0]
+    scheduler.push(urgent)
+    assert scheduler.pop() is urgent
+
+
+def test_parked_host_waits_until_unparked():
+    scheduler = Scheduler(per_host_limit=4)
+    for job in jobs_on("down", 2, 0) + jobs_on("up", 1, 100):
+        scheduler.push(job)
+    scheduler.limit_host("http://down", 0)
+    assert [job.host for job in pop_all(scheduler)] == ["http://up"]
+    scheduler.limit_host("http://down", 1)
+    assert scheduler.pop().host == "http://down"
+    assert scheduler.pop() is None
+    scheduler.limit_host("http://down")
+    assert scheduler.pop().host == "http://down"
@@ -0,0 +1,50 @@
+from downloader import segments
+from downloader.segments import (INITIAL_SEGMENTS, MEGABYTE, THROTTLE_RECOVERY, HostStats, SegmentTable,
+                                 plan_segments)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_plan_follows_size_and_measured_speed():
+    assert plan_segments(MEGABYTE, True, 10) == 1
+    assert plan_segments(64 * MEGABYTE, False, 10) == 1
+    assert plan_segments(64 * MEGABYTE, True, 10) == INITIAL_SEGMENTS
+    stats = HostStats()
+    stats.record_speed(MEGABYTE)
+    assert plan_segments(64 * MEGABYTE, True, 10, stats) == 10
+    assert plan_segments(3 * MEGABYTE, True, 10, stats) == 2
+
+
+def test_throttled_host_gets_connections_back_over_time(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(segments, "time", clock)
+    stats = HostStats()
+    assert stats.max_segments is None
+    stats.record_throttle(4)
+    stats.record_throttle(2)
+    assert stats.max_segments == 1
+    assert plan_segments(64 * MEGABYTE, True, 10, stats) == 1
+
+    clock.now += THROTTLE_RECOVERY
+    assert stats.max_segments == 2
+    clock.now += 2 * THROTTLE_RECOVERY
+    assert plan_segments(64 * MEGABYTE, True, 10, stats) == INITIAL_SEGMENTS
+
+    # Another 503 cuts back from where the host had recovered to
+    stats.record_throttle(4)
+    assert stats.max_segments == 3
+
+
+def test_split_hands_out_the_back_half_of_a_range(tmp_path):
+    table = SegmentTable("http://a/x.bin", str(tmp_path / "x.bin"), 8 * MEGABYTE, "etag", preallocate=True)
+    first, *_ = table.load_or_create(2)
+    new = table.split(first)
+    assert first.end + 1 == new.start
+    assert first.size + new.size == 4 * MEGABYTE
+    assert [segment.start for segment in table.ordered()] == [0, first.end + 1, 4 * MEGABYTE]
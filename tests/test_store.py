@@ -0,0 +1,57 @@
+from downloader.store import JobStore
+
+
+def saved(store):
+    return {job.url: job.file_name for job in store.load(0, 1000)}
+
+
+def test_duplicate_urls_are_saved_once(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    try:
+        assert store.add_links(["http://a/x.bin", "http://a/y.bin", "http://a/x.bin"], str(tmp_path)) == 2
+        assert store.add_links(["http://a/y.bin", "http://a/z.bin"], str(tmp_path)) == 1
+        assert store.count() == 3
+    finally:
+        store.close()
+
+
+def test_taken_file_names_get_numbered_suffixes(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    try:
+        store.add_links(["http://a/x.bin", "http://b/x.bin", "http://c/x.bin?v=2"], str(tmp_path))
+        store.add_links(["http://d/x.bin", "http://e/x (1).bin", "http://f/"], str(tmp_path))
+        assert saved(store) == {
+            "http://a/x.bin": "x.bin",
+            "http://b/x.bin": "x (1).bin",
+            "http://c/x.bin?v=2": "x (2).bin",
+            "http://d/x.bin": "x (3).bin",
+            "http://e/x (1).bin": "x (1) (1).bin",
+            "http://f/": "download",
+        }
+    finally:
+        store.close()
+
+
+def test_names_and_urls_are_remembered_across_stores(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = JobStore(path)
+    store.add_links(["http://a/x.bin"], str(tmp_path))
+    store.close()
+
+    store = JobStore(path)
+    try:
+        assert store.add_links(["http://a/x.bin", "http://b/x.bin"], str(tmp_path)) == 1
+        assert saved(store)["http://b/x.bin"] == "x (1).bin"
+    finally:
+        store.close()
+
+
+def test_cleared_store_reuses_names(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    try:
+        store.add_links(["http://a/x.bin", "http://b/x.bin"], str(tmp_path))
+        store.clear()
+        assert store.add_links(["http://b/x.bin"], str(tmp_path)) == 1
+        assert saved(store) == {"http://b/x.bin": "x.bin"}
+    finally:
+        store.close()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+
+from benchmarks.bench import pattern_checksum
+from benchmarks.server import CHUNK_SIZE, ServerConfig, pattern_bytes
+from downloader.events import ProgressBus
+from downloader.jobs import Job
+from downloader.metrics import Metrics
+from downloader.segments import HostStats
+from downloader.transfer import Transfer
+
+MEGABYTE = 1048576
+SIZE = 4 * MEGABYTE
+
+
+def expected_content(size):
+    return b"".join(pattern_bytes(offset, min(CHUNK_SIZE, size - offset)) for offset in range(0, size, CHUNK_SIZE))
+
+
+def assert_downloaded(job, size=SIZE):
+    with open(job.file_path, "rb") as f:
+        assert f.read() == expected_content(size)
+    # Only the finished file is left: no part files and no segment table
+    assert os.listdir(job.download_path) == [job.file_name]
+
+
+def engine_session():
+    # Error statuses raise, as they do in the engine's sessions
+    return aiohttp.ClientSession(raise_for_status=True)
+
+
+async def transfer_for(job, session, **kwargs):
+    bus = ProgressBus(asyncio.get_running_loop(), lambda events: None)
+    return Transfer(job, session, bus, max_segments=4, retries=0, **kwargs)
+
+
+async def wait_for(condition, timeout=30):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+@pytest.mark.parametrize("preallocate", [True, False])
+def test_segments_are_joined_into_the_file(server_url, tmp_path, preallocate):
+    job = Job(1, f"{server_url}/{SIZE}", str(tmp_path))
+    job.expected_hash = pattern_checksum(SIZE)
+    metrics = Metrics()
+
+    async def run():
+        async with engine_session() as session:
+            transfer = await transfer_for(job, session, preallocate=preallocate, metrics=metrics)
+            assert await transfer.run()
+            return transfer
+
+    transfer = asyncio.run(run())
+    assert transfer.table is not None and len(transfer.table.segments) > 1
+    assert job.file_hash == job.expected_hash
+    assert_downloaded(job)
+    written = SIZE if preallocate else 2 * SIZE - transfer.table.ordered()[0].size  # the first part is renamed
+    assert metrics.bytes_written == written
+
+
+def test_wrong_checksum_fails_the_download(server_url, tmp_path):
+    job = Job(1, f"{server_url}/{SIZE}", str(tmp_path))
+    job.expected_hash = pattern_checksum(SIZE - 1)
+
+    async def run():
+        async with engine_session() as session:
+            transfer = await transfer_for(job, session)
+            return await transfer.run(), transfer.error
+
+    success, error = asyncio.run(run())
+    assert not success
+    assert "Checksum mismatch" in error
+
+
+def test_pause_keeps_progress_and_resume_finishes(serve, tmp_path):
+    url = serve(ServerConfig(bandwidth=MEGABYTE))
+    job = Job(1, f"{url}/{SIZE}", str(tmp_path))
+    job.expected_hash = pattern_checksum(SIZE)
+
+    async def run():
+        async with engine_session() as session:
+            transfer = await transfer_for(job, session)
+            task = asyncio.get_running_loop().create_task(transfer.run())
+            await wait_for(lambda: job.downloaded >= MEGABYTE)
+            transfer.pause()
+            await wait_for(lambda: transfer.connections == 0)
+            paused_at = job.downloaded
+            await asyncio.sleep(0.5)
+            assert job.downloaded == paused_at
+            assert not task.done()
+            transfer.resume()
+            assert await task
+            assert job.resume_latency is not None
+
+    asyncio.run(run())
+    assert job.file_hash == job.expected_hash
+    assert_downloaded(job)
+
+
+def test_stopped_download_resumes_from_its_part_files(serve, tmp_path):
+    url = serve(ServerConfig(bandwidth=MEGABYTE))
+    job = Job(1, f"{url}/{SIZE}", str(tmp_path))
+    job.expected_hash = pattern_checksum(SIZE)
+    metrics = Metrics()
+
+    async def run():
+        async with engine_session() as session:
+            transfer = await transfer_for(job, session, preallocate=False, metrics=metrics)
+            task = asyncio.get_running_loop().create_task(transfer.run())
+            await wait_for(lambda: job.downloaded >= MEGABYTE)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            stopped_at = sum(segment.downloaded for segment in job.segments)
+            assert stopped_at > 0
+            received = sum(metrics.bytes_by_host.values())
+
+            transfer = await transfer_for(job, session, preallocate=False, metrics=metrics)
+            assert await transfer.run()
+            # Only what was missing is fetched again
+            assert sum(metrics.bytes_by_host.values()) - received == SIZE - stopped_at
+
+    asyncio.run(run())
+    assert job.file_hash == job.expected_hash
+    assert_downloaded(job)
+
+
+def test_throttled_connections_leave_one_to_finish(serve, tmp_path):
+    # Three in four range requests get a 503, so every connection is throttled at some point
+    url = serve(ServerConfig(error_rate=0.75, seed=3))
+    job = Job(1, f"{url}/{SIZE}", str(tmp_path))
+    metrics = Metrics()
+    host_stats = HostStats()
+
+    async def run():
+        async with engine_session() as session:
+            transfer = await transfer_for(job, session, metrics=metrics, host_stats=host_stats)
+            return await transfer.run(), transfer.error
+
+    success, error = asyncio.run(run())
+    assert success, error
+    assert sum(metrics.throttles_by_host.values()) >= 4
+    assert host_stats.max_segments == 1
+    assert_downloaded(job)